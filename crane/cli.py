@@ -3,8 +3,11 @@ import sys
 
 import click
 
-from . import deployment, hooks, rancher, settings
+from . import deployment, hooks, rancher, settings, transport
 from .exc import UpgradeFailed
+from .hooks import outbox
+from .stats import recorder
+from .tracing import tracer
 from .upgrade import upgrade
 
 
@@ -19,6 +22,23 @@ def strip_trailing_slash(_, param, value):
     )
 
 
+def default_cache_dir():
+    return os.path.join(os.getenv('XDG_CACHE_HOME', '~/.cache'), 'crane')
+
+
+def parse_stack_file(_, __, value):
+    """Read lines of stack names, each optionally followed by service names."""
+    if not value:
+        return
+
+    targets = []
+    for line in value:
+        words = line.split("#")[0].split()
+        if words:
+            targets.append((words[0], tuple(words[1:])))
+    return tuple(targets)
+
+
 # Ignore PyCommentedCodeBear
 # fmt: off
 # start ignoring LineLengthBear
@@ -27,23 +47,41 @@ def strip_trailing_slash(_, param, value):
 @click.option('--access-key', envvar='RANCHER_ACCESS_KEY', required=True, help='Rancher access key')
 @click.option('--secret-key', envvar='RANCHER_SECRET_KEY', required=True, help='Rancher secret key')
 @click.option('--env', envvar='RANCHER_ENV_ID', required=True, help='ID of environment to operate in')
-@click.option('--stack', envvar='RANCHER_STACK_NAME', required=True, help='stack to upgrade')
+@click.option('--stack', envvar='RANCHER_STACK_NAME', multiple=True, help='stacks to upgrade')
+@click.option('--stack-file', envvar='CRANE_STACK_FILE', type=click.File(), callback=parse_stack_file, help='file listing stacks to upgrade, one per line')
 @click.option('--service', envvar='RANCHER_SERVICE_NAME', default=['app'], multiple=True, help='services to upgrade', show_default=True)
 @click.option('--sidekick', envvar='RANCHER_SIDEKICK_NAME', default=None, help='sidekick to use instead of primary service')
 @click.option('--batch-size', envvar='CRANE_BATCH_SIZE', default=1, help='containers to upgrade at once', show_default=True)
 @click.option('--batch-interval', envvar='CRANE_BATCH_INTERVAL', default=2, help='seconds to wait between batches', show_default=True)
+@click.option('--parallelism', envvar='CRANE_PARALLELISM', default=1, help='services to upgrade at once per stack', show_default=True)
+@click.option('--max-parallelism', envvar='CRANE_MAX_PARALLELISM', default=0, help='services to upgrade at once across all stacks (0 for no limit)', show_default=True)
 @click.option('--start-first', envvar='CRANE_START_FIRST', default=False, is_flag=True, help='start new containers before stopping old')
 @click.option('--new-commit', envvar='CRANE_NEW_COMMIT', default=lambda: os.getenv('CI_COMMIT_SHA'), help='commit hash to upgrade to')
 @click.option('--new-image', envvar='CRANE_NEW_IMAGE', help='image URL to upgrade to')
 @click.option('--sleep-after-upgrade', envvar='CRANE_SLEEP_AFTER_UPGRADE', default=0, help='seconds to wait after upgrade', show_default=True)
+@click.option('--upgrade-timeout', envvar='CRANE_UPGRADE_TIMEOUT', default=0, help='seconds to wait for the upgrade before failing (0 to wait forever)', show_default=True)
+@click.option('--watch-events', envvar='CRANE_WATCH_EVENTS', default=False, is_flag=True, help="follow Rancher's events instead of polling")
 @click.option('--manual-finish', envvar='CRANE_MANUAL_FINISH', default=False, is_flag=True, help='skip automatic upgrade finish')
+@click.option('--hook-timeout', envvar='CRANE_HOOK_TIMEOUT', default=60, help='seconds each integration may take per event (0 for no limit)', show_default=True)
+@click.option('--hooks-timeout', envvar='CRANE_HOOKS_TIMEOUT', default=120, help='seconds all integrations may take per event (0 for no limit)', show_default=True)
+@click.option('--background-hooks', envvar='CRANE_BACKGROUND_HOOKS', default=False, is_flag=True, help='start upgrading without waiting for integrations to announce it')
+@click.option('--max-changelog-commits', envvar='CRANE_MAX_CHANGELOG_COMMITS', default=100, help='commits to list in release announcements (0 for no limit)', show_default=True)
+@click.option('--max-payload-commits', envvar='CRANE_MAX_PAYLOAD_COMMITS', default=1000, help='commits to send to Sentry and webhooks (0 for no limit)', show_default=True)
+@click.option('--cache-dir', envvar='CRANE_CACHE_DIR', default=default_cache_dir, help='directory to keep data between runs in (empty to turn off)')
+@click.option('--trace-file', envvar='CRANE_TRACE_FILE', default=None, type=click.Path(dir_okay=False, writable=True), help='file to write a trace of the release to')
+@click.option('--trace-format', envvar='CRANE_TRACE_FORMAT', default='json', type=click.Choice(['json', 'otlp']), help='format of the trace file', show_default=True)
+@click.option('--profile-http', envvar='CRANE_PROFILE_HTTP', default=False, is_flag=True, help='print a summary of HTTP requests by endpoint at exit')
+@click.option('--profile-http-file', envvar='CRANE_PROFILE_HTTP_FILE', default=None, type=click.Path(dir_okay=False, writable=True), help='file to write the summary of HTTP requests to, as JSON')
 @click.option('--slack-token', envvar='CRANE_SLACK_TOKEN', default=None, help='Slack API token')
 @click.option('--slack-channel', envvar='CRANE_SLACK_CHANNEL', default=None, multiple=True, help='Slack channel to announce in')
 @click.option('--slack-link', envvar='CRANE_SLACK_LINK', multiple=True, type=(str, str), metavar='TITLE URL', help='links to mention in Slack')
 @click.option('--sentry-webhook', envvar='CRANE_SENTRY_WEBHOOK', default=None, help='Sentry release webhook URL', callback=strip_trailing_slash)
 @click.option('--webhook-url', envvar='CRANE_WEBHOOK_URL', default=None, multiple=True, help='URLs to POST the release status to', callback=strip_trailing_slash)
 @click.option('--webhook-token', envvar='CRANE_WEBHOOK_TOKEN', default=None, help='auth token for webhooks')
+@click.option('--statsd-host', envvar='CRANE_STATSD_HOST', default=None, help='DogStatsD address to send metrics to, as host:port')
 @click.option('--datadog-key', envvar='CRANE_DATADOG_KEY', default=None, help='key for posting release events')
+@click.option('--prometheus-textfile', envvar='CRANE_PROMETHEUS_TEXTFILE', default=None, type=click.Path(dir_okay=False, writable=True), help='.prom file to write release metrics to, for the node_exporter textfile collector')
+@click.option('--prometheus-pushgateway', envvar='CRANE_PROMETHEUS_PUSHGATEWAY', default=None, help='Pushgateway URL to push release metrics to', callback=strip_trailing_slash)
 # stop ignoring LineLengthBear
 # Ignore PyCommentedCodeBear
 # fmt: on
@@ -51,15 +89,34 @@ def main(**parsed_settings):
     click_context = click.get_current_context()
     click_context.color = True  # GitLab doesn't report terminal type correctly so we need to force it
 
+    recorder.start()
     settings.update(parsed_settings)
+    if not settings['stack'] and not settings['stack_file']:
+        raise click.UsageError('Please tell me which stacks to upgrade with --stack.')
     rancher.session.auth = settings['access_key'], settings['secret_key']
 
+    tracer.enabled = bool(settings['trace_file'])
+    try:
+        with tracer.span('main'):
+            release()
+    finally:
+        if settings['trace_file']:
+            tracer.write(settings['trace_file'], settings['trace_format'])
+        if settings['profile_http']:
+            click.echo('HTTP requests made during the release:\n' + transport.accounting.table())
+        if settings['profile_http_file']:
+            transport.accounting.write(settings['profile_http_file'])
+
+
+def release():
     try:
-        deployment.load_from_settings(settings)
+        with recorder.phase('load_from_settings'):
+            deployment.load_from_settings(settings)
     except UpgradeFailed:
         sys.exit(1)  # we handled it gracefully already
 
-    hooks.dispatch('before_upgrade')
+    flusher = outbox.flush_in_background()  # sending what earlier releases couldn't
+    hooks.dispatch('before_upgrade', wait=not settings['background_hooks'])
 
     try:
         upgrade(deployment.services)
@@ -70,3 +127,23 @@ def main(**parsed_settings):
         raise
     else:
         hooks.dispatch('after_upgrade_success')
+    finally:
+        hooks.drain()
+        flusher.join(settings['hooks_timeout'] or None)
+
+
+# Ignore PyCommentedCodeBear
+# fmt: off
+# start ignoring LineLengthBear
+@click.command()
+@click.option('--cache-dir', envvar='CRANE_CACHE_DIR', default=default_cache_dir, help='directory crane keeps data between runs in')
+@click.option('--batch-size', envvar='CRANE_OUTBOX_BATCH_SIZE', default=outbox.BATCH_SIZE, type=click.IntRange(1, None), help='deliveries to send at once', show_default=True)
+@click.option('--datadog-key', envvar='CRANE_DATADOG_KEY', default=None, help='key for posting saved release events')
+# stop ignoring LineLengthBear
+# Ignore PyCommentedCodeBear
+# fmt: on
+def flush_outbox(batch_size, **parsed_settings):
+    """Send the integration deliveries that failed during earlier releases."""
+    settings.update(parsed_settings)
+    if outbox.flush(batch_size)['kept']:
+        sys.exit(1)
@@ -1,36 +1,40 @@
-import traceback
+from . import datadog, echo, prometheus, sentry, slack, webhook
+from .. import deployment, settings
+from ..tracing import tracer
+from .dispatcher import Worker, wait_for
 
-import click
+AVAILABLE_HOOKS = [datadog, echo, prometheus, sentry, slack, webhook]
 
-from . import datadog, echo, sentry, slack, webhook
-from .. import deployment
+HOOKS = [module.Hook for module in AVAILABLE_HOOKS]
+WORKERS = []
+PENDING = []  # jobs that might still be running
 
-AVAILABLE_HOOKS = [datadog, echo, sentry, slack, webhook]
 
-HOOKS = []
+def dispatch(event, wait=True):
+    """Send the event to all hooks.
 
-
-def dispatch(event):
+    Without waiting, the event is handled in the background,
+    but still before any later events; use :func:`drain` to wait for it.
+    """
     if deployment.is_limited:
         return
 
-    if not HOOKS:
-        for module in AVAILABLE_HOOKS:
-            hook_class = getattr(module, "Hook")
-            try:
-                HOOKS.append(hook_class())
-            except:
-                click.secho(
-                    f"Oh, this is bad. I cannot load the '{module}' hook! "
-                    + "Even if you weren't planning to use it, this should never happen. "
-                    + "Please tell the maintainers about this at https://github.com/kiwicom/crane/issues/new "
-                    + "— sorry about all the trouble!"
-                    + click.style("(シ_ _)シ", bold=True),
-                    fg="red",
-                    err=True,
-                )
-                click.secho("Here's the traceback:\n", fg="red", err=True)
-                traceback.print_exc()
-
-    for hook in HOOKS:
-        hook.dispatch(event)
+    if not WORKERS:  # each worker sets up its hook, so this doesn't wait for any
+        WORKERS.extend(Worker(hook_class) for hook_class in HOOKS)
+
+    with tracer.span(event, wait=wait):
+        jobs = [worker.submit(event) for worker in WORKERS]
+        PENDING[:] = [job for job in PENDING if not job.done.is_set()] + jobs
+        if wait:
+            wait_for(jobs, settings["hook_timeout"], settings["hooks_timeout"])
+        else:
+            for job in jobs:
+                job.detach()
+
+
+def drain():
+    """Wait for the events still being handled, within their time budgets."""
+    jobs = [job for job in PENDING if not job.done.is_set()]
+    PENDING.clear()
+    if jobs:
+        wait_for(jobs, settings["hook_timeout"], settings["hooks_timeout"])
@@ -1,7 +1,12 @@
+import time
 import traceback
 
 import click
 
+from ..stats import recorder
+from ..tracing import tracer
+from .dispatcher import hook_name
+
 
 class Base:
 
@@ -21,8 +26,10 @@ class Base:
             return
 
         handler = getattr(self, event)
+        started_at = time.monotonic()
         try:
-            handler()
+            with tracer.span("hook", hook=hook_name(self), event=event):
+                handler()
         except:
             click.secho(
                 f"Uh-oh, {self.__module__} couldn't handle {event}. Here's the traceback:\n",
@@ -33,3 +40,5 @@ class Base:
             click.echo(
                 "\nOh well, on with the release! " + click.style("乁( ◔ ౪◔)ㄏ", bold=True)
             )
+        finally:
+            recorder.record_hook(hook_name(self), event, time.monotonic() - started_at)
@@ -1,18 +1,35 @@
-from functools import partial
 from os import environ
 
 import datadog
+import requests
 
 from .. import deployment, settings
+from ..stats import recorder
+from . import outbox
 from .base import Base
+from .dispatcher import hook_name
+
+STATSD_PORT = 8125
+DEFAULT_API_HOST = "https://api.datadoghq.com"
 
 
 class Hook(Base):
     def __init__(self):
-        datadog.initialize(api_key=settings["datadog_key"])
+        self.api_host = environ.get("DATADOG_HOST", DEFAULT_API_HOST)
+        if settings.get("datadog_key"):
+            datadog.initialize(api_key=settings["datadog_key"], api_host=self.api_host)
+
+    def after_upgrade_success(self):
+        self.report("success")
 
-        self.after_upgrade_success = partial(self.create_event, "success")
-        self.after_upgrade_failure = partial(self.create_event, "error")
+    def after_upgrade_failure(self):
+        self.report("error")
+
+    def report(self, alert_type):
+        if settings.get("datadog_key"):
+            self.create_event(alert_type)
+        if settings.get("statsd_host"):
+            self.send_metrics(alert_type)
 
     def create_event(self, alert_type):
         prefix = ""
@@ -23,9 +40,15 @@ class Hook(Base):
         elif deployment.is_rollback:
             prefix = "Rollback:\n"
 
-        datadog.api.Event.create(
+        summaries = [commit.summary for commit in deployment.commits]
+        if deployment.hidden_commits:
+            summaries.append(
+                f"+{deployment.hidden_commits} more of {deployment.total_commits} commits"
+            )
+
+        event = dict(
             title="{0} deployment".format(environ["CI_PROJECT_PATH"]),
-            text=prefix + "\n".join(commit.summary for commit in deployment.commits),
+            text=prefix + "\n".join(summaries),
             tags=[
                 "releaser:{0}".format(environ["GITLAB_USER_EMAIL"]),
                 "project:{0}".format(environ["CI_PROJECT_PATH"]),
@@ -33,7 +56,61 @@ class Hook(Base):
             ],
             alert_type=alert_type,
         )
+        try:
+            result = datadog.api.Event.create(**event)
+        except datadog.api.exceptions.DatadogException:
+            result = {"errors": "unreachable"}
+
+        if "errors" in result:  # the client doesn't raise these by default
+            outbox.spool(
+                hook_name(self),
+                requests.Request("POST", f"{self.api_host}/api/v1/events", json=event),
+                credentials={"DD-API-KEY": "datadog_key"},
+            )
+
+    def send_metrics(self, status):
+        """Send timings of the release to DogStatsD, in as few UDP packets as we can."""
+        host, _, port = settings["statsd_host"].partition(":")
+        statsd = datadog.DogStatsd(
+            host=host,
+            port=int(port or STATSD_PORT),
+            constant_tags=[
+                "project:{0}".format(environ["CI_PROJECT_PATH"]),
+                "environment:{0}".format(environ["CI_ENVIRONMENT_NAME"]),
+            ],
+        )
+        stacks = [f"stack:{stack.name}" for stack in deployment.stacks]
+
+        statsd.open_buffer()
+        try:
+            statsd.increment("crane.deploy", tags=[f"status:{status}", *stacks])
+            if recorder.elapsed is not None:
+                statsd.timing(
+                    "crane.deploy.duration",
+                    recorder.elapsed * 1000,
+                    tags=[f"status:{status}", *stacks],
+                )
+            for phase, seconds in recorder.phases.items():
+                statsd.timing(f"crane.upgrade.{phase}", seconds * 1000, tags=stacks)
+            for service, seconds in recorder.services.items():
+                statsd.timing(
+                    "crane.service.upgrade_duration",
+                    seconds * 1000,
+                    tags=[f"stack:{service.stack.name}", f"service:{service.name}"],
+                )
+            for name, event, seconds in list(recorder.hooks):
+                statsd.timing(
+                    "crane.hook.duration",
+                    seconds * 1000,
+                    tags=[f"hook:{name}", f"event:{event}"],
+                )
+            statsd.increment(
+                "crane.rancher.requests", recorder.counts["rancher_requests"]
+            )
+        finally:
+            statsd.close_buffer()  # UDP, so this never waits for the agent
+            statsd.close_socket()
 
     @property
     def is_active(self):
-        return bool(settings.get("datadog_key"))
+        return bool(settings.get("datadog_key") or settings.get("statsd_host"))
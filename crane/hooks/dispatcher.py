@@ -0,0 +1,198 @@
+"""Run hooks side by side, each of them in its own thread.
+
+Every hook gets a worker thread that handles its events in order,
+and that sets up the hook as part of its first event, so that the time budgets cover it.
+The output of an event is collected while the hook runs, and printed in one piece,
+so that hooks running at the same time don't garble each other's messages.
+"""
+
+import contextvars
+import queue
+import sys
+import threading
+import time
+import traceback
+
+import attr
+import click
+
+_local = threading.local()
+_capture_lock = threading.Lock()
+_capture_count = 0
+_print_lock = threading.Lock()
+
+
+class OutputRouter:
+    """Stand-in for sys.stdout or sys.stderr that collects what hooks print."""
+
+    def __init__(self, stream, name):
+        self.stream = stream
+        self.name = name
+
+    def write(self, text):
+        chunks = getattr(_local, "chunks", None)
+        if chunks is None:
+            return self.stream.write(text)
+        if not isinstance(text, str):  # click probes streams with bytes
+            raise TypeError(f"write() argument must be str, not {type(text).__name__}")
+        chunks.append((self.name, text))
+        return len(text)
+
+    def flush(self):
+        if getattr(_local, "chunks", None) is None:
+            self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+def original_stream(name):
+    stream = getattr(sys, name)
+    return stream.stream if isinstance(stream, OutputRouter) else stream
+
+
+def start_capture():
+    global _capture_count
+    with _capture_lock:
+        for name in ("stdout", "stderr"):
+            if not isinstance(getattr(sys, name), OutputRouter):
+                setattr(sys, name, OutputRouter(getattr(sys, name), name))
+        _capture_count += 1
+
+
+def stop_capture():
+    global _capture_count
+    with _capture_lock:
+        _capture_count -= 1
+        if not _capture_count:
+            sys.stdout = original_stream("stdout")
+            sys.stderr = original_stream("stderr")
+
+
+@attr.s(slots=True)
+class Job:
+
+    name = attr.ib()  # of the hook
+    event = attr.ib()
+    submitted_at = attr.ib(factory=time.monotonic)
+    started_at = attr.ib(default=None)
+    finished_at = attr.ib(default=None)
+    output = attr.ib(factory=list)
+    done = attr.ib(factory=threading.Event)
+    detached = attr.ib(default=False)
+    lock = attr.ib(factory=threading.Lock)
+    context = attr.ib(factory=contextvars.copy_context)  # of the dispatch, for tracing
+
+    @property
+    def duration(self):
+        if self.finished_at is None:
+            return None
+        return self.finished_at - self.started_at
+
+    def finish(self):
+        with self.lock:
+            self.finished_at = time.monotonic()
+            self.done.set()
+            if self.detached:  # nobody is waiting to print it, so let's do it now
+                self.print_output()
+        stop_capture()
+
+    def detach(self):
+        """Leave the job running, and print its output whenever it's done."""
+        with self.lock:
+            if self.done.is_set():
+                self.print_output()
+            else:
+                self.detached = True
+
+    def print_output(self):
+        with _print_lock:
+            for stream_name, text in self.output:
+                original_stream(stream_name).write(text)
+            for stream_name in ("stdout", "stderr"):
+                original_stream(stream_name).flush()
+        self.output.clear()
+
+
+class Worker:
+    """A thread that sets up a hook, then runs its events one after the other."""
+
+    def __init__(self, hook_class):
+        self.hook_class = hook_class
+        self.hook = None
+        self.failed = False
+        self.jobs = queue.Queue()
+        self.thread = threading.Thread(
+            target=self.run, name=f"crane-{hook_name(hook_class)}", daemon=True
+        )
+        self.thread.start()
+
+    def submit(self, event):
+        job = Job(hook_name(self.hook_class), event)
+        start_capture()
+        self.jobs.put(job)
+        return job
+
+    def load(self):
+        try:
+            self.hook = self.hook_class()
+        except:
+            self.failed = True
+            click.secho(
+                f"Oh, this is bad. I cannot load the '{self.hook_class.__module__}' hook! "
+                + "Even if you weren't planning to use it, this should never happen. "
+                + "Please tell the maintainers about this at https://github.com/kiwicom/crane/issues/new "
+                + "— sorry about all the trouble!"
+                + click.style("(シ_ _)シ", bold=True),
+                fg="red",
+                err=True,
+            )
+            click.secho("Here's the traceback:\n", fg="red", err=True)
+            traceback.print_exc()
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            _local.chunks = job.output
+            job.started_at = time.monotonic()
+            try:
+                if self.hook is None and not self.failed:
+                    job.context.run(self.load)
+                if not self.failed:
+                    job.context.run(self.hook.dispatch, job.event)
+            finally:
+                _local.chunks = None
+                job.finish()
+
+
+def hook_name(hook):
+    return hook.__module__.rsplit(".", 1)[-1]
+
+
+def wait_for(jobs, hook_timeout=0, total_timeout=0):
+    """Wait for the jobs within their time budgets, printing their output in order.
+
+    Returns the jobs that ran out of time; these carry on in the background.
+    """
+    deadline = time.monotonic() + total_timeout if total_timeout else None
+    timed_out = []
+    for job in jobs:
+        budgets = [deadline] if deadline else []
+        if hook_timeout:
+            budgets.append(job.submitted_at + hook_timeout)
+        timeout = max(min(budgets) - time.monotonic(), 0) if budgets else None
+
+        if not job.done.wait(timeout):
+            timed_out.append(job)
+        job.detach()
+
+    if timed_out:
+        click.secho(
+            "These hooks are taking too long, so I'm moving on without them: "
+            + ", ".join(f"{job.name} ({job.event})" for job in timed_out)
+            + " "
+            + click.style("(￣ヘ￣;)", bold=True),
+            fg="yellow",
+            err=True,
+        )
+    return timed_out
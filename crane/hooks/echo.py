@@ -26,6 +26,11 @@ class Hook(Base):
             for commit in deployment.commits
             if len(commit.parents) == 1  # skip Merge commit
         )
+        if deployment.hidden_commits:
+            commits_text += (
+                f"\n  …and {deployment.hidden_commits} more "
+                f"of {deployment.total_commits} commits"
+            )
 
         return f"{prefix}\n{commits_text}"
 
@@ -0,0 +1,287 @@
+"""Deliveries that failed, saved in the cache directory to be sent again later.
+
+Each file in the outbox is one HTTP request, serialized as JSON.
+Files are only readable by their owner, as the requests may carry credentials.
+Where a hook can, it leaves its credentials out, and names the settings
+to add them back from when the request is sent again.
+Only a run with the same values in those settings sends it,
+as the cache directory may be shared by crane runs of other projects.
+A request may also have a key: a newer delivery with the same key,
+such as a later status of the same release, replaces the saved one.
+"""
+
+import base64
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+
+import click
+import requests
+
+from .. import settings, transport
+from ..store import replace_file
+
+BATCH_SIZE = 10
+MAX_ATTEMPTS = 5
+MAX_AGE = 7 * 24 * 60 * 60  # seconds until a delivery is no longer worth sending
+CLAIM_TIMEOUT = 10 * 60  # seconds until deliveries claimed by a crashed run are free
+
+session = requests.Session()
+_adapter = transport.Adapter(pool_connections=BATCH_SIZE, pool_maxsize=BATCH_SIZE)
+session.mount("http://", _adapter)
+session.mount("https://", _adapter)
+
+
+def is_permanent(response):
+    """Client errors won't go away by trying again, except for rate limiting."""
+    if response is None:
+        return False
+    return 400 <= response.status_code < 500 and response.status_code != 429
+
+
+def fingerprint(value):
+    """Identifies a credential without saving it."""
+    if not value:
+        return None
+    return hashlib.sha256(value.encode()).hexdigest()[:16]
+
+
+def directory():
+    cache_dir = settings.get("cache_dir")
+    if not cache_dir:
+        return None
+    return os.path.join(os.path.expanduser(cache_dir), "outbox")
+
+
+def write(path, entry):
+    replace_file(path, json.dumps(entry), mode=0o600)
+
+
+def read(path):
+    with open(path) as entry_file:
+        return json.load(entry_file)
+
+
+def supersede(key):
+    """Drop the saved deliveries with this key, as there's a newer one now."""
+    outbox_dir = directory()
+    if outbox_dir is None:
+        return
+    try:
+        filenames = sorted(os.listdir(outbox_dir))
+    except FileNotFoundError:
+        return
+
+    for filename in filenames:
+        if not filename.endswith(".json"):
+            continue  # deliveries being sent right now are out of our hands
+        path = os.path.join(outbox_dir, filename)
+        try:
+            if read(path).get("key") == key:
+                os.remove(path)
+        except (OSError, ValueError):  # sent, or being written, in the meantime
+            continue
+
+
+def spool(hook_name, request, key=None, credentials=None, max_age=MAX_AGE):
+    """Save a request that couldn't be delivered. Returns whether it was saved.
+
+    The credentials map header names to the settings that hold their values,
+    which are left out of the file and added back when the request is sent again.
+    """
+    outbox_dir = directory()
+    if outbox_dir is None:
+        return False
+    if key is not None:
+        supersede(key)
+
+    prepared = request.prepare()
+    body = prepared.body or b""
+    if isinstance(body, str):
+        body = body.encode()
+    entry = {
+        "hook": hook_name,
+        "method": prepared.method,
+        "url": prepared.url,
+        "headers": dict(prepared.headers),
+        "body": base64.b64encode(body).decode(),
+        "credentials": {
+            header: {
+                "setting": setting,
+                "fingerprint": fingerprint(settings.get(setting)),
+            }
+            for header, setting in (credentials or {}).items()
+        },
+        "key": key,
+        "created_at": time.time(),
+        "expires_at": time.time() + max_age,
+        "attempts": 0,
+    }
+
+    try:
+        os.makedirs(outbox_dir, mode=0o700, exist_ok=True)
+        write(
+            os.path.join(outbox_dir, f"{time.time():.6f}-{uuid.uuid4().hex}.json"),
+            entry,
+        )
+    except OSError as ex:
+        click.secho(
+            f"I couldn't save the {hook_name} delivery for later either: {ex}",
+            fg="yellow",
+            err=True,
+        )
+        return False
+
+    click.secho(
+        f"I couldn't reach {hook_name}, so I saved the delivery in {outbox_dir} "
+        "to send it again on the next run.",
+        fg="yellow",
+        err=True,
+    )
+    return True
+
+
+def unclaimed_path(path):
+    if path.endswith(".claimed"):
+        return path.rsplit(".json.", 1)[0] + ".json"
+    return path
+
+
+def claim_pending(outbox_dir, limit):
+    """Take deliveries oldest first, renaming them so that other crane runs skip them."""
+    try:
+        filenames = sorted(os.listdir(outbox_dir))
+    except FileNotFoundError:
+        return []
+
+    claimed = []
+    for filename in filenames:
+        path = os.path.join(outbox_dir, filename)
+        if filename.endswith(".claimed"):
+            try:
+                if time.time() - os.stat(path).st_mtime < CLAIM_TIMEOUT:
+                    continue
+            except FileNotFoundError:
+                continue
+        elif not filename.endswith(".json"):
+            continue
+
+        claimed_path = f"{unclaimed_path(path)}.{os.getpid()}.claimed"
+        try:
+            os.replace(path, claimed_path)
+            os.utime(claimed_path)
+        except FileNotFoundError:  # another run got it first
+            continue
+        claimed.append(claimed_path)
+        if len(claimed) == limit:
+            break
+    return claimed
+
+
+def replay(claimed_path):
+    """Send a delivery again. Returns whether it was sent, dropped, kept for later,
+    or skipped, as it's not for this run's credentials.
+    """
+    entry = read(claimed_path)
+    expires_at = entry.get("expires_at", entry["created_at"] + MAX_AGE)
+    if time.time() > expires_at:
+        click.secho(
+            f"I dropped a saved {entry['hook']} delivery, as it's out of date by now.",
+            fg="yellow",
+            err=True,
+        )
+        os.remove(claimed_path)
+        return "dropped"
+
+    credentials = {
+        header: settings.get(credential["setting"])
+        for header, credential in entry["credentials"].items()
+    }
+    if any(
+        fingerprint(credentials[header]) != credential["fingerprint"]
+        for header, credential in entry["credentials"].items()
+    ):
+        return "skipped"  # it's up to a run with the credentials it was made with
+
+    try:
+        response = session.request(
+            entry["method"],
+            entry["url"],
+            headers={**entry["headers"], **credentials},
+            data=base64.b64decode(entry["body"]),
+            timeout=transport.TIMEOUT,
+        )
+    except requests.RequestException:
+        response = None
+
+    if response is not None and response.ok:
+        os.remove(claimed_path)
+        return "sent"
+
+    entry["attempts"] += 1
+    if (
+        is_permanent(response)
+        or entry["attempts"] >= MAX_ATTEMPTS
+        or time.time() > expires_at
+    ):
+        click.secho(
+            f"I gave up on sending a saved {entry['hook']} delivery "
+            f"after {entry['attempts']} attempts.",
+            fg="yellow",
+            err=True,
+        )
+        os.remove(claimed_path)
+        return "dropped"
+
+    write(unclaimed_path(claimed_path), entry)
+    os.remove(claimed_path)
+    return "kept"
+
+
+def flush(batch_size=BATCH_SIZE):
+    """Send everything in the outbox, a batch at a time.
+
+    Returns how many deliveries were sent, dropped, and kept for later.
+    """
+    results = Counter(sent=0, dropped=0, kept=0)
+    outbox_dir = directory()
+    if outbox_dir is None:
+        return results
+
+    skipped = []  # held on to until the end, so that we don't claim them again
+    try:
+        with ThreadPoolExecutor(batch_size, thread_name_prefix="crane-outbox") as pool:
+            while not results["kept"]:  # if something is still down, don't hammer it
+                batch = claim_pending(outbox_dir, batch_size)
+                if not batch:
+                    break
+                for path, result in zip(batch, pool.map(replay, batch)):
+                    if result == "skipped":
+                        skipped.append(path)
+                    else:
+                        results[result] += 1
+    finally:
+        for path in skipped:
+            os.replace(path, unclaimed_path(path))
+
+    if results["sent"] or results["kept"]:
+        click.echo(
+            f"I sent {results['sent']} saved deliveries from the outbox"
+            + (
+                f", and {results['kept']} will have to wait until next time."
+                if results["kept"]
+                else "."
+            )
+        )
+    return results
+
+
+def flush_in_background():
+    thread = threading.Thread(target=flush, name="crane-outbox", daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,255 @@
+"""Release metrics in the Prometheus text format.
+
+The metrics go to a file that node_exporter's textfile collector picks up,
+or to a Pushgateway, or both.
+The file keeps counting across releases: counters and histograms are added to
+what's already in the file, so the collector sees them grow like any other counter.
+The Pushgateway only keeps what it got last for each project and environment,
+so there the counters only cover the latest release.
+"""
+
+import base64
+import fcntl
+from functools import partial
+import math
+import os
+from os import environ
+import re
+import time
+
+import attr
+import click
+import requests
+
+from .. import deployment, settings, transport
+from ..stats import recorder
+from ..store import replace_file
+from .base import Base
+
+BUCKETS = (30, 60, 120, 300, 600, 1200, 1800, 3600, math.inf)  # seconds
+SAMPLE_PATTERN = re.compile(r"^([a-zA-Z_:][a-zA-Z0-9_:]*)(\{.*\})?\s+(\S+)$")
+HISTOGRAM_SUFFIXES = ("bucket", "sum", "count")
+
+session = requests.Session()
+_adapter = transport.Adapter(pool_connections=1, pool_maxsize=1, max_retries=3)
+session.mount("http://", _adapter)
+session.mount("https://", _adapter)
+
+
+@attr.s(frozen=True, slots=True)
+class Family:
+
+    name = attr.ib()
+    type = attr.ib()
+    help = attr.ib()
+
+    @property
+    def is_cumulative(self):
+        return self.type in ("counter", "histogram")
+
+    def owns(self, sample_name):
+        if self.type == "histogram":
+            return sample_name in {
+                f"{self.name}_{suffix}" for suffix in HISTOGRAM_SUFFIXES
+            }
+        return sample_name == self.name
+
+
+DEPLOY_DURATION = Family(
+    "crane_deploy_duration_seconds", "histogram", "How long releases took."
+)
+DEPLOYS = Family("crane_deploys_total", "counter", "Releases, by how they ended.")
+LAST_DEPLOY = Family(
+    "crane_last_deploy_timestamp_seconds", "gauge", "When the latest release ended."
+)
+SERVICE_UPGRADE = Family(
+    "crane_service_upgrade_seconds",
+    "gauge",
+    "How long each service took to upgrade in the latest release.",
+)
+PHASE = Family(
+    "crane_upgrade_phase_seconds",
+    "gauge",
+    "How long each phase of the latest release took.",
+)
+RANCHER_REQUESTS = Family(
+    "crane_rancher_requests_total", "counter", "Requests made to the Rancher API."
+)
+HOOK_DURATION = Family(
+    "crane_hook_duration_seconds",
+    "gauge",
+    "How long each integration took per event in the latest release.",
+)
+FAMILIES = [
+    DEPLOY_DURATION,
+    DEPLOYS,
+    LAST_DEPLOY,
+    SERVICE_UPGRADE,
+    PHASE,
+    RANCHER_REQUESTS,
+    HOOK_DURATION,
+]
+
+
+def escape(value):
+    return str(value).replace("\\", r"\\").replace('"', r"\"").replace("\n", r"\n")
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{escape(value)}"' for key, value in labels) + "}"
+
+
+def format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+@attr.s(slots=True)
+class Metrics:
+    """Samples by family, each keyed by its name and its formatted labels."""
+
+    samples = attr.ib(factory=dict)
+
+    def add(self, family, labels, value, suffix=None):
+        name = f"{family.name}_{suffix}" if suffix else family.name
+        key = (name, format_labels(labels))
+        self.samples.setdefault(family, {})
+        self.samples[family][key] = self.samples[family].get(key, 0) + value
+
+    def observe(self, family, labels, value):
+        """Add an observation to a histogram."""
+        for bound in BUCKETS:
+            le = [("le", format_value(bound))]
+            self.add(family, [*labels, *le], int(value <= bound), "bucket")
+        self.add(family, labels, value, "sum")
+        self.add(family, labels, 1, "count")
+
+    def merge(self, previous):
+        """Carry over what an earlier release left, adding up counters and histograms."""
+        for family, samples in previous.samples.items():
+            current = self.samples.setdefault(family, {})
+            for key, value in samples.items():
+                if key not in current:
+                    current[key] = value
+                elif family.is_cumulative:
+                    current[key] += value
+
+    def render(self):
+        lines = []
+        for family in FAMILIES:
+            samples = self.samples.get(family)
+            if not samples:
+                continue
+            lines.append(f"# HELP {family.name} {family.help}")
+            lines.append(f"# TYPE {family.name} {family.type}")
+            lines.extend(
+                f"{name}{labels} {format_value(value)}"
+                for (name, labels), value in samples.items()
+            )
+        return "".join(f"{line}\n" for line in lines)
+
+    @classmethod
+    def parse(cls, text):
+        """Read the samples of known families from a text written by :meth:`render`."""
+        metrics = cls()
+        for line in text.splitlines():
+            match = SAMPLE_PATTERN.match(line)
+            if not match:
+                continue
+            name, labels, value = match.groups()
+            family = next((family for family in FAMILIES if family.owns(name)), None)
+            if family is None:
+                continue
+            metrics.samples.setdefault(family, {})[(name, labels or "")] = float(value)
+        return metrics
+
+
+def collect(status):
+    """The metrics of the release so far, which ended with the given status."""
+    metrics = Metrics()
+    common = [
+        ("project", environ["CI_PROJECT_PATH"]),
+        ("environment", environ["CI_ENVIRONMENT_NAME"]),
+    ]
+    for stack in deployment.stacks:
+        labels = [*common, ("stack", stack.name)]
+        if recorder.elapsed is not None:
+            metrics.observe(
+                DEPLOY_DURATION, [*labels, ("status", status)], recorder.elapsed
+            )
+        metrics.add(DEPLOYS, [*labels, ("status", status)], 1)
+        metrics.add(LAST_DEPLOY, labels, time.time())
+    for service, seconds in recorder.services.items():
+        labels = [*common, ("stack", service.stack.name), ("service", service.name)]
+        metrics.add(SERVICE_UPGRADE, labels, seconds)
+    for phase, seconds in recorder.phases.items():
+        metrics.add(PHASE, [*common, ("phase", phase)], seconds)
+    metrics.add(RANCHER_REQUESTS, common, recorder.counts["rancher_requests"])
+    for name, event, seconds in list(recorder.hooks):
+        metrics.add(HOOK_DURATION, [*common, ("hook", name), ("event", event)], seconds)
+    return metrics
+
+
+def grouping_path():
+    """The Pushgateway's grouping key, with values that may contain slashes."""
+    parts = ["job", "crane"]
+    for label, variable in [
+        ("project", "CI_PROJECT_PATH"),
+        ("environment", "CI_ENVIRONMENT_NAME"),
+    ]:
+        value = base64.urlsafe_b64encode(environ[variable].encode()).decode()
+        parts += [f"{label}@base64", value]
+    return "/".join(parts)
+
+
+class Hook(Base):
+    def __init__(self):
+        self.textfile = settings.get("prometheus_textfile")
+        self.pushgateway = settings.get("prometheus_pushgateway")
+
+        self.after_upgrade_success = partial(self.export, "success")
+        self.after_upgrade_failure = partial(self.export, "failure")
+
+    def export(self, status):
+        metrics = collect(status)
+        try:
+            if self.pushgateway:
+                self.push(metrics)
+        finally:  # the textfile doesn't depend on the Pushgateway being up
+            if self.textfile:
+                self.write(metrics)
+
+    def push(self, metrics):
+        response = session.put(
+            f"{self.pushgateway}/metrics/{grouping_path()}",
+            data=metrics.render().encode(),
+            headers={"Content-Type": "text/plain; version=0.0.4"},
+            timeout=transport.TIMEOUT,
+        )
+        response.raise_for_status()
+
+    def write(self, metrics):
+        """Add the metrics to the file, holding a lock so other crane runs wait their turn."""
+        path = os.path.expanduser(self.textfile)
+        with open(f"{path}.lock", "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)  # released when the file is closed
+            try:
+                with open(path) as textfile:
+                    metrics.merge(Metrics.parse(textfile.read()))
+            except FileNotFoundError:
+                pass
+
+            replace_file(path, metrics.render())
+        click.echo(f"I wrote the release metrics for Prometheus to {path}.")
+
+    @property
+    def is_active(self):
+        return bool(
+            settings.get("prometheus_textfile")
+            or settings.get("prometheus_pushgateway")
+        )
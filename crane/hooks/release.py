@@ -0,0 +1,50 @@
+"""JSON bodies describing the release, encoded once and shared by the hooks that post them.
+
+The commit list is the bulk of every payload, so it's serialized only once per run,
+and spliced into the body of each request.
+These bodies are for other programs, so they list up to ``--max-payload-commits`` commits,
+which is usually more than the announcements show.
+"""
+
+from datetime import datetime
+import json
+import threading
+
+from .. import deployment
+
+_lock = threading.Lock()
+_encoded_commits = (None, b"[]")  # the changes they were encoded from, and the bytes
+
+
+def commit_data(commit):
+    return {
+        "id": commit.hexsha,
+        "message": commit.message,
+        "author_name": commit.author_name,
+        "author_email": commit.author_email,
+        "timestamp": str(
+            datetime.fromtimestamp(commit.committed_date + commit.committer_tz_offset)
+        ),
+    }
+
+
+def encoded_commits():
+    global _encoded_commits
+    with _lock:
+        changes, encoded = _encoded_commits
+        if changes is not deployment.changes:
+            changes = deployment.changes
+            encoded = json.dumps(
+                [commit_data(commit) for commit in deployment.payload_commits]
+            )
+            _encoded_commits = changes, encoded.encode()
+        return _encoded_commits[1]
+
+
+def body(fields, with_commits=True):
+    """Encode the fields as a JSON object, along with the commits unless told otherwise."""
+    commits = encoded_commits() if with_commits else b"[]"
+    separator = b", " if fields else b""
+    return (
+        json.dumps(fields).encode()[:-1] + separator + b'"commits": ' + commits + b"}"
+    )
@@ -1,15 +1,14 @@
-from datetime import datetime
 from os import environ
 
 import requests
 
-from .. import deployment, settings
+from .. import deployment, settings, transport
+from . import outbox, release
 from .base import Base
+from .dispatcher import hook_name
 
 session = requests.Session()
-_adapter = requests.adapters.HTTPAdapter(
-    pool_connections=5, pool_maxsize=5, max_retries=3
-)
+_adapter = transport.Adapter(pool_connections=5, pool_maxsize=5, max_retries=3)
 session.mount("http://", _adapter)
 session.mount("https://", _adapter)
 
@@ -19,28 +18,27 @@ class Hook(Base):
         self.webhook = settings["sentry_webhook"]
 
     def after_upgrade_success(self):
-        session.post(
+        request = requests.Request(
+            "POST",
             f"{self.webhook}/",
-            json={
-                "version": deployment.new_version,
-                "url": f'{environ["CI_PROJECT_URL"]}/builds/{environ["CI_JOB_ID"]}',
-                "commits": [
-                    {
-                        "id": commit.hexsha,
-                        "message": commit.message,
-                        "author_name": commit.author.name,
-                        "author_email": commit.author.email,
-                        "timestamp": str(
-                            datetime.fromtimestamp(
-                                commit.committed_date + commit.committer_tz_offset
-                            )
-                        ),
-                    }
-                    for commit in deployment.commits
-                    if not deployment.is_rollback
-                ],
-            },
+            data=release.body(
+                {
+                    "version": deployment.new_version,
+                    "url": f'{environ["CI_PROJECT_URL"]}/builds/{environ["CI_JOB_ID"]}',
+                },
+                with_commits=not deployment.is_rollback,
+            ),
+            headers={"Content-Type": "application/json"},
         )
+        try:
+            session.send(
+                session.prepare_request(request), timeout=transport.TIMEOUT
+            ).raise_for_status()
+        except requests.RequestException as ex:
+            if outbox.is_permanent(ex.response) or not outbox.spool(
+                hook_name(self), request
+            ):
+                raise
 
     @property
     def is_active(self):
@@ -1,22 +1,246 @@
 from collections import UserList
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+from itertools import islice
 import json
 from os import environ
+import threading
+import time
 
+import attr
 import backoff
 import click
 import requests
 
-from .. import deployment, settings
+from .. import deployment, settings, transport
+from ..store import JsonStore
 from .base import Base
 
+DIRECTORY_TTL = 24 * 60 * 60  # seconds to trust the cached users and channels for
+PAGE_SIZE = 200
+MESSAGE_SEARCH_WINDOW = 7 * 24 * 60 * 60  # seconds of channel history to look through
+MESSAGE_SEARCH_LIMIT = 5 * PAGE_SIZE  # messages to look through at most
+MAX_CONCURRENCY = 5
+MAX_TRIES = 3  # when Slack tells us to slow down
+
+# calls per minute, from https://api.slack.com/docs/rate-limits
+# chat methods are limited per channel
+METHOD_RATES = {
+    "chat.postMessage": 60,
+    "chat.update": 50,
+    "conversations.history": 50,
+    "conversations.list": 20,
+    "users.list": 20,
+    "users.lookupByEmail": 50,
+}
+DEFAULT_RATE = 20
+
 session = requests.Session()
-_adapter = requests.adapters.HTTPAdapter(
-    pool_connections=5, pool_maxsize=5, max_retries=3
+_adapter = transport.Adapter(
+    pool_connections=MAX_CONCURRENCY, pool_maxsize=MAX_CONCURRENCY, max_retries=3
 )
 session.mount("http://", _adapter)
 session.mount("https://", _adapter)
 
 
+@attr.s(slots=True)
+class RateLimiter:
+    """Spaces out calls to keep to a number of calls per minute, allowing short bursts."""
+
+    per_minute = attr.ib()
+    tokens = attr.ib(default=None)
+    updated_at = attr.ib(default=None)
+    lock = attr.ib(factory=threading.Lock)
+
+    @property
+    def burst(self):
+        return max(self.per_minute // 4, 1)
+
+    def wait(self):
+        with self.lock:
+            self.refill()
+            self.tokens -= 1
+            delay = -self.tokens * 60 / self.per_minute
+        if delay > 0:
+            time.sleep(delay)
+
+    def pause(self, seconds):
+        """Hold off all calls for a while, such as when Slack tells us to."""
+        with self.lock:
+            self.refill()
+            self.tokens = min(self.tokens, 0) - seconds * self.per_minute / 60
+
+    def refill(self):
+        now = time.monotonic()
+        if self.tokens is None:
+            self.tokens = self.burst
+        else:
+            elapsed = now - self.updated_at
+            self.tokens = min(self.tokens + elapsed * self.per_minute / 60, self.burst)
+        self.updated_at = now
+
+
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+
+def rate_limiter(method, channel=None):
+    key = (method, channel if method.startswith("chat.") else None)
+    with _rate_limiters_lock:
+        if key not in _rate_limiters:
+            _rate_limiters[key] = RateLimiter(METHOD_RATES.get(method, DEFAULT_RATE))
+        return _rate_limiters[key]
+
+
+def api_call(method, params=None, data=None):
+    """Call a Slack API method, with a POST if there's data, keeping to its rate limit."""
+    url = f"https://slack.com/api/{method}"
+    limiter = rate_limiter(method, (data or params or {}).get("channel"))
+    for attempt in range(1, MAX_TRIES + 1):
+        limiter.wait()
+        if data is None:
+            response = session.get(url, params=params, timeout=transport.TIMEOUT)
+        else:
+            response = session.post(url, data=data, timeout=transport.TIMEOUT)
+        if response.status_code != 429 or attempt == MAX_TRIES:
+            break
+        limiter.pause(float(response.headers.get("Retry-After", 1)))
+        transport.accounting.record_retry(url)
+    response.raise_for_status()
+    return response
+
+
+def api_get(method, token, **params):
+    return api_call(method, params={"token": token, **params}).json()
+
+
+def pages(method, key, token, cursor=None, **params):
+    """Go through the pages of a Slack API listing, each with the cursor of the next."""
+    while True:
+        data = api_get(method, token, limit=PAGE_SIZE, cursor=cursor, **params)
+        cursor = data.get("response_metadata", {}).get("next_cursor")
+        yield data[key], cursor
+        if not cursor:
+            return
+
+
+def paginate(method, key, token, **params):
+    """Go through all items of a Slack API listing, following its cursors."""
+    for items, _ in pages(method, key, token, **params):
+        yield from items
+
+
+@attr.s(slots=True)
+class Directory:
+    """The IDs of users and channels in a Slack workspace, cached between runs."""
+
+    token = attr.ib(repr=False)
+    users = attr.ib(factory=dict)  # user ID by email
+    channels = attr.ib(factory=dict)  # channel ID by name
+    fetched_at = attr.ib(default=None)  # when all users were last downloaded
+    # users of the download in progress, and the cursor of its next page
+    pending = attr.ib(factory=dict, repr=False)
+    cursor = attr.ib(default=None)
+    store = attr.ib(default=None, repr=False)
+    _lock = attr.ib(factory=threading.Lock, repr=False)
+
+    @classmethod
+    def load(cls, token):
+        store = JsonStore.in_cache_dir("slack-directory.json", mode=0o600)
+        directory = cls(token, store=store)
+        if store is not None:
+            cached = store.get(directory.key, {})
+            directory.users = cached.get("users", {})
+            directory.channels = cached.get("channels", {})
+            directory.fetched_at = cached.get("fetched_at")
+            directory.pending = cached.get("pending", {})
+            directory.cursor = cached.get("cursor")
+        return directory
+
+    @property
+    def key(self):
+        """Identifies the workspace without saving the token itself."""
+        return hashlib.sha256(self.token.encode()).hexdigest()[:16]
+
+    @property
+    def is_fresh(self):
+        return (
+            self.fetched_at is not None
+            and time.time() - self.fetched_at < DIRECTORY_TTL
+        )
+
+    def save(self):
+        if self.store is None:
+            return
+        with self._lock:
+            self.store[self.key] = {
+                "users": self.users,
+                "channels": self.channels,
+                "fetched_at": self.fetched_at,
+                "pending": self.pending,
+                "cursor": self.cursor,
+            }
+
+    def load_channels(self):
+        self.channels = {
+            channel["name"]: channel["id"]
+            for channel in paginate(
+                "conversations.list", "channels", self.token, exclude_archived="true"
+            )
+        }
+        self.save()
+
+    def look_up_user(self, email):
+        data = api_get("users.lookupByEmail", self.token, email=email)
+        return data["user"]["id"] if data.get("ok") else None
+
+    def look_up_users(self, emails):
+        """Find just these users, for when there's no full list of users at hand."""
+        workers = max(min(len(emails), MAX_CONCURRENCY), 1)
+        with ThreadPoolExecutor(workers, thread_name_prefix="crane-slack") as pool:
+            user_ids = list(pool.map(self.look_up_user, emails))
+        self.users.update(
+            (email, user_id) for email, user_id in zip(emails, user_ids) if user_id
+        )
+        self.save()
+
+    def refresh(self):
+        """Download all users, saving the progress after each page.
+
+        The download runs while crane has other things to do, and a large workspace
+        may take longer than that, so the next run picks it up where this one stopped.
+        """
+        if self.cursor is None:
+            self.pending = {}
+        try:
+            for members, self.cursor in pages(
+                "users.list", "members", self.token, cursor=self.cursor
+            ):
+                self.pending.update(
+                    (user["profile"]["email"], user["id"])
+                    for user in members
+                    if user["profile"].get("email")
+                )
+                self.users = {**self.users, **self.pending}
+                self.save()
+        except KeyError:  # Slack didn't list them, such as for an expired cursor
+            self.pending, self.cursor = {}, None
+            self.save()
+            raise
+
+        self.load_channels()
+        self.users, self.pending = self.pending, {}
+        self.fetched_at = time.time()
+        self.save()
+
+    def refresh_in_background(self):
+        thread = threading.Thread(
+            target=self.refresh, name="crane-slack-directory", daemon=True
+        )
+        thread.start()
+        return thread
+
+
 class AttachmentFields(UserList):
     """List subclass for working with Slack message attachment like dicts.
 
@@ -39,20 +263,22 @@ class AttachmentFields(UserList):
         ]
     """
 
+    def __init__(self, initlist=None):
+        super().__init__(initlist)
+        self.by_title = {field["title"]: field for field in self.data}
+
     def __getitem__(self, item):
-        for field in self.data:
-            if field["title"] == item:
-                return field["value"]
-        else:
-            raise KeyError(f"'{item}' is not one of the fields")
+        try:
+            return self.by_title[item]["value"]
+        except KeyError:
+            raise KeyError(f"'{item}' is not one of the fields") from None
 
     def __setitem__(self, item, value):
-        for field in self.data:
-            if field["title"] == item:
-                field["value"] = value
-                return
+        if item in self.by_title:
+            self.by_title[item]["value"] = value
         else:
-            self.data.append({"title": item, "value": value, "short": True})
+            self.by_title[item] = {"title": item, "value": value, "short": True}
+            self.data.append(self.by_title[item])
 
     @classmethod
     def aslist(cls, obj):
@@ -61,6 +287,76 @@ class AttachmentFields(UserList):
         raise TypeError()
 
 
+class EnvironmentStatuses(dict):
+    """The status of each environment in the announcement, keyed by the environment's text.
+
+    These are shown in the Environment field, one environment per line::
+
+        :white_check_mark: <https://example.com|production>
+        :spinner: staging
+    """
+
+    @classmethod
+    def parse(cls, text):
+        statuses = cls()
+        for line in text.splitlines():
+            words = line.split()
+            status = words[0] if len(words) == 2 else ""
+            statuses[line.replace(status, "").strip()] = status
+        return statuses
+
+    def render(self):
+        return "\n".join(
+            f"{status} {name}" if status else name for name, status in self.items()
+        )
+
+
+@attr.s(slots=True)
+class Message:
+    """A release announcement in a channel."""
+
+    text = attr.ib()
+    attachment = attr.ib()  # everything in the attachment other than its fields
+    fields = attr.ib(converter=AttachmentFields)
+    environments = attr.ib(factory=EnvironmentStatuses)
+    ts = attr.ib(default=None)  # Slack's ID for the message, once it's posted
+    sent = attr.ib(default=None)  # what Slack last got, so we don't send it again
+
+    @classmethod
+    def from_slack(cls, data):
+        attachment = dict(data["attachments"][0])
+        fields = AttachmentFields(attachment.pop("fields", []))
+        environments = EnvironmentStatuses.parse(
+            fields.by_title.get("Environment", {}).get("value", "")
+        )
+        message = cls(data["text"], attachment, fields, environments, data["ts"])
+        message.sent = message.render()  # this is what's in the channel right now
+        return message
+
+    def render(self):
+        """The message as sent to the Slack API, serialized only here."""
+        if self.environments or "Environment" in self.fields.by_title:
+            self.fields["Environment"] = self.environments.render()
+
+        attachment = {**self.attachment, "fields": self.fields}
+        environment_text = self.fields.by_title.get("Environment", {}).get("value", "")
+        if ":x:" in environment_text:
+            attachment["color"] = "danger"
+        elif ":spinner:" in environment_text:
+            attachment.pop("color", None)
+        else:
+            attachment["color"] = "good"
+
+        data = {
+            "text": self.text,
+            "attachments": json.dumps([attachment], default=AttachmentFields.aslist),
+            "link_names": "1",
+        }
+        if self.ts:
+            data.update(ts=self.ts, parse=True)
+        return data
+
+
 class Hook(Base):
     def __init__(self):
         self.token = settings["slack_token"]
@@ -74,6 +370,16 @@ class Hook(Base):
         self.users_by_email = {}
         self.channels_by_name = {}
         self.channel_ids = []
+        # the announcements found or posted by this run, by channel ID
+        self.messages = {}
+        self.messages_lock = threading.Lock()
+        # the timestamps of messages about this deployment, which Slack uses as IDs
+        self.message_store = JsonStore.in_cache_dir("slack-messages.json")
+        self.message_ids = (
+            dict(self.message_store.get(deployment.id, {}))
+            if self.message_store is not None
+            else {}
+        )
 
         if self.token and self.slack_channels:
             self.load_workspace_data()
@@ -83,42 +389,93 @@ class Hook(Base):
 
     @backoff.on_exception(backoff.expo, Exception, max_tries=3)
     def load_workspace_data(self):
-        users_response = session.get(
-            "https://slack.com/api/users.list", params={"token": self.token}
-        )
-        users_response.raise_for_status()
-        for user in users_response.json()["members"]:
-            self.users_by_email[user["profile"].get("email")] = f"<@{user['id']}>"
+        """Load the IDs we need, from the cache if possible.
+
+        Without a complete list of users at hand,
+        only the people mentioned in this release are looked up,
+        and the list is downloaded in the background for next time.
+        """
+        directory = Directory.load(self.token)
+        if any(name not in directory.channels for name in self.slack_channels):
+            directory.load_channels()
+
+        if not directory.is_fresh:
+            emails = {commit.author_email for commit in deployment.commits}
+            emails.add(environ.get("GITLAB_USER_EMAIL"))
+            directory.look_up_users(
+                sorted(email for email in emails - set(directory.users) if email)
+            )
+            if directory.store is not None:
+                directory.refresh_in_background()
 
-        channels_response = session.get(
-            "https://slack.com/api/channels.list", params={"token": self.token}
-        )
-        channels_response.raise_for_status()
-        for channel in channels_response.json()["channels"]:
-            self.channels_by_name[channel["name"]] = channel["id"]
+        self.users_by_email = {
+            email: f"<@{user_id}>" for email, user_id in directory.users.items()
+        }
+        self.channels_by_name = dict(directory.channels)
 
     def base_data(self, channel_id):
         return {"token": self.token, "channel": channel_id}
 
-    def get_existing_message(self, channel_id):
-        response = session.get(
-            "https://slack.com/api/channels.history", params=self.base_data(channel_id)
+    def remember_message(self, channel_id, message):
+        with self.messages_lock:
+            self.messages[channel_id] = message
+            self.message_ids[channel_id] = message.ts
+            if self.message_store is not None:
+                self.message_store[deployment.id] = dict(self.message_ids)
+
+    def candidate_messages(self, channel_id):
+        """Messages that might be about this deployment, the most likely ones first."""
+        with self.messages_lock:
+            message_id = self.message_ids.get(channel_id)
+        if message_id:  # an earlier job posted it, but it may have changed since
+            yield from api_get(
+                "conversations.history",
+                self.token,
+                channel=channel_id,
+                latest=message_id,
+                inclusive="true",
+                limit=1,
+            )["messages"]
+
+        # we don't know about it, so let's look for it in the recent history
+        yield from islice(
+            paginate(
+                "conversations.history",
+                "messages",
+                self.token,
+                channel=channel_id,
+                oldest=time.time() - MESSAGE_SEARCH_WINDOW,
+            ),
+            MESSAGE_SEARCH_LIMIT,
         )
-        messages = response.json()["messages"]
-        for message in messages:
-            if message.get("text") == self.deployment_text:
-                message["attachments"][0]["fields"] = AttachmentFields(
-                    message["attachments"][0]["fields"]
-                )
+
+    def get_existing_message(self, channel_id):
+        """The announcement in the channel, looked up in Slack only the first time."""
+        with self.messages_lock:
+            if channel_id in self.messages:
+                return self.messages[channel_id]
+
+        for data in self.candidate_messages(channel_id):
+            if data.get("text") == self.deployment_text:
+                message = Message.from_slack(data)
+                self.remember_message(channel_id, message)
                 return message
         else:
             raise KeyError(f"There's no existing message in the {channel_id} channel")
 
     def get_existing_messages(self):
-        return {
-            channel_id: self.get_existing_message(channel_id)
-            for channel_id in self.channel_ids
-        }
+        with self.channel_pool() as pool:
+            messages = pool.map(self.get_existing_message, self.channel_ids)
+            return dict(zip(self.channel_ids, messages))
+
+    def channel_pool(self):
+        workers = max(min(len(self.channel_ids), MAX_CONCURRENCY), 1)
+        return ThreadPoolExecutor(workers, thread_name_prefix="crane-slack")
+
+    def for_each_channel(self, function, messages):
+        """Call the function with each channel and its message, all at once."""
+        with self.channel_pool() as pool:
+            list(pool.map(function, messages.keys(), messages.values()))
 
     @staticmethod
     def generate_cc_message(commit_msg):
@@ -142,15 +499,20 @@ class Hook(Base):
         elif deployment.is_rollback:
             prefix = ":warning: Rolling back the following changes:\n"
 
-        return prefix + "\n".join(
+        lines = [
             (
                 f'<{environ["CI_PROJECT_URL"]}/commit/{commit.hexsha}|{commit.summary}> '
-                f"by {self.users_by_email.get(commit.author.email, commit.author.name)}"
+                f"by {self.users_by_email.get(commit.author_email, commit.author_name)}"
                 f"{self.generate_cc_message(commit.message)}"
             )
             for commit in deployment.commits
             if len(commit.parents) == 1  # skip Merge commit
-        )
+        ]
+        if deployment.hidden_commits:
+            lines.append(
+                f"_+{deployment.hidden_commits} more of {deployment.total_commits} commits_"
+            )
+        return prefix + "\n".join(lines)
 
     def generate_new_message(self):
         fields = AttachmentFields()
@@ -160,45 +522,35 @@ class Hook(Base):
         fields["Releaser"] = ""
         fields["Links"] = self.links_text
 
-        return {
-            "link_names": True,
-            "text": self.deployment_text,
-            "attachments": [
-                {
-                    "fallback": f'{environ["CI_PROJECT_PATH"]} release',
-                    "title": f'{environ["CI_PROJECT_PATH"]} release',
-                    "title_link": f'{environ["CI_PROJECT_URL"]}/builds/{environ["CI_JOB_ID"]}',
-                    "text": self.get_changelog(),
-                    "fields": fields,
-                }
-            ],
-        }
+        return Message(
+            text=self.deployment_text,
+            attachment={
+                "fallback": f'{environ["CI_PROJECT_PATH"]} release',
+                "title": f'{environ["CI_PROJECT_PATH"]} release',
+                "title_link": f'{environ["CI_PROJECT_URL"]}/builds/{environ["CI_JOB_ID"]}',
+                "text": self.get_changelog(),
+            },
+            fields=fields,
+        )
 
     def send_message(self, channel_id, message):
-        fields = message["attachments"][0]["fields"]
+        rendered = message.render()
+        if rendered == message.sent:
+            return  # Slack already shows this
 
-        if ":x:" in fields["Environment"]:
-            message["attachments"][0]["color"] = "danger"
-        elif ":spinner:" in fields["Environment"]:
-            message["attachments"][0].pop("color", None)
+        data = {**self.base_data(channel_id), **rendered}
+        if message.ts:
+            api_call("chat.update", data=data)
         else:
-            message["attachments"][0]["color"] = "good"
-
-        message["attachments"] = json.dumps(
-            message["attachments"], default=AttachmentFields.aslist
-        )
-        if "ts" in message:
-            url = "https://slack.com/api/chat.update"
-            message["parse"] = True
-        else:
-            url = "https://slack.com/api/chat.postMessage"
-        session.post(
-            url, data={**self.base_data(channel_id), **message, "link_names": "1"}
-        )
+            result = api_call("chat.postMessage", data=data).json()
+            if result.get("ok"):
+                message.ts = result["ts"]
+                self.remember_message(channel_id, message)
+        message.sent = rendered
 
     def send_reply(self, channel_id, message_id, text, in_channel=False):
-        session.post(
-            "https://slack.com/api/chat.postMessage",
+        api_call(
+            "chat.postMessage",
             data={
                 **self.base_data(channel_id),
                 "thread_ts": message_id,
@@ -209,23 +561,7 @@ class Hook(Base):
         )
 
     def set_status(self, message, status):
-        fields = message["attachments"][0]["fields"]
-        env_lines = fields["Environment"].splitlines()
-        self.generate_env_lines(env_lines, status)
-        fields["Environment"] = "\n".join(env_lines)
-
-    def generate_env_lines(self, env_lines, status):
-        for index, line in enumerate(env_lines):
-            env_dict = {"status": "", "name": ""}
-            words = line.split()
-            if len(words) == 2:
-                env_dict["status"] = words[0]
-            env_dict["name"] = line.replace(env_dict["status"], "").strip()
-            if env_dict["name"] == self.env_text:
-                env_lines[index] = status + " " + self.env_text
-                break
-        else:
-            env_lines.append(status + " " + self.env_text)
+        message.environments[self.env_text] = status
 
     def before_upgrade(self):
         try:
@@ -236,19 +572,20 @@ class Hook(Base):
                 for channel_id in self.channel_ids
             }
 
-        for channel_id, message in messages.items():
-            fields = message["attachments"][0]["fields"]
+        releaser = self.users_by_email.get(
+            environ["GITLAB_USER_EMAIL"], environ["GITLAB_USER_EMAIL"]
+        )
 
-            if "ts" in message:
+        def announce(channel_id, message):
+            fields = message.fields
+
+            if message.ts:
                 self.send_reply(
-                    channel_id, message["ts"], f"Starting release on {self.env_text}."
+                    channel_id, message.ts, f"Starting release on {self.env_text}."
                 )
 
             self.set_status(message, ":spinner:")
 
-            releaser = self.users_by_email.get(
-                environ["GITLAB_USER_EMAIL"], environ["GITLAB_USER_EMAIL"]
-            )
             if fields["Releaser"] and releaser.strip("@") not in fields["Releaser"]:
                 fields["Releaser"] += " & " + releaser
             else:
@@ -261,16 +598,20 @@ class Hook(Base):
 
             self.send_message(channel_id, message)
 
+        self.for_each_channel(announce, messages)
+
     def after_upgrade_success(self):
         try:
             messages = self.get_existing_messages()
         except KeyError:
             return  # we didn't even start
 
-        for channel_id, message in messages.items():
+        def announce(channel_id, message):
             self.set_status(message, ":white_check_mark:")
             self.send_message(channel_id, message)
-            self.send_reply(channel_id, message["ts"], f"Released on {self.env_text}.")
+            self.send_reply(channel_id, message.ts, f"Released on {self.env_text}.")
+
+        self.for_each_channel(announce, messages)
 
     def after_upgrade_failure(self):
         try:
@@ -278,16 +619,18 @@ class Hook(Base):
         except KeyError:
             return  # we didn't even start
 
-        for channel_id, message in messages.items():
+        def announce(channel_id, message):
             self.set_status(message, ":x:")
             self.send_message(channel_id, message)
             self.send_reply(
                 channel_id,
-                message["ts"],
+                message.ts,
                 f"Release failed on {self.env_text}.",
                 in_channel=True,
             )
 
+        self.for_each_channel(announce, messages)
+
     @property
     def is_active(self):
         provided = missing = None
@@ -316,9 +659,14 @@ class Hook(Base):
 
     @property
     def links_text(self):
+        stacks = deployment.stacks or [deployment.stack]
         links = {
             "Image": f'{environ["CI_REGISTRY_IMAGE"]}:{deployment.new_version}',
-            "Stack": deployment.stack.web_url,
+            **(
+                {"Stack": stacks[0].web_url}
+                if len(stacks) == 1
+                else {f"Stack {stack.name}": stack.web_url for stack in stacks}
+            ),
             **dict(settings["slack_link"]),
         }
         return " | ".join(f"<{url}|{title}>" for title, url in links.items())
@@ -1,10 +1,56 @@
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from os import environ
+import time
+from urllib.parse import urlsplit
 
+import attr
+import backoff
+import click
 import requests
 
-from .. import deployment, settings
+from .. import deployment, settings, transport
+from . import outbox, release
 from .base import Base
+from .dispatcher import hook_name
+
+MAX_CONCURRENCY = 10
+STATUS_MAX_AGE = 60 * 60  # seconds until a saved status is too old to send
+
+session = requests.Session()
+_adapter = transport.Adapter(
+    pool_connections=MAX_CONCURRENCY, pool_maxsize=MAX_CONCURRENCY
+)
+session.mount("http://", _adapter)
+session.mount("https://", _adapter)
+
+
+@backoff.on_exception(
+    backoff.expo,
+    requests.RequestException,
+    max_tries=3,
+    giveup=lambda error: outbox.is_permanent(error.response),
+    on_backoff=lambda details: transport.accounting.record_retry(details["args"][0]),
+)
+def post(url, body, headers):
+    response = session.post(url, data=body, headers=headers, timeout=transport.TIMEOUT)
+    response.raise_for_status()
+    return response
+
+
+@attr.s(slots=True)
+class Delivery:
+
+    url = attr.ib()
+    duration = attr.ib()
+    status_code = attr.ib(default=None)
+    error = attr.ib(default=None)
+
+    @property
+    def target(self):
+        """The URL without credentials or query strings, so it's fine to print."""
+        parts = urlsplit(self.url)
+        return f"{parts.scheme}://{parts.hostname}{parts.path}"
 
 
 class Hook(Base):
@@ -12,33 +58,70 @@ class Hook(Base):
         self.urls = settings["webhook_url"]
         self.token = settings.get("webhook_token")
 
+    def before_upgrade(self):
+        self.send("started")
+
     def after_upgrade_success(self):
-        for url in self.urls:
-            requests.post(
-                url,
-                headers={"Auth-Token": self.token},
-                json={
-                    "status": "success",
-                    "version": deployment.new_version,
-                    "ci_project_url": environ["CI_PROJECT_URL"],
-                    "ci_job_id": environ["CI_JOB_ID"],
-                    "gitlab_user_email": environ["GITLAB_USER_EMAIL"],
-                    "commits": [
-                        {
-                            "id": commit.hexsha,
-                            "message": commit.message,
-                            "author_name": commit.author.name,
-                            "author_email": commit.author.email,
-                            "timestamp": str(
-                                datetime.fromtimestamp(
-                                    commit.committed_date + commit.committer_tz_offset
-                                )
-                            ),
-                        }
-                        for commit in deployment.commits
-                    ],
-                },
-            )
+        self.send("success")
+
+    def after_upgrade_failure(self):
+        self.send("failure")
+
+    def send(self, status):
+        """Post the release status to every URL at once, and report how it went."""
+        body = release.body(
+            {
+                "status": status,
+                "version": deployment.new_version,
+                "ci_project_url": environ["CI_PROJECT_URL"],
+                "ci_job_id": environ["CI_JOB_ID"],
+                "gitlab_user_email": environ["GITLAB_USER_EMAIL"],
+                "total_commits": deployment.total_commits,
+            }
+        )
+        workers = min(len(self.urls), MAX_CONCURRENCY)
+        with ThreadPoolExecutor(workers, thread_name_prefix="crane-webhook") as pool:
+            deliveries = list(pool.map(partial(self.deliver, body), self.urls))
+
+        for delivery in deliveries:
+            milliseconds = delivery.duration * 1000
+            if delivery.error is None:
+                click.echo(
+                    f"Webhook {delivery.target} responded with {delivery.status_code} "
+                    f"in {milliseconds:.0f} ms."
+                )
+            else:
+                click.secho(
+                    f"Webhook {delivery.target} failed after {milliseconds:.0f} ms: "
+                    f"{delivery.error}",
+                    fg="yellow",
+                    err=True,
+                )
+        return deliveries
+
+    @staticmethod
+    def status_key(url):
+        """Statuses of the project's releases in an environment replace each other."""
+        return f'{url} {environ["CI_PROJECT_URL"]} {environ.get("CI_ENVIRONMENT_NAME")}'
+
+    def deliver(self, body, url):
+        started_at = time.monotonic()
+        headers = {"Auth-Token": self.token, "Content-Type": "application/json"}
+        outbox.supersede(self.status_key(url))  # saved statuses are older than this
+        try:
+            response = post(url, body, headers)
+        except requests.RequestException as ex:
+            duration = time.monotonic() - started_at
+            if not outbox.is_permanent(ex.response):
+                outbox.spool(
+                    hook_name(self),
+                    requests.Request("POST", url, data=body, headers=headers),
+                    key=self.status_key(url),
+                    max_age=STATUS_MAX_AGE,
+                )
+            status_code = ex.response.status_code if ex.response is not None else None
+            return Delivery(url, duration, status_code, ex)
+        return Delivery(url, time.monotonic() - started_at, response.status_code)
 
     @property
     def is_active(self):
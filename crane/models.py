@@ -1,5 +1,7 @@
+from functools import partial
 from os import environ
 import re
+import threading
 
 import attr
 import click
@@ -9,24 +11,196 @@ import gitdb.exc
 from .exc import UpgradeFailed
 
 
+LOG_FORMAT = "%H%x00%P%x00%an%x00%ae%x00%ct%x00%ci%x00%B"
+
+
+@attr.s(frozen=True, slots=True)
+class Commit:
+    """The details of a commit that hooks need, loaded in bulk by :func:`iter_commits`."""
+
+    hexsha = attr.ib()
+    parents = attr.ib(converter=tuple)
+    author_name = attr.ib()
+    author_email = attr.ib()
+    committed_date = attr.ib(converter=int)
+    committer_tz_offset = attr.ib(converter=int)
+    message = attr.ib()
+
+    @property
+    def summary(self):
+        return self.message.split("\n", 1)[0]
+
+    @classmethod
+    def from_log_fields(cls, fields):
+        hexsha, parents, author_name, author_email, timestamp, date, message = fields
+        utc_offset = date.rsplit(" ", 1)[-1]  # looks like +0130
+        sign = -1 if utc_offset[0] == "-" else 1
+        seconds = int(utc_offset[1:3]) * 3600 + int(utc_offset[3:5]) * 60
+        return cls(
+            hexsha,
+            parents.split(),
+            author_name,
+            author_email,
+            timestamp,
+            -sign * seconds,  # same as GitPython, which counts seconds west of UTC
+            message,
+        )
+
+
+def iter_commits(repo, *args):
+    """Stream commits from a single ``git log`` call instead of many object lookups."""
+    process = repo.git.log(*args, "-z", f"--format={LOG_FORMAT}", as_process=True)
+    fields = []
+    pending = b""
+    for chunk in iter(partial(process.stdout.read, 64 * 1024), b""):
+        *complete, pending = (pending + chunk).split(b"\0")
+        for field in complete:
+            fields.append(field.decode(errors="replace"))
+            if len(fields) == len(attr.fields(Commit)):
+                yield Commit.from_log_fields(fields)
+                fields = []
+    process.wait()
+
+
+FORWARD = "forward"
+ROLLBACK = "rollback"
+REDEPLOY = "redeploy"
+DISCONNECTED = "disconnected"
+
+
+def classify(repo, old_commit, new_commit):
+    """Tell how the new commit relates to the old one, with a single ``git merge-base``.
+
+    Answers are saved in the cache directory, since they never change for a pair of commits.
+    """
+    from .store import JsonStore  # avoiding circular imports
+
+    if old_commit is None:  # old commit was probably removed by force push
+        return DISCONNECTED
+    if old_commit == new_commit:
+        return REDEPLOY
+
+    store = JsonStore.in_cache_dir("ancestry.json")
+    key = f"{old_commit.hexsha}..{new_commit.hexsha}"
+    if store is not None and key in store:
+        return store.get(key)
+
+    try:
+        merge_base = repo.git.merge_base(old_commit.hexsha, new_commit.hexsha)
+    except git.GitCommandError:  # no common history, or other black magic
+        return DISCONNECTED  # not cached, as a deeper clone might find the history
+
+    if merge_base == old_commit.hexsha:
+        direction = FORWARD
+    elif merge_base == new_commit.hexsha:
+        direction = ROLLBACK
+    else:
+        direction = DISCONNECTED  # the two commits are on separate branches
+
+    if store is not None:
+        store[key] = direction
+    return direction
+
+
+@attr.s(frozen=True, slots=True)
+class Changes:
+    """What a deployment changes, worked out from git history.
+
+    Hooks all read this same object, so each git command runs only once per run.
+    """
+
+    old_commit = attr.ib()
+    new_commit = attr.ib()
+    commits = attr.ib(converter=tuple)
+    direction = attr.ib()
+    total_commits = attr.ib()
+
+    @property
+    def is_rollback(self):
+        return self.direction == ROLLBACK
+
+    @property
+    def is_disconnected(self):
+        return self.direction == DISCONNECTED
+
+    @property
+    def hidden_commits(self):
+        """The number of commits left out of :attr:`commits` because of the cap."""
+        return self.total_commits - len(self.commits)
+
+    def latest(self, count):
+        """The latest ``count`` of the loaded commits (all of them for 0), in their order."""
+        if not count or count >= len(self.commits):
+            return self.commits
+        if self.is_rollback:  # newest first
+            return self.commits[:count]
+        return self.commits[-count:]
+
+    @classmethod
+    def from_range(cls, repo, old_version, new_version, max_commits=0):
+        """Load the changes, keeping only the latest ``max_commits`` commits (0 for all)."""
+        new_commit = repo.commit(new_version)
+        try:
+            old_commit = repo.commit(old_version)
+            old_commit.committed_date  # this is what fails for unknown SHAs
+        except (gitdb.exc.BadName, ValueError):
+            old_commit = None  # old commit was probably removed by force push
+
+        direction = classify(repo, old_commit, new_commit)
+
+        if direction == DISCONNECTED:
+            return cls(
+                old_commit,
+                new_commit,
+                iter_commits(repo, "-1", new_commit.hexsha),
+                direction,
+                total_commits=1,
+            )
+        if direction == REDEPLOY:
+            return cls(old_commit, new_commit, [], direction, total_commits=0)
+
+        if direction == ROLLBACK:
+            revisions = f"{new_commit.hexsha}..{old_commit.hexsha}"
+            order = []  # newest first, as we're undoing them
+        else:
+            revisions = f"{old_commit.hexsha}..{new_commit.hexsha}"
+            order = ["--reverse"]  # oldest first, applied after the limit
+
+        limit = [f"--max-count={max_commits}"] if max_commits else []
+        commits = tuple(iter_commits(repo, *order, *limit, revisions))
+        total_commits = len(commits)
+        if max_commits and total_commits == max_commits:  # there might be more
+            total_commits = int(repo.git.rev_list("--count", revisions))
+
+        return cls(old_commit, new_commit, commits, direction, total_commits)
+
+
 @attr.s(slots=True)
 class Deployment:
 
     stack = attr.ib(default=None)
+    stacks = attr.ib(factory=list)
     services = attr.ib(default=None)
     repo = attr.ib(default=None)
     old_version = attr.ib(default=None)
     new_version = attr.ib(default=None)
     is_limited = attr.ib(default=False)
+    _changes = attr.ib(default=None, init=False, repr=False)
+    _changes_key = attr.ib(default=None, init=False, repr=False)
+    _changes_lock = attr.ib(factory=threading.Lock, init=False, repr=False)
 
     def load_from_settings(self, settings):
-        from . import rancher  # here to prevent circular importing
+        from . import upgrade  # here to prevent circular importing
 
-        self.stack = rancher.Stack.from_name(settings["stack"])
-        self.services = [
-            self.stack.service_from_name(service) for service in settings["service"]
+        targets = [(name, settings["service"]) for name in settings["stack"]]
+        targets += [
+            (name, services or settings["service"])
+            for name, services in settings["stack_file"] or ()
         ]
 
+        self.stacks, self.services = upgrade.lookup(targets)
+        self.stack = self.stacks[0]
+
         old_image = self.services[0].json()["launchConfig"]["imageUuid"]
 
         if settings["new_image"]:
@@ -65,30 +239,64 @@ class Deployment:
         return self.old_version + self.new_version
 
     @property
-    def commits(self):
-        if self.is_disconnected:
-            return [self.new_commit]
-        elif self.is_redeploy:
-            return []
-        elif self.is_rollback:
-            return list(
-                self.repo.iter_commits(self.old_version + "..." + self.new_version)
-            )
-        return reversed(
-            list(self.repo.iter_commits(self.old_version + "..." + self.new_version))
+    def changes(self):
+        """The analysis of the commit range, done once for as long as the versions stay.
+
+        It loads as many commits as the announcements or the payloads need, whichever is more.
+        """
+        from . import settings  # avoiding circular imports
+
+        caps = (
+            settings.get("max_changelog_commits", 0),
+            settings.get("max_payload_commits", 0),
         )
+        key = (self.repo, self.old_version, self.new_version)
+        with self._changes_lock:  # hooks ask for it from their own threads at once
+            if self._changes is None or self._changes_key != key:
+                self._changes = Changes.from_range(
+                    *key, max_commits=0 if 0 in caps else max(caps)
+                )
+                self._changes_key = key
+            return self._changes
+
+    def invalidate_changes(self):
+        with self._changes_lock:
+            self._changes = self._changes_key = None
+
+    @property
+    def commits(self):
+        """The commits to announce, at most ``--max-changelog-commits`` of them."""
+        from . import settings  # avoiding circular imports
+
+        return self.changes.latest(settings.get("max_changelog_commits", 0))
+
+    @property
+    def payload_commits(self):
+        """The commits to send to other programs, at most ``--max-payload-commits`` of them."""
+        from . import settings  # avoiding circular imports
+
+        return self.changes.latest(settings.get("max_payload_commits", 0))
+
+    @property
+    def total_commits(self):
+        return self.changes.total_commits
+
+    @property
+    def hidden_commits(self):
+        """The number of commits left out of the announcements."""
+        return self.total_commits - len(self.commits)
 
     @property
     def old_commit(self):
-        return self.repo.commit(self.old_version)
+        return self.changes.old_commit
 
     @property
     def new_commit(self):
-        return self.repo.commit(self.new_version)
+        return self.changes.new_commit
 
     @property
     def is_rollback(self):
-        return self.new_commit.committed_date < self.old_commit.committed_date
+        return self.changes.is_rollback
 
     @property
     def is_redeploy(self):
@@ -97,13 +305,7 @@ class Deployment:
     @property
     def is_disconnected(self):
         """True if no path can be found from old commit to new commit."""
-        try:
-            return not (
-                self.repo.is_ancestor(self.old_version, self.new_version)
-                or self.repo.is_ancestor(self.new_version, self.old_version)
-            )
-        except git.GitCommandError:  # old commit was probably removed by force push or other black magic
-            return True
+        return self.changes.is_disconnected
 
     def check_preconditions(self):
         from . import settings  # avoiding circular imports
@@ -121,7 +323,7 @@ class Deployment:
             self.is_limited = True
             return
         try:
-            self.new_commit
+            self.repo.commit(self.new_version)
         except (gitdb.exc.BadName, ValueError):
             click.secho(
                 f"The new version you specified, {self.new_version}, is not a valid git reference! "
@@ -1,23 +1,116 @@
+from base64 import b64encode
+from copy import deepcopy
 import re
+import threading
+import time
 
 import attr
 import click
 import pybreaker
 import requests
+import websocket
 
 import crane
 import crane.exc
 
-from . import deployment, settings
+from . import deployment, settings, transport
+from .stats import recorder
+from .tracing import tracer
 
 session = requests.Session()
-_adapter = requests.adapters.HTTPAdapter(
-    pool_connections=5, pool_maxsize=5, max_retries=3
-)
+_adapter = transport.Adapter(pool_connections=5, pool_maxsize=5, max_retries=3)
 session.mount("http://", _adapter)
 session.mount("https://", _adapter)
+session.hooks["response"].append(lambda *_, **__: recorder.count("rancher_requests"))
+
+time_breaker = pybreaker.CircuitBreaker(
+    fail_max=20, name="Rancher", listeners=[transport.TripCounter()]
+)
+
+
+@attr.s(slots=True)
+class CachedResponse:
+
+    body = attr.ib()
+    etag = attr.ib()
+    fetched_at = attr.ib()
+
+
+@attr.s(slots=True)
+class ResponseCache:
+    """Remember the Rancher documents we've downloaded during this run.
+
+    Entries with an ETag are revalidated with If-None-Match on every use,
+    and entries without one are trusted for ``ttl`` seconds.
+    The bodies are shared, so don't modify them in place.
+    """
+
+    ttl = attr.ib(default=5)
+    entries = attr.ib(factory=dict)
+    lock = attr.ib(factory=threading.Lock)
+
+    def get(self, url):
+        with self.lock:
+            entry = self.entries.get(url)
+
+        headers = {}
+        if entry and entry.etag:
+            headers["If-None-Match"] = entry.etag
+        elif entry and time.monotonic() - entry.fetched_at < self.ttl:
+            return entry.body
+
+        response = session.get(url, headers=headers, timeout=60)
+        if entry and response.status_code == 304:
+            return entry.body
+
+        response.raise_for_status()
+        entry = CachedResponse(
+            response.json(), response.headers.get("ETag"), time.monotonic()
+        )
+        with self.lock:
+            self.entries[url] = entry
+        return entry.body
+
+    def put(self, url, body):
+        with self.lock:
+            self.entries[url] = CachedResponse(body, None, time.monotonic())
+
+    def invalidate(self, url):
+        with self.lock:
+            self.entries.pop(url, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+cache = ResponseCache()
+
+
+def paginate(url, params=None):
+    """Yield every item of a Rancher collection, following its pagination links."""
+    while url:
+        response = session.get(url, params=params, timeout=60)
+        response.raise_for_status()
+        collection = response.json()
+        yield from collection["data"]
+        url = (collection.get("pagination") or {}).get("next")
+        params = None  # the next link already has the whole query in it
 
-time_breaker = pybreaker.CircuitBreaker(fail_max=20)
+
+def subscribe(timeout=60):
+    """Open Rancher's event websocket, which pushes changes of resources."""
+    url = re.sub("^http", "ws", settings["url"])
+    header = {}
+    if session.auth:
+        credentials = b64encode(":".join(session.auth).encode()).decode()
+        header["Authorization"] = f"Basic {credentials}"
+
+    return websocket.create_connection(
+        f'{url}/v1/projects/{settings["env"]}/subscribe?eventNames=resource.change',
+        header=header,
+        timeout=timeout,
+    )
 
 
 @attr.s(frozen=True, slots=True)
@@ -37,9 +130,8 @@ class Entity:
 
     @time_breaker
     def json(self):
-        response = session.get(self.api_url, timeout=60)
-        response.raise_for_status()
-        return response.json()
+        with tracer.span("rancher.json", entity=self.id):
+            return cache.get(self.api_url)
 
 
 @attr.s(frozen=True, slots=True)
@@ -56,24 +148,82 @@ class Stack(Entity):
         return f'{settings["url"]}/v1/projects/{settings["env"]}/environments/{self.id}'
 
     @classmethod
-    def from_name(cls, name):
-        response = session.get(
-            "{url}/v1/projects/{env}/environments".format_map(settings),
-            params={"name": name},
-        )
-        response.raise_for_status()
-        stack_info = response.json()["data"][0]
+    def from_names(cls, names):
+        """Look up multiple stacks with a single list request, each of them once."""
+        names = list(dict.fromkeys(names))
+        params = {"limit": 1000}
+        if len(names) == 1:
+            params["name"] = names[0]
+        stacks_by_name = {
+            stack_info["name"]: stack_info
+            for stack_info in paginate(
+                "{url}/v1/projects/{env}/environments".format_map(settings), params
+            )
+        }
 
-        return cls(stack_info["id"].replace("1e", "1st"), stack_info["name"])
+        missing = [name for name in names if name not in stacks_by_name]
+        if missing:
+            click.secho(
+                "I can't find these stacks in Rancher: "
+                + ", ".join(click.style(name, bold=True) for name in missing)
+                + " "
+                + click.style("(・・ )?", bold=True),
+                err=True,
+                fg="red",
+            )
+            raise crane.exc.UpgradeFailed()
 
-    def service_from_name(self, name):
-        response = session.get(
-            "{url}/v1/projects/{env}/services".format_map(settings),
-            params={"name": name, "stackId": self.id},
-        )
-        response.raise_for_status()
-        service_info = response.json()["data"][0]
-        return Service(service_info["id"], service_info["name"], self)
+        return [
+            cls(stacks_by_name[name]["id"].replace("1e", "1st"), name) for name in names
+        ]
+
+    def services_from_names(self, names, qualified=False):
+        """Look up multiple services of the stack with a single list request.
+
+        With ``qualified``, the services are logged along with the stack's name.
+        """
+        services_url = "{url}/v1/projects/{env}/services".format_map(settings)
+        services_by_name = {}
+        for service_info in paginate(
+            services_url, params={"stackId": self.id, "limit": 1000}
+        ):
+            services_by_name[service_info["name"]] = service_info
+            # we'll need the details of the services right away
+            cache.put(f'{services_url}/{service_info["id"]}', service_info)
+
+        missing = [name for name in names if name not in services_by_name]
+        if missing:
+            click.secho(
+                f"I can't find these services in the {self.log_name} stack: "
+                + ", ".join(click.style(name, bold=True) for name in missing)
+                + " "
+                + click.style("(・・ )?", bold=True),
+                err=True,
+                fg="red",
+            )
+            raise crane.exc.UpgradeFailed()
+
+        return [
+            Service(services_by_name[name]["id"], name, self, qualified)
+            for name in names
+        ]
+
+    @time_breaker
+    def service_states(self):
+        """Map the IDs of all services in the stack to their current state.
+
+        This needs only a single list request for most stacks,
+        instead of fetching each service one by one.
+        """
+        services_url = "{url}/v1/projects/{env}/services".format_map(settings)
+        states = {}
+        for service_info in paginate(
+            services_url, params={"stackId": self.id, "limit": 1000}
+        ):
+            states[service_info["id"]] = service_info["state"]
+            # these are newer than the cached documents, and save fetching them again
+            cache.put(f'{services_url}/{service_info["id"]}', service_info)
+        return states
 
 
 @attr.s(frozen=True, slots=True)
@@ -81,6 +231,14 @@ class Service(Entity):
 
     ID_PATTERN = re.compile("[0-9]s[0-9]+")
     stack = attr.ib(validator=attr.validators.instance_of(Stack))
+    # whether there are services of other stacks around, so the name alone is ambiguous
+    qualified = attr.ib(default=False, cmp=False)
+
+    @property
+    def log_name(self):
+        if self.qualified:
+            return click.style(f"{self.stack.name}/{self.name}", bold=True)
+        return click.style(self.name, bold=True)
 
     @property
     def web_url(self):
@@ -90,6 +248,10 @@ class Service(Entity):
     def api_url(self):
         return f'{settings["url"]}/v1/projects/{settings["env"]}/services/{self.id}'
 
+    @property
+    def scale(self):
+        return self.json().get("scale") or 1  # global services have no scale
+
     @property
     def launch_config(self):
         return self.json()["launchConfig"]
@@ -111,12 +273,13 @@ class Service(Entity):
             }
         }
 
+        # copying, as we're about to modify what's stored in the cache
         if not settings["sidekick"]:
-            launch_config = payload["inServiceStrategy"][
-                "launchConfig"
-            ] = self.launch_config
+            launch_config = payload["inServiceStrategy"]["launchConfig"] = deepcopy(
+                self.launch_config
+            )
         else:
-            launch_config = self.sidekick_launch_configs[settings["sidekick"]]
+            launch_config = deepcopy(self.sidekick_launch_configs[settings["sidekick"]])
             payload["inServiceStrategy"]["secondaryLaunchConfigs"].append(launch_config)
 
         launch_config["imageUuid"] = (
@@ -131,6 +294,7 @@ class Service(Entity):
         response = session.post(
             self.api_url, params={"action": "upgrade"}, json=payload, timeout=60
         )
+        cache.invalidate(self.api_url)
         try:
             response.raise_for_status()
         except requests.exceptions.HTTPError as ex:
@@ -163,5 +327,6 @@ class Service(Entity):
         response = session.post(
             self.api_url, params={"action": "finishupgrade"}, timeout=60, json={}
         )
+        cache.invalidate(self.api_url)
         response.raise_for_status()
         click.echo(f"Marked upgrade of {self.log_name} as finished in Rancher.")
@@ -0,0 +1,65 @@
+"""Measurements of the release, for the integrations that report metrics."""
+
+from collections import Counter
+from contextlib import contextmanager
+import threading
+import time
+
+import attr
+
+from .tracing import tracer
+
+
+@attr.s(slots=True)
+class Recorder:
+    """Collects how long each part of the release takes, from any thread."""
+
+    started_at = attr.ib(default=None)
+    phases = attr.ib(factory=dict)  # seconds spent in each phase, by name
+    phase_started_at = attr.ib(factory=dict)
+    services = attr.ib(factory=dict)  # seconds until each service was upgraded
+    hooks = attr.ib(factory=list)  # (hook name, event, seconds) of every hook event
+    counts = attr.ib(factory=Counter)
+    lock = attr.ib(factory=threading.Lock, repr=False)
+
+    def start(self):
+        self.started_at = time.monotonic()
+
+    @property
+    def elapsed(self):
+        if self.started_at is None:
+            return None
+        return time.monotonic() - self.started_at
+
+    def since(self, phase):
+        """Seconds since the given phase started."""
+        started_at = self.phase_started_at.get(phase)
+        if started_at is None:
+            return None
+        return time.monotonic() - started_at
+
+    @contextmanager
+    def phase(self, name):
+        """Time a phase of the release, which is also a span of its trace."""
+        started_at = self.phase_started_at[name] = time.monotonic()
+        try:
+            with tracer.span(name):
+                yield
+        finally:
+            with self.lock:
+                self.phases[name] = time.monotonic() - started_at
+
+    def record_service(self, service, seconds):
+        with self.lock:
+            self.services[service] = seconds
+
+    def record_hook(self, name, event, seconds):
+        with self.lock:
+            self.hooks.append((name, event, seconds))
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counts[name] += value
+
+
+recorder = Recorder()
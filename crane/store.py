@@ -0,0 +1,87 @@
+"""Small JSON files that crane keeps between runs, in the ``--cache-dir``."""
+
+import json
+import os
+import tempfile
+import threading
+
+import attr
+
+
+def replace_file(path, content, mode=0o644):
+    """Replace the file in one step, so that readers never see half of it.
+
+    The new file has its permissions before anything is in it,
+    and nothing is left behind if writing it fails.
+    """
+    directory = os.path.dirname(path) or "."
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".crane-")
+    try:
+        os.fchmod(fd, mode)
+        with os.fdopen(fd, "w") as temp_file:
+            temp_file.write(content)
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+
+
+@attr.s(slots=True)
+class JsonStore:
+    """A dict of JSON values saved in a file, keeping only the latest entries."""
+
+    path = attr.ib()
+    max_entries = attr.ib(default=1000)
+    mode = attr.ib(default=0o644)
+    _data = attr.ib(default=None, init=False, repr=False)
+    _lock = attr.ib(factory=threading.RLock, init=False, repr=False)
+
+    @classmethod
+    def in_cache_dir(cls, filename, **kwargs):
+        """Open a store in the configured cache directory, or None if caching is off."""
+        from . import settings  # avoiding circular imports
+
+        cache_dir = settings.get("cache_dir")
+        if not cache_dir:
+            return None
+        return cls(os.path.join(os.path.expanduser(cache_dir), filename), **kwargs)
+
+    @property
+    def data(self):
+        with self._lock:
+            if self._data is None:
+                try:
+                    with open(self.path) as store_file:
+                        self._data = json.load(store_file)
+                except (OSError, ValueError):  # missing or corrupt, let's start over
+                    self._data = {}
+            return self._data
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self.data.pop(key, None)  # so that it counts as the newest entry
+            self.data[key] = value
+            for old_key in list(self.data)[: -self.max_entries]:
+                del self.data[old_key]
+            self.save()
+
+    def __delitem__(self, key):
+        with self._lock:
+            if self.data.pop(key, None) is not None:
+                self.save()
+
+    def save(self):
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            replace_file(self.path, json.dumps(self._data), self.mode)
+        except OSError:
+            pass  # a cache we can't write is just a cache miss next time
@@ -0,0 +1,191 @@
+"""Spans of the release, to see where its time goes.
+
+Tracing is off unless ``--trace-file`` is set, and then every span is kept in memory
+until the release is over, and written to the file in one go.
+Spans started in worker threads nest under the span they came from,
+as long as the context is carried over, which the Rancher and hook workers do.
+"""
+
+import contextvars
+import functools
+import json
+import os
+import threading
+import time
+
+import attr
+import click
+
+_current = contextvars.ContextVar("crane_span", default=None)
+
+
+class NoopSpan:
+    """Stand-in for spans while tracing is off, so that it costs next to nothing."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def set_attribute(self, key, value):
+        return
+
+    def set_error(self, error):
+        return
+
+
+NOOP_SPAN = NoopSpan()
+
+
+@attr.s(slots=True)
+class Span:
+
+    tracer = attr.ib(repr=False)
+    name = attr.ib()
+    attributes = attr.ib(factory=dict)
+    span_id = attr.ib(factory=lambda: os.urandom(8).hex())
+    parent_id = attr.ib(default=None)
+    thread = attr.ib(default=None)
+    start_ns = attr.ib(default=None)
+    end_ns = attr.ib(default=None)
+    error = attr.ib(default=None)
+    token = attr.ib(default=None, repr=False)
+
+    def __enter__(self):
+        parent = _current.get()
+        self.parent_id = parent.span_id if parent is not None else None
+        self.thread = threading.current_thread().name
+        self.token = _current.set(self)
+        self.start_ns = time.time_ns()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.end_ns = time.time_ns()
+        _current.reset(self.token)
+        if exc_value is not None and self.error is None:
+            self.set_error(exc_value)
+        self.tracer.finish(self)
+        return False
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def set_error(self, error):
+        message = str(error)
+        self.error = (
+            f"{type(error).__name__}: {message}" if message else type(error).__name__
+        )
+
+    def as_json(self):
+        return {
+            "name": self.name,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "thread": self.thread,
+            "start": self.start_ns / 1e9,
+            "duration": (self.end_ns - self.start_ns) / 1e9,
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+    def as_otlp(self, trace_id):
+        attributes = {"thread.name": self.thread, **self.attributes}
+        status = {"code": 1}  # ok
+        if self.error is not None:
+            status = {"code": 2, "message": self.error}
+        span = {
+            "traceId": trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": 1,  # internal
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns),
+            "attributes": [otlp_attribute(*item) for item in attributes.items()],
+            "status": status,
+        }
+        if self.parent_id is not None:
+            span["parentSpanId"] = self.parent_id
+        return span
+
+
+def otlp_attribute(key, value):
+    if isinstance(value, bool):
+        return {"key": key, "value": {"boolValue": value}}
+    if isinstance(value, int):
+        return {"key": key, "value": {"intValue": str(value)}}
+    if isinstance(value, float):
+        return {"key": key, "value": {"doubleValue": value}}
+    return {"key": key, "value": {"stringValue": str(value)}}
+
+
+@attr.s(slots=True)
+class Tracer:
+
+    enabled = attr.ib(default=False)
+    trace_id = attr.ib(factory=lambda: os.urandom(16).hex())
+    spans = attr.ib(factory=list)
+    lock = attr.ib(factory=threading.Lock, repr=False)
+
+    def span(self, name, **attributes):
+        if not self.enabled:
+            return NOOP_SPAN
+        return Span(self, name, attributes)
+
+    def traced(self, name):
+        """Decorate a function to run it in a span."""
+
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return function(*args, **kwargs)
+                with Span(self, name):
+                    return function(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def finish(self, span):
+        with self.lock:
+            self.spans.append(span)
+
+    def as_json(self):
+        with self.lock:
+            spans = sorted(self.spans, key=lambda span: span.start_ns)
+        return {"trace_id": self.trace_id, "spans": [span.as_json() for span in spans]}
+
+    def as_otlp(self):
+        with self.lock:
+            spans = sorted(self.spans, key=lambda span: span.start_ns)
+        return {
+            "resourceSpans": [
+                {
+                    "resource": {
+                        "attributes": [otlp_attribute("service.name", "crane")]
+                    },
+                    "scopeSpans": [
+                        {
+                            "scope": {"name": "crane"},
+                            "spans": [span.as_otlp(self.trace_id) for span in spans],
+                        }
+                    ],
+                }
+            ]
+        }
+
+    def write(self, path, trace_format="json"):
+        trace = self.as_otlp() if trace_format == "otlp" else self.as_json()
+        try:
+            with open(os.path.expanduser(path), "w") as trace_file:
+                json.dump(trace, trace_file)
+        except OSError as ex:
+            click.secho(
+                f"I couldn't write the trace to {path}: {ex}", fg="yellow", err=True
+            )
+            return False
+        return True
+
+
+tracer = Tracer()
@@ -0,0 +1,218 @@
+"""Accounting of the HTTP requests crane makes, to see which APIs it leans on.
+
+Every session of crane mounts :class:`Adapter`, which records each request
+under its host and endpoint, the path with IDs and tokens left out.
+"""
+
+from collections import Counter
+import json
+import math
+import re
+import threading
+import time
+from urllib.parse import urlsplit
+
+import attr
+import click
+import pybreaker
+import requests
+import urllib3
+
+from . import settings
+
+TIMEOUT = (3.05, 10)  # seconds to connect, and to wait for the response
+ID_SEGMENT = re.compile(r"v\d+|\D*")  # API versions and words are fine to show
+SHOWN_SEGMENTS = 2  # of the paths of other APIs than Rancher's, such as webhooks
+PERCENTILES = (50, 90, 99)
+COLUMNS = {  # of the table, by key in the JSON
+    "requests": "requests",
+    "errors": "errors",
+    "retries": "retries",
+    "bytes_sent": "sent",
+    "bytes_received": "received",
+}
+
+
+def endpoint_of(url):
+    """Split the URL into its host and its path, with IDs and tokens replaced.
+
+    Rancher's paths are only words and IDs, but other URLs, like webhooks,
+    can have secrets that are words too, so only their first segments are shown.
+    """
+    parts = urlsplit(url)
+    segments = parts.path.split("/")
+    rancher_url = settings.get("url")
+    if rancher_url and parts.hostname == urlsplit(rancher_url).hostname:
+        shown = len(segments)
+    else:
+        shown = SHOWN_SEGMENTS + 1  # after the empty one before the first "/"
+    segments = [
+        segment if ID_SEGMENT.fullmatch(segment) else "{id}"
+        for segment in segments[:shown]
+    ] + ["{id}" if segment else "" for segment in segments[shown:]]
+    return parts.hostname or "", "/".join(segments) or "/"
+
+
+def percentile(values, percent):
+    """The nearest-rank percentile of the sorted values."""
+    if not values:
+        return None
+    return values[max(math.ceil(len(values) * percent / 100), 1) - 1]
+
+
+@attr.s(slots=True)
+class Endpoint:
+
+    count = attr.ib(default=0)
+    errors = attr.ib(default=0)
+    retries = attr.ib(default=0)
+    bytes_sent = attr.ib(default=0)
+    bytes_received = attr.ib(default=0)
+    latencies = attr.ib(factory=list)  # seconds, of every request
+
+    def as_json(self):
+        latencies = sorted(self.latencies)
+        return {
+            "requests": self.count,
+            "errors": self.errors,
+            "retries": self.retries,
+            "bytes_sent": self.bytes_sent,
+            "bytes_received": self.bytes_received,
+            "latency": {
+                f"p{percent}": percentile(latencies, percent) for percent in PERCENTILES
+            },
+        }
+
+
+@attr.s(slots=True)
+class Accounting:
+    """Tallies of requests by host and endpoint, which any thread can add to."""
+
+    endpoints = attr.ib(factory=dict)
+    breaker_trips = attr.ib(factory=Counter)  # how many times each breaker opened
+    lock = attr.ib(factory=threading.Lock, repr=False)
+
+    def record(
+        self, url, seconds, bytes_sent=0, bytes_received=0, retries=0, error=False
+    ):
+        key = endpoint_of(url)
+        with self.lock:
+            stats = self.endpoints.setdefault(key, Endpoint())
+            stats.count += 1
+            stats.errors += int(error)
+            stats.retries += retries
+            stats.bytes_sent += bytes_sent
+            stats.bytes_received += bytes_received
+            stats.latencies.append(seconds)
+
+    def record_retry(self, url):
+        """Count a request that is sent again by crane, rather than by urllib3."""
+        key = endpoint_of(url)
+        with self.lock:
+            self.endpoints.setdefault(key, Endpoint()).retries += 1
+
+    def record_trip(self, breaker_name):
+        with self.lock:
+            self.breaker_trips[breaker_name] += 1
+
+    def as_json(self):
+        with self.lock:
+            return {
+                "endpoints": [
+                    {"host": host, "endpoint": path, **stats.as_json()}
+                    for (host, path), stats in sorted(self.endpoints.items())
+                ],
+                "breaker_trips": dict(self.breaker_trips),
+            }
+
+    def table(self):
+        headers = ["host", "endpoint", *COLUMNS.values()]
+        headers += [f"p{percent}" for percent in PERCENTILES]
+        rows = []
+        for entry in self.as_json()["endpoints"]:
+            row = [entry["host"], entry["endpoint"]]
+            row += [str(entry[key]) for key in COLUMNS]
+            row += [
+                "-" if seconds is None else f"{seconds * 1000:.0f}ms"
+                for seconds in entry["latency"].values()
+            ]
+            rows.append(row)
+
+        widths = [max(map(len, column)) for column in zip(headers, *rows)]
+        lines = [
+            "  ".join(
+                cell.ljust(width) if index < 2 else cell.rjust(width)
+                for index, (cell, width) in enumerate(zip(row, widths))
+            ).rstrip()
+            for row in [headers, *rows]
+        ]
+        for name, trips in sorted(self.breaker_trips.items()):
+            times = "once" if trips == 1 else f"{trips} times"
+            lines.append(f"The {name} circuit breaker tripped {times}.")
+        return "\n".join(lines)
+
+    def write(self, path):
+        try:
+            with open(path, "w") as json_file:
+                json.dump(self.as_json(), json_file, indent=2)
+        except OSError as ex:
+            click.secho(
+                f"I couldn't write the HTTP profile to {path}: {ex}",
+                fg="yellow",
+                err=True,
+            )
+
+
+accounting = Accounting()
+
+
+def body_size(body):
+    if body is None:
+        return 0
+    if isinstance(body, (bytes, str)):
+        return len(body)
+    return 0  # streamed from a file or a generator, which we don't read twice
+
+
+class Adapter(requests.adapters.HTTPAdapter):
+    """An HTTP adapter that adds every request it sends to the accounting."""
+
+    def send(self, request, **kwargs):
+        started_at = time.monotonic()
+        try:
+            response = super().send(request, **kwargs)
+        except requests.RequestException as ex:
+            exhausted = ex.args and isinstance(
+                ex.args[0], urllib3.exceptions.MaxRetryError
+            )
+            accounting.record(
+                request.url,
+                time.monotonic() - started_at,
+                bytes_sent=body_size(request.body),
+                retries=(self.max_retries.total or 0) if exhausted else 0,
+                error=True,
+            )
+            raise
+
+        retries = getattr(response.raw, "retries", None)
+        if kwargs.get("stream"):
+            received = int(response.headers.get("Content-Length", 0))
+        else:
+            received = len(response.content)
+        accounting.record(
+            request.url,
+            time.monotonic() - started_at,
+            bytes_sent=body_size(request.body),
+            bytes_received=received,
+            retries=len(retries.history) if retries is not None else 0,
+            error=not response.ok,
+        )
+        return response
+
+
+class TripCounter(pybreaker.CircuitBreakerListener):
+    """Count how many times a circuit breaker opens."""
+
+    def state_change(self, cb, old_state, new_state):
+        if new_state.name == pybreaker.STATE_OPEN:
+            accounting.record_trip(cb.name or "unnamed")
@@ -1,19 +1,140 @@
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+import contextvars
+from itertools import chain, zip_longest
+import json
+import math
+import random
+import threading
 import time
+import traceback
 
+import attr
 import click
 import pybreaker
 import requests
+import websocket
 
-from . import deployment, settings
+from . import deployment, rancher, settings
 from .exc import UpgradeFailed
+from .stats import recorder
+from .tracing import tracer
 
+CONTAINER_START_SECONDS = 5  # rough guess of how long Rancher needs per batch
+MIN_POLL_INTERVAL = 1
+MAX_POLL_INTERVAL = 30
 
+
+@attr.s(slots=True)
+class PollScheduler:
+    """Tell how long to sleep between checks on an ongoing upgrade.
+
+    The first interval is guessed from how long Rancher needs for the batches,
+    and it grows while nothing changes, so slow upgrades don't hammer the API.
+    A bit of jitter keeps parallel crane jobs from polling in lockstep.
+    """
+
+    base_interval = attr.ib()
+    deadline = attr.ib(default=None)
+    factor = attr.ib(default=1.5)
+    jitter = attr.ib(default=0.1)
+    interval = attr.ib(default=None)
+
+    def __attrs_post_init__(self):
+        self.interval = self.base_interval
+
+    @classmethod
+    def from_settings(cls, scale=1):
+        batches = math.ceil(max(scale, 1) / max(settings["batch_size"], 1))
+        expected_seconds = batches * (
+            settings["batch_interval"] + CONTAINER_START_SECONDS
+        )
+        timeout = settings["upgrade_timeout"]
+        return cls(
+            base_interval=min(
+                max(expected_seconds / 4, MIN_POLL_INTERVAL), MAX_POLL_INTERVAL / 3
+            ),
+            deadline=time.monotonic() + timeout if timeout else None,
+        )
+
+    @property
+    def remaining(self):
+        if self.deadline is None:
+            return math.inf
+        return max(self.deadline - time.monotonic(), 0)
+
+    @property
+    def is_expired(self):
+        return self.remaining <= 0
+
+    def delay(self):
+        jittered = self.interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+        return min(jittered, self.remaining)
+
+    def record(self, progressed):
+        if progressed:
+            self.interval = self.base_interval
+        else:
+            self.interval = min(self.interval * self.factor, MAX_POLL_INTERVAL)
+
+
+def run_in_threads(function, arguments, workers):
+    """Call the function with each of the argument tuples in a thread pool.
+
+    The futures are returned in the same order, once every call has settled.
+    The threads carry on the caller's context, so their spans nest under the caller's.
+    """
+    with ThreadPoolExecutor(
+        max_workers=max(workers, 1), thread_name_prefix="crane-rancher"
+    ) as executor:
+        return [
+            executor.submit(contextvars.copy_context().run, function, *args)
+            for args in arguments
+        ]
+
+
+@tracer.traced("upgrade.lookup")
+def lookup(targets):
+    """Find the stacks and services to upgrade, listing the stacks concurrently.
+
+    ``targets`` is a list of stack names, each paired with its service names.
+    A stack listed more than once is looked up once, with all of its services.
+    """
+    services_by_stack = {}
+    for name, service_names in targets:
+        services_by_stack.setdefault(name, {}).update(dict.fromkeys(service_names))
+    targets = [(name, tuple(names)) for name, names in services_by_stack.items()]
+
+    stacks = rancher.Stack.from_names([name for name, _ in targets])
+    futures = run_in_threads(
+        lambda stack, names: stack.services_from_names(names, len(stacks) > 1),
+        [(stack, service_names) for stack, (_, service_names) in zip(stacks, targets)],
+        len(stacks),
+    )
+    return stacks, [service for future in futures for service in future.result()]
+
+
+@tracer.traced("upgrade.upgrade")
 def upgrade(services):
     click.echo("Alrighty, let's deploy! " + click.style("ᕕ( ᐛ )ᕗ", bold=True))
-    click.echo(f"(But please supervise me at {deployment.stack.web_url})")
+    click.echo(
+        "(But please supervise me at "
+        + ", ".join(stack.web_url for stack in deployment.stacks)
+        + ")"
+    )
 
-    service_start_upgrade(services)
-    wait_for_upgrade(services)
+    # read from the cached documents, before starting the upgrade invalidates them
+    scales = [service.scale for service in services]
+    with recorder.phase("start_upgrade"):
+        service_start_upgrade(services)
+    with recorder.phase("wait_for_upgrade"):
+        # the quickest service is the one we should not keep waiting
+        scheduler = PollScheduler.from_settings(min(scales))
+        if settings["watch_events"]:
+            wait_for_upgrade_events(services, scheduler)
+        else:
+            wait_for_upgrade(services, scheduler)
     after_upgrade(services)
 
 
@@ -23,54 +144,229 @@ def after_upgrade(services):
             f'Upgrade done, waiting {settings["sleep_after_upgrade"]}s as requested '
             + click.style("(ʃƪ˘･ᴗ･˘)", bold=True)
         )
-        time.sleep(settings["sleep_after_upgrade"])
+        with recorder.phase("sleep_after_upgrade"):
+            time.sleep(settings["sleep_after_upgrade"])
     if not settings["manual_finish"]:
-        service_finish_upgrade(services)
+        with recorder.phase("finish_upgrade"):
+            service_finish_upgrade(services)
 
 
-def wait_for_upgrade(services):
-    done = set()
+@tracer.traced("upgrade.wait_for_upgrade")
+def wait_for_upgrade(services, scheduler=None, done=None):
+    scheduler = scheduler or PollScheduler.from_settings()
+    done = set() if done is None else done
     while done != set(services):
-        time.sleep(3)
-        try:
-            check_state(services, done)
-        except requests.RequestException:
-            continue
-        except pybreaker.CircuitBreakerError:
-            click.secho(
-                "Rancher is unreachable! Please fix it for me "
-                + click.style("(´･ω･`)", bold=True),
-                fg="red",
-                err=True,
-            )
+        if scheduler.is_expired:
+            report_timeout(set(services) - done)
             raise UpgradeFailed()
 
+        time.sleep(scheduler.delay())
+        scheduler.record(progressed=poll(services, done))
+
+
+@tracer.traced("upgrade.wait_for_upgrade_events")
+def wait_for_upgrade_events(services, scheduler=None):
+    """Wait for the upgrade by listening to Rancher's events instead of polling.
+
+    If the event stream breaks, we carry on with polling where we left off.
+    """
+    scheduler = scheduler or PollScheduler.from_settings()
+    services_by_id = {service.id: service for service in services}
+    done = set()
+    try:
+        with closing(rancher.subscribe()) as events:
+            poll(services, done)  # some might have finished before we subscribed
+            while done != set(services):
+                if scheduler.is_expired:
+                    report_timeout(set(services) - done)
+                    raise UpgradeFailed()
+
+                events.settimeout(min(scheduler.remaining, MAX_POLL_INTERVAL))
+                try:
+                    event = json.loads(events.recv())
+                except websocket.WebSocketTimeoutException:
+                    poll(services, done)  # just to be sure we didn't miss anything
+                    continue
+                except ValueError:  # a close frame is received as ""
+                    raise websocket.WebSocketConnectionClosedException(
+                        "Rancher closed the event stream"
+                    )
+
+                service = services_by_id.get(event.get("resourceId"))
+                if event.get("name") != "resource.change" or service is None:
+                    continue
+                if service in done:
+                    continue
+                resource = event.get("data", {}).get("resource", {})
+                record_state(service, resource.get("state", "upgrading"), done)
+    except (websocket.WebSocketException, OSError):
+        click.secho(
+            "I lost track of Rancher's events, so I'll keep checking on the services myself.",
+            fg="yellow",
+            err=True,
+        )
+        wait_for_upgrade(services, scheduler, done)
+
+
+@tracer.traced("upgrade.poll")
+def poll(services, done):
+    """Check on the services once, returning whether any of them finished."""
+    done_count = len(done)
+    try:
+        check_state(services, done)
+    except requests.RequestException:
+        pass
+    except pybreaker.CircuitBreakerError:
+        report_unreachable()
+        raise UpgradeFailed()
+    return len(done) > done_count
+
+
+def report_unreachable():
+    click.secho(
+        "Rancher is unreachable! Please fix it for me "
+        + click.style("(´･ω･`)", bold=True),
+        fg="red",
+        err=True,
+    )
+
+
+def report_timeout(services):
+    click.secho(
+        f'The upgrade didn\'t finish in {settings["upgrade_timeout"]}s, '
+        + "these services are still upgrading: "
+        + ", ".join(service.log_name for service in services)
+        + " "
+        + click.style("(ಥ﹏ಥ)", bold=True),
+        fg="red",
+        err=True,
+    )
+
 
 def service_start_upgrade(services):
-    for service in services:
-        service.start_upgrade()
+    raise_for_unstarted(run_concurrently(services, "start_upgrade"))
 
 
 def service_finish_upgrade(services):
+    raise_for_unfinished(run_concurrently(services, "finish_upgrade"))
+
+
+def raise_for_unstarted(failed):
+    if failed:
+        click.secho(
+            "I couldn't start upgrading "
+            + ", ".join(service.log_name for service in failed)
+            + ", but everything else is upgrading now "
+            + click.style("(・_・;)", bold=True),
+            fg="red",
+            err=True,
+        )
+        raise UpgradeFailed()
+
+
+def raise_for_unfinished(failed):
+    if failed:
+        click.secho(
+            "I couldn't mark the upgrade of "
+            + ", ".join(service.log_name for service in failed)
+            + " as finished, please do it in Rancher "
+            + click.style("(・_・;)", bold=True),
+            fg="red",
+            err=True,
+        )
+        raise UpgradeFailed()
+
+
+def run_concurrently(services, method):
+    """Call the given method of every service, within the concurrency limits.
+
+    Without concurrency the first error is raised right away,
+    otherwise the services that failed are returned after every call settled.
+    """
+    per_stack = settings["parallelism"]
+    services_by_stack = defaultdict(list)
     for service in services:
-        service.finish_upgrade()
-
-
-def check_state(services, done):
-    for service in set(services) - done:
-        service_json = service.json()
-
-        if service_json["state"] != "upgrading":
-            click.echo(
-                f"Rancher says {service.log_name} is now '{service_json['state']}'."
-            )
-            done.add(service)
-            if service_json["state"] != "upgraded":
-                click.secho(
-                    f"But I don't know what {service.log_name}'s '{service_json['state']}' state means! "
-                    + "Please fix it for me "
-                    + click.style("(´;︵;`)", bold=True),
-                    fg="red",
-                    err=True,
-                )
-                raise UpgradeFailed()
+        services_by_stack[service.stack].append(service)
+
+    workers = per_stack * len(services_by_stack)
+    if settings["max_parallelism"]:
+        workers = min(workers, settings["max_parallelism"])
+
+    def call(service):
+        with tracer.span(f"service_{method}", service=service.id):
+            getattr(service, method)()
+
+    if workers <= 1:
+        for service in services:
+            call(service)
+        return []
+
+    limits = {
+        stack: threading.BoundedSemaphore(per_stack) for stack in services_by_stack
+    }
+
+    def limited_call(service):
+        with limits[service.stack]:
+            call(service)
+
+    # taking turns between stacks, so that no worker waits for a stack's limit
+    ordered = [
+        service
+        for service in chain.from_iterable(zip_longest(*services_by_stack.values()))
+        if service is not None
+    ]
+    futures = run_in_threads(limited_call, [(service,) for service in ordered], workers)
+    return collect_failures(ordered, [future.exception() for future in futures])
+
+
+def collect_failures(services, errors):
+    """Report the errors of the services that failed, and return those services."""
+    failed = []
+    for service, error in zip(services, errors):
+        if error is None:
+            continue
+        failed.append(service)
+        if not isinstance(error, UpgradeFailed):  # these have been reported already
+            click.secho(f"{service.log_name} blew up:", fg="red", err=True)
+            traceback.print_exception(type(error), error, error.__traceback__)
+    return failed
+
+
+@tracer.traced("upgrade.check_state")
+def check_state(services, done, states=None):
+    pending = set(services) - done
+    if states is None:
+        states = {}
+        stacks = {service.stack for service in pending}
+        futures = run_in_threads(
+            lambda stack: stack.service_states(),
+            [(stack,) for stack in stacks],
+            len(stacks),
+        )
+        for future in futures:
+            states.update(future.result())
+
+    for service in pending:
+        state = states.get(service.id)
+        if state is None:  # not listed for some reason, let's ask about it directly
+            state = service.json()["state"]
+
+        record_state(service, state, done)
+
+
+def record_state(service, state, done):
+    if state == "upgrading":
+        return
+
+    click.echo(f"Rancher says {service.log_name} is now '{state}'.")
+    done.add(service)
+    if state != "upgraded":
+        click.secho(
+            f"But I don't know what {service.log_name}'s '{state}' state means! "
+            + "Please fix it for me "
+            + click.style("(´;︵;`)", bold=True),
+            fg="red",
+            err=True,
+        )
+        raise UpgradeFailed()
+    recorder.record_service(service, recorder.since("start_upgrade"))
@@ -19,7 +19,12 @@ setup(
     packages=find_packages(),
     install_requires=install_requires,
     tests_require=tests_require,
-    entry_points={"console_scripts": "crane=crane.cli:main"},
+    entry_points={
+        "console_scripts": [
+            "crane=crane.cli:main",
+            "crane-flush-outbox=crane.cli:flush_outbox",
+        ]
+    },
     classifiers=[
         "Development Status :: 5 - Production/Stable",
         "Environment :: Console",
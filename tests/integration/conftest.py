@@ -1,10 +1,12 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import os
 import shutil
+import threading
 
 import git
 import pytest
 import tempfile
-from crane import deployment
+from crane import deployment, settings
 
 
 @pytest.fixture(autouse=True)
@@ -15,3 +17,96 @@ def gitlab_ci_env(monkeypatch):
     monkeypatch.setenv("CI_JOB_ID", "1234567")
     monkeypatch.setenv("CI_REGISTRY_IMAGE", "registry.example.com/foo/bar")
     monkeypatch.setenv("CI_ENVIRONMENT_NAME", "a-b/c-d")
+
+
+@pytest.fixture
+def upgrade_settings(monkeypatch):
+    """The settings the upgrade reads, as the CLI sets them by default."""
+    monkeypatch.setitem(settings, "parallelism", 1)
+    monkeypatch.setitem(settings, "max_parallelism", 0)
+    monkeypatch.setitem(settings, "batch_size", 1)
+    monkeypatch.setitem(settings, "batch_interval", 2)
+    monkeypatch.setitem(settings, "upgrade_timeout", 0)
+    monkeypatch.setitem(settings, "sleep_after_upgrade", 0)
+    monkeypatch.setitem(settings, "manual_finish", False)
+    monkeypatch.setitem(settings, "watch_events", False)
+
+
+class FakeStack:
+    def __init__(self):
+        self.services = []
+        self.list_count = 0
+
+    def service_states(self):
+        self.list_count += 1
+        return {service.id: service.state for service in self.services}
+
+
+class FakeService:
+    log_name = "service_log_name"
+
+    def __init__(self, state=None, stack=None):
+        self.id = str(id(self))
+        self.state = state
+        self.stack = stack or FakeStack()
+        self.stack.services.append(self)
+
+    def start_upgrade(self):
+        pass
+
+    def finish_upgrade(self):
+        pass
+
+    def json(self):
+        return {"state": self.state}
+
+
+class UpgradingService(FakeService):
+    """Reports being upgraded after being polled a given number of times."""
+
+    scale = 1
+
+    def __init__(self, polls, stack):
+        super().__init__("upgrading", stack)
+        self.polls = polls
+
+    def finish_upgrade(self):
+        self.finished = True
+
+
+class CountingStack(FakeStack):
+    def service_states(self):
+        for service in self.services:
+            service.polls -= 1
+            if service.polls <= 0:
+                service.state = "upgraded"
+        return super().service_states()
+
+
+class RecordingHandler(BaseHTTPRequestHandler):
+    def handle_request(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.server.received.append((self.command, self.path, body))
+        self.send_response(self.server.status)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"ok")
+
+    do_GET = do_POST = do_PUT = do_DELETE = handle_request
+
+    def log_message(self, *args):
+        return
+
+
+@pytest.fixture
+def http_server():
+    """A local HTTP server that records requests, and answers them with its status."""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), RecordingHandler)
+    server.received = []
+    server.status = 200
+    server.url = f"http://127.0.0.1:{server.server_port}"
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
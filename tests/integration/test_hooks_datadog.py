@@ -1,14 +1,19 @@
+import json
+import socket
+
 import git
 import pytest
 import tempfile
 import datadog
 from crane.hooks import datadog as uut
+from crane.hooks.outbox import fingerprint
 from crane import settings, Deployment
+from crane.stats import Recorder
 
 
 @pytest.fixture(autouse=True)
 def click_settings(monkeypatch):
-    monkeypatch.setitem(settings, "datadog_key", "")
+    monkeypatch.setitem(settings, "datadog_key", "dd-key")
 
 
 @pytest.fixture
@@ -49,3 +54,77 @@ def test_create_event(monkeypatch, mocker, repo, commits, event, text):
     fake_create.assert_called_with(
         title="foo/bar deployment", text=text, tags=tags, alert_type=event
     )
+
+
+def test_create_event_capped(monkeypatch, mocker, repo):
+    monkeypatch.setitem(settings, "max_changelog_commits", 2)
+    old_version = repo.head.commit.hexsha
+    for commit in ["1", "2", "3"]:
+        repo.index.commit(commit)
+
+    fake_create = mocker.patch.object(datadog.api.Event, "create")
+    fake_deployment = Deployment(repo=repo, new_version="HEAD", old_version=old_version)
+    monkeypatch.setattr(uut, "deployment", fake_deployment)
+
+    uut.Hook().after_upgrade_success()
+    assert fake_create.call_args[1]["text"] == "2\n3\n+1 more of 3 commits"
+
+
+def test_send_metrics(monkeypatch, mocker, repo):
+    listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    listener.bind(("127.0.0.1", 0))
+    listener.settimeout(5)
+    monkeypatch.setitem(
+        settings, "statsd_host", f"127.0.0.1:{listener.getsockname()[1]}"
+    )
+    monkeypatch.setitem(settings, "datadog_key", "")
+
+    fake_recorder = Recorder(started_at=0)
+    fake_recorder.phases["start_upgrade"] = 0.5
+    fake_recorder.record_hook("slack", "before_upgrade", 0.25)
+    fake_recorder.count("rancher_requests", 7)
+    monkeypatch.setattr(uut, "recorder", fake_recorder)
+    monkeypatch.setattr(
+        uut, "deployment", Deployment(repo=repo, new_version="HEAD", old_version="HEAD")
+    )
+    fake_create = mocker.patch.object(datadog.api.Event, "create")
+    close_socket = mocker.spy(datadog.DogStatsd, "close_socket")
+
+    hook = uut.Hook()
+    assert hook.is_active
+    hook.after_upgrade_success()
+    assert close_socket.call_count == 1
+
+    lines = []
+    while not any(line.startswith("crane.rancher.requests") for line in lines):
+        lines += listener.recv(65535).decode().splitlines()
+    listener.close()
+
+    metrics = [line.split("|#")[0] for line in lines if line.startswith("crane.")]
+    assert metrics[0] == "crane.deploy:1|c"
+    assert metrics[1].startswith("crane.deploy.duration:")
+    assert metrics[2:] == [
+        "crane.upgrade.start_upgrade:500.0|ms",
+        "crane.hook.duration:250.0|ms",
+        "crane.rancher.requests:7|c",
+    ]
+    assert "project:foo/bar" in lines[0] and "status:success" in lines[0]
+    assert not fake_create.called  # no API key, so no event
+
+
+def test_create_event_spools_without_key(monkeypatch, mocker, repo, tmp_path):
+    monkeypatch.setitem(settings, "cache_dir", str(tmp_path))
+    mocker.patch.object(datadog.api.Event, "create", return_value={"errors": ["no"]})
+    monkeypatch.setattr(
+        uut, "deployment", Deployment(repo=repo, new_version="HEAD", old_version="HEAD")
+    )
+
+    uut.Hook().after_upgrade_success()
+
+    (path,) = (tmp_path / "outbox").iterdir()
+    entry = json.loads(path.read_text())
+    assert entry["url"] == "https://api.datadoghq.com/api/v1/events"
+    assert entry["credentials"] == {
+        "DD-API-KEY": {"setting": "datadog_key", "fingerprint": fingerprint("dd-key")}
+    }
+    assert "dd-key" not in path.read_text()
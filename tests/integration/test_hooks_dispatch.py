@@ -0,0 +1,163 @@
+import time
+
+import click
+import pytest
+
+from crane import hooks as uut, settings
+from crane.hooks import base
+from crane.hooks.base import Base
+from crane.stats import Recorder
+
+
+class SlowHook(Base):
+    is_active = True
+
+    def __init__(self, name, delay):
+        self.__module__ = f"tests.{name}"  # to have nice names in the summary
+        self.name = name
+        self.delay = delay
+        self.events = []
+
+    def before_upgrade(self):
+        for index in range(3):
+            click.echo(f"{self.name} {index}")
+            time.sleep(self.delay)
+        self.events.append("before_upgrade")
+
+    def after_upgrade_success(self):
+        raise RuntimeError(f"{self.name} is broken")
+
+
+def set_up(hook, delay=0):
+    """A stand-in for a hook class, which returns the hook after a while."""
+
+    def hook_class():
+        time.sleep(delay)
+        return hook
+
+    hook_class.__module__ = hook.__module__
+    return hook_class
+
+
+@pytest.fixture(autouse=True)
+def click_settings(monkeypatch):
+    monkeypatch.setitem(settings, "hook_timeout", 0)
+    monkeypatch.setitem(settings, "hooks_timeout", 0)
+
+
+@pytest.fixture
+def hooks(monkeypatch):
+    hooks = [SlowHook("first", 0.05), SlowHook("second", 0.01)]
+    monkeypatch.setattr(uut, "HOOKS", [set_up(hook) for hook in hooks])
+    monkeypatch.setattr(uut, "WORKERS", [])
+    monkeypatch.setattr(uut.deployment, "is_limited", False)
+    yield hooks
+    monkeypatch.setitem(settings, "hook_timeout", 0)
+    monkeypatch.setitem(settings, "hooks_timeout", 0)
+    uut.drain()
+
+
+def test_dispatch_concurrently(capsys, hooks):
+    started_at = time.monotonic()
+    uut.dispatch("before_upgrade")
+
+    assert time.monotonic() - started_at < 0.05 * 3 + 0.01 * 3
+    assert all(hook.events == ["before_upgrade"] for hook in hooks)
+    assert capsys.readouterr().out == (
+        "first 0\nfirst 1\nfirst 2\nsecond 0\nsecond 1\nsecond 2\n"
+    )
+
+
+def test_dispatch_errors(capsys, hooks):
+    uut.dispatch("after_upgrade_success")
+
+    err = capsys.readouterr().err
+    assert err.count("couldn't handle after_upgrade_success") == 2
+    assert err.index("first is broken") < err.index("second is broken")
+
+
+def test_dispatch_hook_timeout(monkeypatch, capsys, hooks):
+    monkeypatch.setitem(settings, "hook_timeout", 0.1)
+    hooks[0].delay = 0.2
+
+    uut.dispatch("before_upgrade")
+    captured = capsys.readouterr()
+    assert captured.out == "second 0\nsecond 1\nsecond 2\n"
+    assert "moving on without them: first (before_upgrade)" in captured.err
+
+    monkeypatch.setitem(settings, "hook_timeout", 0)
+    uut.dispatch("before_upgrade")  # runs after the first event has finished
+    assert capsys.readouterr().out.startswith("first 0\nfirst 1\nfirst 2\n")
+    assert hooks[0].events == ["before_upgrade", "before_upgrade"]
+
+
+def test_dispatch_total_timeout(monkeypatch, capsys, hooks):
+    monkeypatch.setitem(settings, "hooks_timeout", 0.02)
+
+    uut.dispatch("before_upgrade")
+    assert "first (before_upgrade), second (before_upgrade)" in (
+        capsys.readouterr().err
+    )
+
+
+def test_dispatch_in_background(capsys, hooks):
+    started_at = time.monotonic()
+    uut.dispatch("before_upgrade", wait=False)
+    assert time.monotonic() - started_at < 0.01
+    assert hooks[0].events == []
+
+    uut.dispatch("after_upgrade_success")
+    assert all(hook.events == ["before_upgrade"] for hook in hooks)
+
+    captured = capsys.readouterr()
+    assert captured.out.count("first") == captured.out.count("second") == 3
+    assert captured.err.index("first is broken") < captured.err.index(
+        "second is broken"
+    )
+
+
+def test_drain(capsys, hooks):
+    uut.dispatch("before_upgrade", wait=False)
+    uut.drain()
+
+    assert all(hook.events == ["before_upgrade"] for hook in hooks)
+    assert capsys.readouterr().out.count("\n") == 6
+    assert uut.PENDING == []
+
+
+def test_only_active_hooks_are_recorded(monkeypatch, hooks):
+    fake_recorder = Recorder()
+    monkeypatch.setattr(base, "recorder", fake_recorder)
+    hooks[1].is_active = False
+
+    uut.dispatch("before_upgrade")
+
+    assert [(name, event) for name, event, _ in fake_recorder.hooks] == [
+        ("first", "before_upgrade")
+    ]
+
+
+def test_hooks_are_set_up_in_the_background(monkeypatch, capsys, hooks):
+    monkeypatch.setitem(settings, "hook_timeout", 0.1)
+    slow, broken = SlowHook("slow", 0), SlowHook("broken", 0)
+    slow_class = set_up(slow, delay=0.2)
+
+    def broken_class():
+        raise RuntimeError("no config")
+
+    broken_class.__module__ = broken.__module__
+    monkeypatch.setattr(uut, "HOOKS", [slow_class, broken_class])
+
+    started_at = time.monotonic()
+    uut.dispatch("before_upgrade", wait=False)
+    assert time.monotonic() - started_at < 0.05
+
+    uut.dispatch("after_upgrade_success")  # the slow one is still setting up
+    captured = capsys.readouterr()
+    assert "moving on without them: slow (after_upgrade_success)" in captured.err
+    assert "I cannot load the 'tests.broken' hook!" in captured.err
+    assert "no config" in captured.err
+
+    monkeypatch.setitem(settings, "hook_timeout", 0)
+    uut.drain()
+    assert slow.events == ["before_upgrade"]
@@ -0,0 +1,137 @@
+import base64
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import time
+
+import pytest
+
+from crane import settings
+from crane.hooks import prometheus as uut
+from crane.stats import Recorder
+
+FakeStack = namedtuple("FakeStack", "name")
+FakeService = namedtuple("FakeService", "name stack")
+FakeDeployment = namedtuple("FakeDeployment", "stacks")
+
+
+@pytest.fixture(autouse=True)
+def fake_release(monkeypatch):
+    stack = FakeStack("my-app")
+    monkeypatch.setattr(uut, "deployment", FakeDeployment([stack]))
+
+    recorder = Recorder()
+    recorder.phases["wait_for_upgrade"] = 42.5
+    recorder.record_service(FakeService("api", stack), 40)
+    recorder.record_hook("slack", "before_upgrade", 0.25)
+    recorder.count("rancher_requests", 7)
+    monkeypatch.setattr(uut, "recorder", recorder)
+    return recorder
+
+
+def test_textfile(monkeypatch, fake_release, tmp_path):
+    path = tmp_path / "crane.prom"
+    monkeypatch.setitem(settings, "prometheus_textfile", str(path))
+    fake_release.started_at = time.monotonic() - 100
+
+    hook = uut.Hook()
+    assert hook.is_active
+    hook.after_upgrade_success()
+    hook.after_upgrade_failure()
+    hook.after_upgrade_success()
+
+    labels = 'project="foo/bar",environment="a-b/c-d"'
+    lines = path.read_text().splitlines()
+    assert "# TYPE crane_deploy_duration_seconds histogram" in lines
+    assert (
+        f'crane_deploy_duration_seconds_bucket{{{labels},stack="my-app",status="success",le="60"}} 0'
+        in lines
+    )
+    assert (
+        f'crane_deploy_duration_seconds_bucket{{{labels},stack="my-app",status="success",le="120"}} 2'
+        in lines
+    )
+    assert (
+        f'crane_deploy_duration_seconds_count{{{labels},stack="my-app",status="success"}} 2'
+        in lines
+    )
+    assert f'crane_deploys_total{{{labels},stack="my-app",status="success"}} 2' in lines
+    assert f'crane_deploys_total{{{labels},stack="my-app",status="failure"}} 1' in lines
+    assert f"crane_rancher_requests_total{{{labels}}} 21" in lines
+    assert (
+        f'crane_service_upgrade_seconds{{{labels},stack="my-app",service="api"}} 40'
+        in lines
+    )
+    assert (
+        f'crane_upgrade_phase_seconds{{{labels},phase="wait_for_upgrade"}} 42.5'
+        in lines
+    )
+    assert (
+        f'crane_hook_duration_seconds{{{labels},hook="slack",event="before_upgrade"}} 0.25'
+        in lines
+    )
+    assert not list(tmp_path.glob(".crane-*"))  # no temporary files left
+
+
+def test_textfile_failure(monkeypatch, mocker, tmp_path):
+    path = tmp_path / "crane.prom"
+    monkeypatch.setitem(settings, "prometheus_textfile", str(path))
+    mocker.patch("crane.store.os.replace", side_effect=OSError("read-only"))
+
+    with pytest.raises(OSError):
+        uut.Hook().after_upgrade_success()
+    assert sorted(child.name for child in tmp_path.iterdir()) == ["crane.prom.lock"]
+
+
+def test_pushgateway(monkeypatch, http_server):
+    monkeypatch.setitem(settings, "prometheus_pushgateway", http_server.url)
+
+    uut.Hook().after_upgrade_failure()
+
+    ((method, path, body),) = http_server.received
+    assert method == "PUT"
+    project, environment = [
+        base64.urlsafe_b64encode(value).decode() for value in [b"foo/bar", b"a-b/c-d"]
+    ]
+    assert path == (
+        f"/metrics/job/crane/project@base64/{project}/environment@base64/{environment}"
+    )
+    text = body.decode()
+    assert (
+        'crane_deploys_total{project="foo/bar",environment="a-b/c-d",stack="my-app",status="failure"} 1\n'
+        in text
+    )
+    assert "crane_deploy_duration_seconds" not in text  # the clock didn't start
+
+
+def test_pushgateway_error(monkeypatch, http_server):
+    monkeypatch.setitem(settings, "prometheus_pushgateway", http_server.url)
+    http_server.status = 400
+
+    with pytest.raises(uut.requests.HTTPError):
+        uut.Hook().after_upgrade_success()
+
+
+def test_textfile_without_pushgateway(monkeypatch, http_server, tmp_path):
+    path = tmp_path / "crane.prom"
+    monkeypatch.setitem(settings, "prometheus_textfile", str(path))
+    monkeypatch.setitem(settings, "prometheus_pushgateway", http_server.url)
+    http_server.status = 503
+
+    with pytest.raises(uut.requests.HTTPError):
+        uut.Hook().after_upgrade_success()
+    assert "crane_deploys_total" in path.read_text()
+
+
+def test_textfile_concurrent_writes(monkeypatch, tmp_path):
+    path = tmp_path / "crane.prom"
+    monkeypatch.setitem(settings, "prometheus_textfile", str(path))
+
+    with ThreadPoolExecutor(8) as pool:
+        list(pool.map(lambda _: uut.Hook().after_upgrade_success(), range(16)))
+
+    labels = 'project="foo/bar",environment="a-b/c-d",stack="my-app",status="success"'
+    assert f"crane_deploys_total{{{labels}}} 16" in path.read_text().splitlines()
+
+
+def test_inactive():
+    assert not uut.Hook().is_active
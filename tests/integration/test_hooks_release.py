@@ -0,0 +1,81 @@
+import json
+import tempfile
+
+import git
+from git import Actor
+import pytest
+
+from crane import Deployment, settings
+from crane.models import Changes
+from crane.hooks import release as uut, sentry, webhook
+
+
+@pytest.fixture(autouse=True)
+def click_settings(monkeypatch):
+    monkeypatch.setitem(settings, "sentry_webhook", "https://sentry.example.com/hook")
+    monkeypatch.setitem(
+        settings,
+        "webhook_url",
+        ["https://one.example.com/hook", "https://two.example.com/hook"],
+    )
+    monkeypatch.setitem(settings, "webhook_token", "secret")
+
+
+@pytest.fixture
+def fake_deployment(monkeypatch):
+    with tempfile.TemporaryDirectory() as repo_dir:
+        repo = git.Repo.init(repo_dir)
+        old_version = repo.index.commit("Initial commit").hexsha
+        for message in ["1", "2"]:
+            repo.index.commit(message, author=Actor("test_author", "test@test.com"))
+
+        fake_deployment = Deployment(
+            repo=repo, old_version=old_version, new_version="HEAD"
+        )
+        for module in (uut, sentry, webhook):
+            monkeypatch.setattr(module, "deployment", fake_deployment)
+        yield fake_deployment
+
+
+def test_body(fake_deployment):
+    body = json.loads(uut.body({"version": "v2"}))
+    assert body["version"] == "v2"
+    assert [commit["message"] for commit in body["commits"]] == ["1", "2"]
+    assert body["commits"][0]["author_email"] == "test@test.com"
+
+    assert json.loads(uut.body({}, with_commits=False)) == {"commits": []}
+
+
+def test_commits_are_encoded_once(requests_mock, mocker, fake_deployment):
+    for url in ["https://sentry.example.com/hook/", *settings["webhook_url"]]:
+        requests_mock.post(url)
+    spy = mocker.spy(uut, "commit_data")
+
+    sentry.Hook().after_upgrade_success()
+    webhook.Hook().after_upgrade_success()
+
+    assert spy.call_count == 2
+    sentry_body, *webhook_bodies = [
+        request.json() for request in requests_mock.request_history
+    ]
+    assert sentry_body["commits"] == webhook_bodies[0]["commits"]
+    assert webhook_bodies[0] == webhook_bodies[1]
+    assert webhook_bodies[0]["status"] == "success"
+    assert webhook_bodies[0]["total_commits"] == 2
+
+
+def test_payload_cap(monkeypatch, mocker, fake_deployment):
+    monkeypatch.setitem(settings, "max_changelog_commits", 1)
+    monkeypatch.setitem(settings, "max_payload_commits", 2)
+    spy = mocker.spy(Changes, "from_range")
+
+    assert [commit.summary for commit in fake_deployment.commits] == ["2"]
+    body = json.loads(uut.body({}))
+    assert [commit["message"] for commit in body["commits"]] == ["1", "2"]
+    assert spy.call_count == 1
+    assert spy.call_args[1]["max_commits"] == 2
+
+    monkeypatch.setitem(settings, "max_payload_commits", 1)
+    fake_deployment.invalidate_changes()
+    body = json.loads(uut.body({}))
+    assert [commit["message"] for commit in body["commits"]] == ["2"]
@@ -35,6 +35,17 @@ def click_settings(monkeypatch):
     monkeypatch.setitem(settings, "stack", "asd")
 
 
+@pytest.fixture(autouse=True)
+def fresh_rate_limits(monkeypatch):
+    monkeypatch.setattr(uut, "_rate_limiters", {})
+
+
+def look_up_by_email(request, context):
+    if request.qs["email"] == ["jd@kiwi.com"]:
+        return {"ok": True, "user": {"id": "123"}}
+    return {"ok": False, "error": "users_not_found"}
+
+
 @pytest.fixture(autouse=True)
 def mock_slack_api(requests_mock):
     requests_mock.get(
@@ -42,7 +53,10 @@ def mock_slack_api(requests_mock):
         json={"members": [{"profile": {"email": "jd@kiwi.com"}, "id": "123"}]},
     )
     requests_mock.get(
-        "https://slack.com/api/channels.list",
+        "https://slack.com/api/users.lookupByEmail", json=look_up_by_email
+    )
+    requests_mock.get(
+        "https://slack.com/api/conversations.list",
         json={
             "channels": [{"name": "general", "id": "123"}, {"name": "team", "id": "42"}]
         },
@@ -79,14 +93,12 @@ def test_get_existing_message(monkeypatch, mocker, repo, slack_response, result)
 
     fake_response.json = lambda: {
         "messages": [
-            {"text": deployment_id, "attachments": [{"fields": []}]},
+            {"text": deployment_id, "ts": "1.2", "attachments": [{"fields": []}]},
             {"text": "colemak", "attachments": [{"fields": []}]},
         ]
     }
-    assert slack_hook.get_existing_message("123")["text"] == deployment_id
-    assert slack_hook.get_existing_message("123")["attachments"][0][
-        "fields"
-    ] == uut.AttachmentFields([])
+    assert slack_hook.get_existing_message("123").text == deployment_id
+    assert slack_hook.get_existing_message("123").fields == uut.AttachmentFields([])
 
 
 @pytest.mark.parametrize(["slack_response", "result"], [[{"messages": []}, None]])
@@ -111,14 +123,14 @@ def test_get_existing_messages(monkeypatch, mocker, repo, slack_response, result
 
     fake_response.json = lambda: {
         "messages": [
-            {"text": deployment_id, "attachments": [{"fields": []}]},
+            {"text": deployment_id, "ts": "1.2", "attachments": [{"fields": []}]},
             {"text": "colemak", "attachments": [{"fields": []}]},
         ]
     }
     messages = slack_hook.get_existing_messages()
     assert len(messages) == 2
-    assert messages["123"]["text"] == deployment_id
-    assert messages["asd"]["attachments"][0]["fields"] == uut.AttachmentFields([])
+    assert messages["123"].text == deployment_id
+    assert messages["asd"].fields == uut.AttachmentFields([])
 
 
 @pytest.mark.parametrize(
@@ -204,14 +216,11 @@ def test_get_changelog_redeploy(monkeypatch, repo):
 
 
 def test_get_changelog_rollback(monkeypatch, repo):
-    ts = datetime(2017, 1, 1, 0, 0, 0).isoformat()
-    old_version = repo.head.commit.hexsha
+    new_version = repo.head.commit.hexsha
     for commit in ["1"]:
-        repo.index.commit(
-            commit, author=Actor("test_author", "test@test.com"), commit_date=ts
-        )
+        repo.index.commit(commit, author=Actor("test_author", "test@test.com"))
 
-    fake_deployment = Deployment(repo=repo, new_version="HEAD", old_version=old_version)
+    fake_deployment = Deployment(repo=repo, new_version=new_version, old_version="HEAD")
     monkeypatch.setattr(uut, "deployment", fake_deployment)
     slack_hook = uut.Hook()
     slack_hook.users_by_email = {}
@@ -230,8 +239,6 @@ def test_get_changelog_rollback(monkeypatch, repo):
         [
             ["1"],
             {
-                "link_names": True,
-                "text": "",
                 "attachments": [
                     {
                         "fallback": "foo/bar release",
@@ -274,8 +281,11 @@ def test_generate_new_message(monkeypatch, repo, commits, expected):
     slack_hook.users_by_email = {"picky@kiwi.com": "@picky"}
 
     msg = slack_hook.generate_new_message()
-    expected["text"] = slack_hook.deployment_text
-    assert msg == expected
+    expected_attachment = dict(expected["attachments"][0])
+    expected_fields = expected_attachment.pop("fields")
+    assert msg.text == slack_hook.deployment_text
+    assert msg.attachment == expected_attachment
+    assert msg.fields == AttachmentFields(expected_fields)
 
 
 @pytest.mark.parametrize(
@@ -319,12 +329,23 @@ def test_send_message(monkeypatch, mocker, repo, message_title, url, result_mess
 
     slack_hook = uut.Hook()
     slack_hook.channel_ids = ["asd"]
-    slack_hook.send_message(
-        "asd", {"attachments": [{"fields": AttachmentFields([message_title])}]}
+    message = uut.Message(
+        text="",
+        attachment={},
+        fields=[message_title],
+        environments=uut.EnvironmentStatuses.parse(message_title["value"]),
     )
+    slack_hook.send_message("asd", message)
     base_data = {"token": "xoxp-123-456", "channel": "asd"}
     fake_post.assert_called_with(
-        url, data={**base_data, "attachments": result_message, "link_names": "1"}
+        url,
+        data={
+            **base_data,
+            "text": "",
+            "attachments": result_message,
+            "link_names": "1",
+        },
+        timeout=uut.transport.TIMEOUT,
     )
 
 
@@ -353,6 +374,7 @@ def test_send_reply(monkeypatch, mocker, repo, message_id, text):
             "reply_broadcast": "false",
             "link_names": "1",
         },
+        timeout=uut.transport.TIMEOUT,
     )
 
 
@@ -371,13 +393,18 @@ def test_set_status(monkeypatch, repo, environment_before, environment_after, ex
 
     fake_deployment = Deployment(repo=repo, new_version="HEAD", old_version=old_version)
     monkeypatch.setattr(uut, "deployment", fake_deployment)
-    message = {"attachments": [{"fields": {"Environment": environment_before}}]}
+    message = uut.Message(
+        text="",
+        attachment={},
+        fields=[{"title": "Environment", "value": environment_before, "short": True}],
+        environments=uut.EnvironmentStatuses.parse(environment_before),
+    )
 
     slack_hook = uut.Hook()
     slack_hook.channel_ids = ["asd"]
     slack_hook.set_status(message, environment_after)
 
-    assert message["attachments"][0]["fields"]["Environment"] == expected
+    assert message.environments.render() == expected
 
 
 def test_is_active__active():
@@ -407,3 +434,207 @@ def test_is_active__inactive(monkeypatch):
 
     slack_hook = uut.Hook()
     assert not slack_hook.is_active
+
+
+def test_load_workspace_data_paginates(monkeypatch, mocker, requests_mock, tmp_path):
+    monkeypatch.setitem(settings, "cache_dir", str(tmp_path))
+    requests_mock.get(
+        "https://slack.com/api/conversations.list",
+        [
+            {
+                "json": {
+                    "channels": [{"name": "general", "id": "123"}],
+                    "response_metadata": {"next_cursor": "page2"},
+                }
+            },
+            {"json": {"channels": [{"name": "team", "id": "42"}]}},
+        ],
+    )
+    fake_refresh = mocker.patch.object(uut.Directory, "refresh_in_background")
+
+    slack_hook = uut.Hook()
+
+    assert slack_hook.channel_ids == ["123", "42"]
+    assert requests_mock.request_history[1].qs["cursor"] == ["page2"]
+    lookups = [
+        request.qs["email"]
+        for request in requests_mock.request_history
+        if request.path == "/api/users.lookupbyemail"
+    ]
+    assert lookups == [["picky@kiwi.com"]]
+    assert fake_refresh.call_count == 1
+    assert (tmp_path / "slack-directory.json").exists()
+
+
+def test_load_workspace_data_from_cache(monkeypatch, requests_mock, tmp_path):
+    monkeypatch.setitem(settings, "cache_dir", str(tmp_path))
+    directory = uut.Directory.load(settings["slack_token"])
+    directory.refresh()
+    requests_mock.reset_mock()
+
+    slack_hook = uut.Hook()
+    assert slack_hook.users_by_email == {"jd@kiwi.com": "<@123>"}
+    assert slack_hook.channel_ids == ["123", "42"]
+    assert requests_mock.call_count == 0
+
+
+def test_directory_refresh_resumes(monkeypatch, requests_mock, tmp_path):
+    monkeypatch.setitem(settings, "cache_dir", str(tmp_path))
+    members = [
+        {"profile": {"email": f"{index}@kiwi.com"}, "id": str(index)}
+        for index in range(3)
+    ]
+    requests_mock.get(
+        "https://slack.com/api/users.list",
+        [
+            {
+                "json": {
+                    "members": members[:1],
+                    "response_metadata": {"next_cursor": "page2"},
+                }
+            },
+            {"exc": requests.exceptions.ConnectionError},  # as if crane exited
+        ],
+    )
+    with pytest.raises(requests.exceptions.ConnectionError):
+        uut.Directory.load(settings["slack_token"]).refresh()
+
+    directory = uut.Directory.load(settings["slack_token"])
+    assert directory.users == {"0@kiwi.com": "0"}
+    assert directory.cursor == "page2" and not directory.is_fresh
+
+    users_list = requests_mock.get(
+        "https://slack.com/api/users.list", json={"members": members[1:]}
+    )
+    directory.refresh()
+    assert users_list.last_request.qs["cursor"] == ["page2"]
+    directory = uut.Directory.load(settings["slack_token"])
+    assert directory.users == {f"{index}@kiwi.com": str(index) for index in range(3)}
+    assert directory.cursor is None and directory.is_fresh
+
+
+def test_directory_looks_up_users_at_once(mocker):
+    barrier = uut.threading.Barrier(3, timeout=5)
+
+    def look_up_user(email):
+        barrier.wait()  # only passes if all lookups run at the same time
+        return email.split("@")[0]
+
+    mocker.patch.object(uut.Directory, "look_up_user", side_effect=look_up_user)
+    directory = uut.Directory(settings["slack_token"])
+    directory.look_up_users(["a@kiwi.com", "b@kiwi.com", "c@kiwi.com"])
+    assert directory.users == {"a@kiwi.com": "a", "b@kiwi.com": "b", "c@kiwi.com": "c"}
+
+
+def test_existing_message_is_remembered(monkeypatch, requests_mock, tmp_path):
+    monkeypatch.setitem(settings, "cache_dir", str(tmp_path))
+    monkeypatch.setattr(uut.Directory, "refresh_in_background", lambda self: None)
+    requests_mock.post(
+        "https://slack.com/api/chat.postMessage", json={"ok": True, "ts": "1.2"}
+    )
+    uut.deployment.stack = rancher.Stack("0st0", "foo")
+    slack_hook = uut.Hook()
+    message = slack_hook.generate_new_message()
+    slack_hook.send_message("123", message)
+
+    history = requests_mock.get(
+        "https://slack.com/api/conversations.history",
+        json={
+            "messages": [
+                {
+                    "text": slack_hook.deployment_text,
+                    "ts": "1.2",
+                    "attachments": [{"fields": []}],
+                }
+            ]
+        },
+    )
+    later_hook = uut.Hook()  # as if in a later pipeline job
+    assert later_hook.get_existing_message("123").ts == "1.2"
+    assert history.call_count == 1
+    assert history.last_request.qs["latest"] == ["1.2"]
+    assert history.last_request.qs["limit"] == ["1"]
+
+    assert slack_hook.get_existing_message("123") is message
+    assert later_hook.get_existing_message("123").ts == "1.2"
+    assert history.call_count == 1  # both already know the message
+    stored = slack_hook.message_store.get(uut.deployment.id)
+    assert stored == {"123": "1.2"}
+    assert stored is not slack_hook.message_ids  # saved while other threads add to it
+
+
+def test_existing_message_search_is_bounded(mocker, requests_mock):
+    history = requests_mock.get(
+        "https://slack.com/api/conversations.history",
+        json={
+            "messages": [{"text": "other", "ts": "1.1"}] * uut.PAGE_SIZE,
+            "response_metadata": {"next_cursor": "more"},
+        },
+    )
+
+    with pytest.raises(KeyError):
+        uut.Hook().get_existing_message("123")
+    assert history.call_count == uut.MESSAGE_SEARCH_LIMIT / uut.PAGE_SIZE
+    assert "oldest" in history.last_request.qs
+
+
+def test_api_call_retries_after(mocker, requests_mock):
+    fake_sleep = mocker.patch.object(uut.time, "sleep")
+    requests_mock.post(
+        "https://slack.com/api/chat.update",
+        [
+            {"status_code": 429, "headers": {"Retry-After": "2"}},
+            {"json": {"ok": True}},
+        ],
+    )
+
+    assert uut.api_call("chat.update", data={"channel": "42"}).json() == {"ok": True}
+    assert requests_mock.call_count == 2
+    assert requests_mock.last_request.timeout == uut.transport.TIMEOUT
+    assert fake_sleep.call_args[0][0] >= 2 - 0.1
+
+
+def test_rate_limiter(mocker):
+    fake_sleep = mocker.patch.object(uut.time, "sleep")
+    mocker.patch.object(uut.time, "monotonic", return_value=100)
+    limiter = uut.RateLimiter(20)
+
+    for _ in range(limiter.burst):
+        limiter.wait()
+    assert not fake_sleep.called
+
+    limiter.wait()
+    assert fake_sleep.call_args[0][0] == 3  # 20 calls a minute are 3 seconds apart
+
+
+def test_send_message_skips_unchanged(mocker):
+    fake_post = mocker.patch.object(requests.Session, "post")
+    message = uut.Message.from_slack(
+        {
+            "text": "<deployment.com| >",
+            "ts": "1.2",
+            "attachments": [
+                {
+                    "color": "good",
+                    "fields": [
+                        {
+                            "title": "Environment",
+                            "value": ":white_check_mark: a-b/c-d",
+                            "short": True,
+                        }
+                    ],
+                }
+            ],
+        }
+    )
+    slack_hook = uut.Hook()
+
+    slack_hook.set_status(message, ":white_check_mark:")
+    slack_hook.send_message("42", message)
+    assert not fake_post.called
+
+    slack_hook.set_status(message, ":x:")
+    slack_hook.send_message("42", message)
+    slack_hook.send_message("42", message)
+    assert fake_post.call_count == 1
+    assert '"color": "danger"' in fake_post.call_args[1]["data"]["attachments"]
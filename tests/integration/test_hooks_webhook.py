@@ -0,0 +1,119 @@
+import base64
+import json
+import tempfile
+
+import git
+import pytest
+import requests
+
+from crane import Deployment, settings
+from crane.hooks import release, webhook as uut
+
+
+@pytest.fixture(autouse=True)
+def click_settings(monkeypatch):
+    monkeypatch.setitem(
+        settings,
+        "webhook_url",
+        [
+            "https://ok.example.com/hook?key=secret",
+            "https://flaky.example.com/hook",
+            "https://missing.example.com/hook",
+            "https://down.example.com/hook",
+        ],
+    )
+    monkeypatch.setitem(settings, "webhook_token", "secret")
+
+
+@pytest.fixture(autouse=True)
+def fake_deployment(monkeypatch):
+    with tempfile.TemporaryDirectory() as repo_dir:
+        repo = git.Repo.init(repo_dir)
+        old_version = repo.index.commit("Initial commit").hexsha
+        repo.index.commit("1")
+        fake_deployment = Deployment(
+            repo=repo, old_version=old_version, new_version="HEAD"
+        )
+        for module in (uut, release):
+            monkeypatch.setattr(module, "deployment", fake_deployment)
+        yield fake_deployment
+
+
+@pytest.fixture(autouse=True)
+def no_sleep(mocker):
+    mocker.patch("time.sleep")
+
+
+@pytest.fixture
+def endpoints(requests_mock):
+    return {
+        "ok": requests_mock.post("https://ok.example.com/hook"),
+        "flaky": requests_mock.post(
+            "https://flaky.example.com/hook",
+            [{"status_code": 502}, {"status_code": 204}],
+        ),
+        "missing": requests_mock.post(
+            "https://missing.example.com/hook", status_code=404
+        ),
+        "down": requests_mock.post(
+            "https://down.example.com/hook", exc=requests.exceptions.ConnectTimeout
+        ),
+    }
+
+
+@pytest.mark.parametrize(
+    ["event", "status"],
+    [
+        ["before_upgrade", "started"],
+        ["after_upgrade_success", "success"],
+        ["after_upgrade_failure", "failure"],
+    ],
+)
+def test_send(capsys, endpoints, event, status):
+    getattr(uut.Hook(), event)()
+
+    assert endpoints["ok"].last_request.json()["status"] == status
+    assert endpoints["ok"].last_request.headers["Auth-Token"] == "secret"
+    assert endpoints["flaky"].call_count == 2
+    assert endpoints["missing"].call_count == 1
+    assert endpoints["down"].call_count == 3
+
+    captured = capsys.readouterr()
+    assert "Webhook https://ok.example.com/hook responded with 200" in captured.out
+    assert "https://flaky.example.com/hook responded with 204" in captured.out
+    assert "Webhook https://missing.example.com/hook failed" in captured.err
+    assert "Webhook https://down.example.com/hook failed" in captured.err
+    assert "key=secret" not in captured.out + captured.err
+
+
+def test_send_reports_deliveries(endpoints):
+    deliveries = uut.Hook().send("success")
+
+    assert [delivery.status_code for delivery in deliveries] == [200, 204, 404, None]
+    assert all(delivery.duration >= 0 for delivery in deliveries)
+    assert isinstance(deliveries[3].error, requests.exceptions.ConnectTimeout)
+
+
+def test_send_spools_failures(monkeypatch, tmp_path, endpoints):
+    monkeypatch.setitem(settings, "cache_dir", str(tmp_path))
+
+    uut.Hook().send("success")
+
+    entries = [json.loads(path.read_text()) for path in (tmp_path / "outbox").iterdir()]
+    assert [entry["url"] for entry in entries] == ["https://down.example.com/hook"]
+
+
+def test_send_replaces_saved_statuses(monkeypatch, requests_mock, tmp_path, endpoints):
+    monkeypatch.setitem(settings, "cache_dir", str(tmp_path))
+    uut.Hook().send("started")
+    uut.Hook().send("failure")
+
+    (path,) = (tmp_path / "outbox").iterdir()
+    assert (
+        json.loads(base64.b64decode(json.loads(path.read_text())["body"]))["status"]
+        == "failure"
+    )
+
+    requests_mock.post("https://down.example.com/hook")  # up again
+    uut.Hook().send("success")
+    assert list((tmp_path / "outbox").iterdir()) == []
@@ -0,0 +1,139 @@
+from concurrent.futures import ThreadPoolExecutor
+import tempfile
+
+import git
+import pytest
+
+from crane import Deployment, models, settings
+from crane.models import iter_commits
+
+
+@pytest.fixture
+def repo():
+    with tempfile.TemporaryDirectory() as repo_dir:
+        repo = git.Repo.init(repo_dir)
+        repo.index.commit("Initial commit")
+        yield repo
+
+
+def test_changes_are_analyzed_once(mocker, repo):
+    old_version = repo.head.commit.hexsha
+    for message in ["1", "2"]:
+        repo.index.commit(message)
+    spy = mocker.spy(models, "classify")
+    deployment = Deployment(repo=repo, old_version=old_version, new_version="HEAD")
+
+    for _ in range(3):
+        assert [commit.summary for commit in deployment.commits] == ["1", "2"]
+        assert not deployment.is_rollback
+        assert not deployment.is_disconnected
+    assert spy.call_count == 1
+    assert deployment.changes is deployment.changes
+
+
+def test_changes_are_analyzed_once_across_threads(mocker, repo):
+    old_version = repo.head.commit.hexsha
+    repo.index.commit("1")
+    spy = mocker.spy(models.Changes, "from_range")
+    deployment = Deployment(repo=repo, old_version=old_version, new_version="HEAD")
+
+    with ThreadPoolExecutor(4) as pool:
+        results = list(pool.map(lambda _: deployment.changes, range(4)))
+
+    assert spy.call_count == 1
+    assert all(changes is results[0] for changes in results)
+
+
+def test_changes_follow_versions(repo):
+    old_version = repo.head.commit.hexsha
+    repo.index.commit("1")
+    deployment = Deployment(repo=repo, old_version=old_version, new_version="HEAD")
+    changes = deployment.changes
+
+    deployment.new_version = old_version
+    assert deployment.changes is not changes
+    assert deployment.commits == ()
+
+    changes = deployment.changes
+    deployment.invalidate_changes()
+    assert deployment.changes is not changes
+    assert deployment.changes == changes
+
+
+def test_iter_commits_matches_gitpython(repo):
+    repo.index.commit("Add feature\n\nWith a longer description.\n")
+    repo.index.commit("Fix ümlaut", commit_date="2019-02-01T10:00:00 +0130")
+
+    commits = list(iter_commits(repo, "HEAD"))
+    expected = list(repo.iter_commits("HEAD"))
+    assert [commit.hexsha for commit in commits] == [c.hexsha for c in expected]
+    for commit, original in zip(commits, expected):
+        assert commit.parents == tuple(parent.hexsha for parent in original.parents)
+        assert commit.author_name == original.author.name
+        assert commit.author_email == original.author.email
+        assert commit.committed_date == original.committed_date
+        assert commit.committer_tz_offset == original.committer_tz_offset
+        assert commit.message == original.message
+        assert commit.summary == original.summary
+
+
+def test_changes_direction(repo):
+    base = repo.head.commit.hexsha
+    first = repo.index.commit("1").hexsha
+    second = repo.index.commit("2").hexsha
+    repo.head.reset(base, index=True)
+    branch = repo.index.commit("elsewhere").hexsha
+
+    def direction(old_version, new_version):
+        return models.Changes.from_range(repo, old_version, new_version).direction
+
+    assert direction(base, second) == models.FORWARD
+    assert direction(second, first) == models.ROLLBACK
+    assert direction(second, second) == models.REDEPLOY
+    assert direction(second, branch) == models.DISCONNECTED
+    assert direction("0" * 40, second) == models.DISCONNECTED
+
+    rollback = models.Changes.from_range(repo, second, base)
+    assert [commit.summary for commit in rollback.commits] == ["2", "1"]
+
+
+def test_changes_direction_cache(monkeypatch, mocker, tmp_path, repo):
+    monkeypatch.setitem(settings, "cache_dir", str(tmp_path))
+    old_version = repo.head.commit.hexsha
+    new_version = repo.index.commit("1").hexsha
+    spy = mocker.spy(models.git.Git, "_call_process")
+
+    models.Changes.from_range(repo, old_version, new_version)
+    assert [call[0][1] for call in spy.call_args_list] == ["merge_base", "log"]
+
+    spy.reset_mock()
+    changes = models.Changes.from_range(repo, old_version, new_version)
+    assert changes.direction == models.FORWARD
+    assert [call[0][1] for call in spy.call_args_list] == ["log"]
+    assert (tmp_path / "ancestry.json").exists()
+
+
+@pytest.mark.parametrize(
+    ["max_commits", "forward", "rollback", "total"],
+    [
+        [0, ["1", "2", "3"], ["3", "2", "1"], 3],
+        [2, ["2", "3"], ["3", "2"], 3],
+        [3, ["1", "2", "3"], ["3", "2", "1"], 3],
+    ],
+)
+def test_changes_cap(repo, max_commits, forward, rollback, total):
+    old_version = repo.head.commit.hexsha
+    for message in ["1", "2", "3"]:
+        repo.index.commit(message)
+    new_version = repo.head.commit.hexsha
+
+    for old, new, expected in [
+        (old_version, new_version, forward),
+        (new_version, old_version, rollback),
+    ]:
+        changes = models.Changes.from_range(repo, old, new, max_commits=max_commits)
+        assert [commit.summary for commit in changes.commits] == expected
+        assert changes.total_commits == total
+        assert changes.hidden_commits == total - len(expected)
+        everything = models.Changes.from_range(repo, old, new)
+        assert everything.latest(max_commits) == changes.commits
@@ -0,0 +1,126 @@
+import json
+import os
+import stat
+
+import pytest
+import requests
+
+from crane import settings
+from crane.hooks import outbox as uut
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(monkeypatch, tmp_path):
+    monkeypatch.setitem(settings, "cache_dir", str(tmp_path))
+    return tmp_path
+
+
+def spool(url, token="secret"):
+    request = requests.Request(
+        "POST", url, headers={"Auth-Token": token}, json={"status": "success"}
+    )
+    assert uut.spool("webhook", request)
+
+
+def test_spool(cache_dir):
+    spool("https://example.com/hook")
+
+    (path,) = (cache_dir / "outbox").iterdir()
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+    entry = json.loads(path.read_text())
+    assert entry["url"] == "https://example.com/hook"
+    assert entry["headers"]["Auth-Token"] == "secret"
+    assert entry["attempts"] == 0
+
+
+def test_spool_without_cache_dir(monkeypatch):
+    monkeypatch.setitem(settings, "cache_dir", "")
+    assert not uut.spool("webhook", requests.Request("POST", "https://example.com"))
+
+
+def test_flush(requests_mock, cache_dir):
+    for index in range(3):
+        spool(f"https://ok.example.com/{index}")
+    spool("https://gone.example.com/hook")
+    ok = requests_mock.post("https://ok.example.com/0")
+    ok_others = [
+        requests_mock.post(f"https://ok.example.com/{index}") for index in (1, 2)
+    ]
+    gone = requests_mock.post("https://gone.example.com/hook", status_code=404)
+
+    assert uut.flush(batch_size=2) == {"sent": 3, "dropped": 1, "kept": 0}
+    assert ok.last_request.json() == {"status": "success"}
+    assert ok.last_request.headers["Auth-Token"] == "secret"
+    assert all(matcher.call_count == 1 for matcher in [ok, *ok_others, gone])
+    assert list((cache_dir / "outbox").iterdir()) == []
+
+
+def test_flush_keeps_failures(requests_mock, cache_dir):
+    spool("https://down.example.com/hook")
+    spool("https://later.example.com/hook")
+    requests_mock.post("https://down.example.com/hook", status_code=503)
+    later = requests_mock.post("https://later.example.com/hook")
+
+    assert uut.flush(batch_size=1) == {"sent": 0, "dropped": 0, "kept": 1}
+    assert later.call_count == 0  # waits while the first batch fails
+
+    path, _ = sorted((cache_dir / "outbox").iterdir())
+    assert json.loads(path.read_text())["attempts"] == 1
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+
+    requests_mock.post("https://down.example.com/hook")
+    assert uut.flush() == {"sent": 2, "dropped": 0, "kept": 0}
+
+
+def test_flush_skips_claimed(requests_mock, cache_dir):
+    spool("https://example.com/hook")
+    (path,) = (cache_dir / "outbox").iterdir()
+    path.rename(f"{path}.1234.claimed")  # another crane run is sending it
+
+    assert uut.flush() == {"sent": 0, "dropped": 0, "kept": 0}
+    assert requests_mock.call_count == 0
+
+
+def test_spool_replaces_superseded(cache_dir):
+    for status in ["started", "failure"]:
+        request = requests.Request(
+            "POST", "https://example.com", json={"status": status}
+        )
+        assert uut.spool("webhook", request, key="release")
+    spool("https://example.com/other")
+
+    entries = [
+        json.loads(path.read_text()) for path in (cache_dir / "outbox").iterdir()
+    ]
+    assert sorted(entry["key"] or "" for entry in entries) == ["", "release"]
+
+    uut.supersede("release")
+    (path,) = (cache_dir / "outbox").iterdir()
+    assert json.loads(path.read_text())["url"] == "https://example.com/other"
+
+
+def test_flush_drops_expired(requests_mock, cache_dir):
+    request = requests.Request("POST", "https://example.com/hook", json={})
+    assert uut.spool("webhook", request, max_age=-1)
+
+    assert uut.flush() == {"sent": 0, "dropped": 1, "kept": 0}
+    assert requests_mock.call_count == 0
+
+
+def test_flush_adds_credentials(monkeypatch, requests_mock, cache_dir):
+    monkeypatch.setitem(settings, "datadog_key", "dd-key")
+    request = requests.Request("POST", "https://example.com/events", json={})
+    assert uut.spool("datadog", request, credentials={"DD-API-KEY": "datadog_key"})
+    (path,) = (cache_dir / "outbox").iterdir()
+    assert "dd-key" not in path.read_text()
+    events = requests_mock.post("https://example.com/events")
+
+    for other_key in [None, "other-project-key"]:
+        monkeypatch.setitem(settings, "datadog_key", other_key)
+        assert uut.flush() == {"sent": 0, "dropped": 0, "kept": 0}
+        assert list((cache_dir / "outbox").iterdir()) == [path]  # left for its owner
+    assert events.call_count == 0
+
+    monkeypatch.setitem(settings, "datadog_key", "dd-key")
+    assert uut.flush() == {"sent": 1, "dropped": 0, "kept": 0}
+    assert events.last_request.headers["DD-API-KEY"] == "dd-key"
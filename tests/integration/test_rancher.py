@@ -0,0 +1,185 @@
+import pytest
+
+import crane.exc
+from crane import rancher as uut, settings
+
+
+@pytest.fixture(autouse=True)
+def click_settings(monkeypatch):
+    monkeypatch.setitem(settings, "url", "https://rancher.example.com")
+    monkeypatch.setitem(settings, "env", "1a81")
+    monkeypatch.setitem(settings, "batch_size", 1)
+    monkeypatch.setitem(settings, "batch_interval", 2)
+    monkeypatch.setitem(settings, "start_first", False)
+    monkeypatch.setitem(settings, "sidekick", None)
+    monkeypatch.setitem(settings, "new_image", "example/app:v2")
+
+
+@pytest.fixture(autouse=True)
+def empty_cache():
+    uut.cache.clear()
+    yield
+    uut.cache.clear()
+
+
+@pytest.fixture
+def stack():
+    return uut.Stack("1st551", "my-app")
+
+
+@pytest.fixture
+def service(stack):
+    return uut.Service("1s1", "api", stack)
+
+
+SERVICE_URL = "https://rancher.example.com/v1/projects/1a81/services/1s1"
+
+
+def test_service_states(requests_mock, stack):
+    requests_mock.get(
+        "https://rancher.example.com/v1/projects/1a81/services?stackId=1st551",
+        json={
+            "data": [
+                {"id": "1s1", "name": "api", "state": "upgrading"},
+                {"id": "1s2", "name": "worker", "state": "upgraded"},
+            ],
+            "pagination": {"next": "https://rancher.example.com/page2"},
+        },
+    )
+    requests_mock.get(
+        "https://rancher.example.com/page2",
+        json={"data": [{"id": "1s3", "name": "cron", "state": "active"}]},
+    )
+
+    assert stack.service_states() == {
+        "1s1": "upgrading",
+        "1s2": "upgraded",
+        "1s3": "active",
+    }
+    assert requests_mock.call_count == 2
+    assert requests_mock.request_history[1].qs == {}
+
+
+def test_json_revalidates_with_etag(requests_mock, service):
+    requests_mock.get(
+        SERVICE_URL,
+        [
+            {"json": {"state": "active"}, "headers": {"ETag": '"1"'}},
+            {"status_code": 304},
+        ],
+    )
+
+    assert service.json() == {"state": "active"}
+    assert service.json() == {"state": "active"}
+    assert requests_mock.call_count == 2
+    assert requests_mock.last_request.headers["If-None-Match"] == '"1"'
+
+
+def test_json_ttl_without_etag(requests_mock, mocker, service):
+    requests_mock.get(
+        SERVICE_URL, [{"json": {"state": "active"}}, {"json": {"state": "upgrading"}}]
+    )
+    fake_monotonic = mocker.patch.object(uut.time, "monotonic", return_value=100)
+
+    assert service.json() == {"state": "active"}
+    assert service.json() == {"state": "active"}
+    assert requests_mock.call_count == 1
+
+    fake_monotonic.return_value = 100 + uut.cache.ttl
+    assert service.json() == {"state": "upgrading"}
+    assert requests_mock.call_count == 2
+
+
+def test_start_upgrade_invalidates_cache(requests_mock, service):
+    requests_mock.get(
+        SERVICE_URL,
+        json={"state": "active", "launchConfig": {"imageUuid": "docker:app:v1"}},
+    )
+    requests_mock.post(SERVICE_URL, json={})
+
+    service.start_upgrade()
+    upgrade_request = requests_mock.request_history[1]
+    assert upgrade_request.json()["inServiceStrategy"]["launchConfig"] == {
+        "imageUuid": "docker:example/app:v2"
+    }
+    assert service.launch_config == {"imageUuid": "docker:app:v1"}
+    assert requests_mock.call_count == 3
+
+
+def test_service_states_updates_cache(requests_mock, stack, service):
+    requests_mock.get(SERVICE_URL, json={"state": "upgrading"})
+    requests_mock.get(
+        "https://rancher.example.com/v1/projects/1a81/services?stackId=1st551",
+        json={"data": [{"id": "1s1", "name": "api", "state": "upgraded"}]},
+    )
+
+    assert service.json()["state"] == "upgrading"
+    stack.service_states()
+    assert service.json()["state"] == "upgraded"
+    assert requests_mock.call_count == 2
+
+
+def test_services_from_names(requests_mock, stack):
+    requests_mock.get(
+        "https://rancher.example.com/v1/projects/1a81/services?stackId=1st551",
+        json={
+            "data": [
+                {"id": "1s1", "name": "api", "state": "active"},
+                {"id": "1s2", "name": "worker", "state": "active"},
+                {"id": "1s3", "name": "cron", "state": "active"},
+            ]
+        },
+    )
+
+    services = stack.services_from_names(["worker", "api"])
+    assert services == [
+        uut.Service("1s2", "worker", stack),
+        uut.Service("1s1", "api", stack),
+    ]
+    assert services[0].json()["state"] == "active"
+    assert requests_mock.call_count == 1
+    assert "worker" in services[0].log_name and "/" not in services[0].log_name
+
+    (service,) = stack.services_from_names(["api"], qualified=True)
+    assert f"{stack.name}/api" in service.log_name
+    assert service == uut.Service("1s1", "api", stack)
+
+
+def test_services_from_names_missing(requests_mock, mocker, stack):
+    requests_mock.get(
+        "https://rancher.example.com/v1/projects/1a81/services?stackId=1st551",
+        json={"data": [{"id": "1s1", "name": "api", "state": "active"}]},
+    )
+    fake_secho = mocker.patch.object(uut.click, "secho")
+
+    with pytest.raises(crane.exc.UpgradeFailed):
+        stack.services_from_names(["api", "worker", "cron"])
+
+    message = fake_secho.call_args[0][0]
+    assert "worker" in message and "cron" in message and "api" not in message
+
+
+def test_stacks_from_names(requests_mock, mocker):
+    requests_mock.get(
+        "https://rancher.example.com/v1/projects/1a81/environments",
+        json={
+            "data": [
+                {"id": "1e1", "name": "app-eu"},
+                {"id": "1e2", "name": "app-us"},
+                {"id": "1e3", "name": "other"},
+            ]
+        },
+    )
+    fake_secho = mocker.patch.object(uut.click, "secho")
+
+    assert uut.Stack.from_names(["app-us", "app-eu"]) == [
+        uut.Stack("1st2", "app-us"),
+        uut.Stack("1st1", "app-eu"),
+    ]
+    assert requests_mock.call_count == 1
+    assert uut.Stack.from_names(["app-eu", "app-eu"]) == [uut.Stack("1st1", "app-eu")]
+    assert requests_mock.last_request.qs["name"] == ["app-eu"]
+
+    with pytest.raises(crane.exc.UpgradeFailed):
+        uut.Stack.from_names(["app-eu", "app-asia"])
+    assert "app-asia" in fake_secho.call_args[0][0]
@@ -0,0 +1,98 @@
+import json
+
+import pytest
+
+from crane import settings, upgrade
+from crane.hooks.base import Base
+from crane.hooks.dispatcher import Worker, wait_for
+from crane.tracing import NOOP_SPAN, tracer
+
+from .conftest import CountingStack, UpgradingService
+
+pytestmark = pytest.mark.usefixtures("upgrade_settings")
+
+
+@pytest.fixture
+def enabled(monkeypatch):
+    monkeypatch.setattr(tracer, "enabled", True)
+    monkeypatch.setattr(tracer, "spans", [])
+
+
+class TracedService(UpgradingService):
+    def start_upgrade(self):
+        with tracer.span("rancher.json", entity=self.id):
+            pass
+
+
+def spans_by_name():
+    return {span.name: span for span in tracer.spans}
+
+
+def test_disabled(mocker):
+    mocker.patch.object(upgrade, "deployment")
+    mocker.patch.object(upgrade.PollScheduler, "delay", return_value=0)
+    spans = list(tracer.spans)
+
+    assert tracer.span("main") is NOOP_SPAN
+    upgrade.upgrade([TracedService(1, CountingStack())])
+    assert tracer.spans == spans
+
+
+def test_upgrade(monkeypatch, mocker, enabled, tmp_path):
+    monkeypatch.setitem(settings, "parallelism", 2)  # to start it on a worker thread
+    mocker.patch.object(upgrade, "deployment")
+    mocker.patch.object(upgrade.PollScheduler, "delay", return_value=0)
+    service = TracedService(1, CountingStack())
+
+    with tracer.span("main"):
+        upgrade.upgrade([service])
+
+    spans = spans_by_name()
+    assert spans["rancher.json"].parent_id == spans["service_start_upgrade"].span_id
+    assert spans["service_start_upgrade"].thread != spans["start_upgrade"].thread
+    assert spans["service_start_upgrade"].attributes == {"service": service.id}
+    assert spans["service_start_upgrade"].parent_id == spans["start_upgrade"].span_id
+    for name in ["start_upgrade", "wait_for_upgrade", "finish_upgrade"]:
+        assert spans[name].parent_id == spans["upgrade.upgrade"].span_id
+    assert spans["upgrade.upgrade"].parent_id == spans["main"].span_id
+    assert spans["upgrade.poll"].parent_id == spans["upgrade.wait_for_upgrade"].span_id
+
+    tracer.write(tmp_path / "trace.json")
+    trace = json.loads((tmp_path / "trace.json").read_text())
+    assert trace["trace_id"] == tracer.trace_id
+    assert trace["spans"][0]["name"] == "main"
+    assert trace["spans"][0]["duration"] > 0
+
+    tracer.write(tmp_path / "trace.otlp.json", "otlp")
+    trace = json.loads((tmp_path / "trace.otlp.json").read_text())
+    (resource_spans,) = trace["resourceSpans"]
+    (scope_spans,) = resource_spans["scopeSpans"]
+    otlp_spans = {span["name"]: span for span in scope_spans["spans"]}
+    assert otlp_spans["rancher.json"]["parentSpanId"] == (
+        otlp_spans["service_start_upgrade"]["spanId"]
+    )
+    assert "parentSpanId" not in otlp_spans["main"]
+    assert otlp_spans["main"]["traceId"] == tracer.trace_id
+    assert {"key": "entity", "value": {"stringValue": service.id}} in (
+        otlp_spans["rancher.json"]["attributes"]
+    )
+
+
+def test_hook_spans(enabled):
+    class Hook(Base):
+        is_active = True
+
+        def after_upgrade_success(self):
+            raise RuntimeError("nope")
+
+    with tracer.span("after_upgrade_success"):
+        wait_for([Worker(Hook).submit("after_upgrade_success")])
+
+    spans = spans_by_name()
+    assert spans["hook"].parent_id == spans["after_upgrade_success"].span_id
+    assert spans["hook"].attributes == {
+        "hook": "test_tracing",
+        "event": "after_upgrade_success",
+    }
+    assert spans["hook"].error == "RuntimeError: nope"
+    assert spans["after_upgrade_success"].error is None
@@ -0,0 +1,115 @@
+import json
+
+import pybreaker
+import pytest
+import requests
+
+from crane import settings, transport as uut
+
+
+@pytest.fixture(autouse=True)
+def accounting(monkeypatch):
+    fresh = uut.Accounting()
+    monkeypatch.setattr(uut, "accounting", fresh)
+    return fresh
+
+
+@pytest.fixture
+def session():
+    session = requests.Session()
+    session.mount("http://", uut.Adapter(max_retries=0))
+    return session
+
+
+@pytest.mark.parametrize(
+    ["url", "expected"],
+    [
+        [
+            "https://slack.com/api/chat.postMessage",
+            ("slack.com", "/api/chat.postMessage"),
+        ],
+        [
+            "https://r.example.com/v1/projects/1a5/services?name=app",
+            ("r.example.com", "/v1/projects/{id}/services"),
+        ],
+        [
+            "https://sentry.io/api/hooks/release/builtin/12/f00d/",
+            ("sentry.io", "/api/hooks/{id}/{id}/{id}/{id}/"),
+        ],
+        [
+            "https://hooks.example.com/services/deploys/WebhookSecretOnlyLetters",
+            ("hooks.example.com", "/services/deploys/{id}"),
+        ],
+        [
+            "https://elsewhere.example.com/v1/projects/services",
+            ("elsewhere.example.com", "/v1/projects/{id}"),
+        ],
+        ["https://example.com", ("example.com", "/")],
+    ],
+)
+def test_endpoint_of(monkeypatch, url, expected):
+    monkeypatch.setitem(settings, "url", "https://r.example.com")
+    assert uut.endpoint_of(url) == expected
+
+
+def test_adapter(accounting, session, http_server, tmp_path):
+    for service_id in ["1s1", "1s2"]:
+        session.get(f"{http_server.url}/v1/services/{service_id}")
+    session.post(f"{http_server.url}/hook", data=b"{}")
+    http_server.status = 500
+    session.post(f"{http_server.url}/hook", data=b"{}")
+
+    services = accounting.endpoints[("127.0.0.1", "/v1/services/{id}")]
+    assert services.count == 2
+    assert services.bytes_received == 4
+    assert services.errors == 0
+    hook = accounting.endpoints[("127.0.0.1", "/hook")]
+    assert (hook.count, hook.errors, hook.bytes_sent) == (2, 1, 4)
+
+    lines = accounting.table().splitlines()
+    assert lines[0].split() == [
+        "host",
+        "endpoint",
+        "requests",
+        "errors",
+        "retries",
+        "sent",
+        "received",
+        "p50",
+        "p90",
+        "p99",
+    ]
+    assert lines[1].split()[:7] == ["127.0.0.1", "/hook", "2", "1", "0", "4", "4"]
+
+    accounting.write(tmp_path / "http.json")
+    profile = json.loads((tmp_path / "http.json").read_text())
+    assert [entry["endpoint"] for entry in profile["endpoints"]] == [
+        "/hook",
+        "/v1/services/{id}",
+    ]
+    assert profile["endpoints"][1]["latency"]["p99"] > 0
+
+
+def test_adapter_unreachable(accounting, http_server):
+    session = requests.Session()
+    session.mount("http://", uut.Adapter(max_retries=2))
+    http_server.shutdown()
+    http_server.server_close()
+
+    with pytest.raises(requests.ConnectionError):
+        session.get(f"{http_server.url}/v1/services")
+
+    stats = accounting.endpoints[("127.0.0.1", "/v1/services")]
+    assert (stats.count, stats.errors, stats.retries) == (1, 1, 2)
+
+
+def test_breaker_trips(accounting):
+    breaker = pybreaker.CircuitBreaker(
+        fail_max=1, name="Test", listeners=[uut.TripCounter()]
+    )
+
+    with pytest.raises(pybreaker.CircuitBreakerError):
+        breaker.call(lambda: 1 / 0)
+
+    assert accounting.breaker_trips == {"Test": 1}
+    assert accounting.table().endswith("The Test circuit breaker tripped once.")
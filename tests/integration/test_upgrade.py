@@ -1,3 +1,9 @@
+from base64 import b64encode
+import hashlib
+import json
+import re
+import socket
+import threading
 import time
 
 import pybreaker
@@ -8,21 +14,61 @@ import crane
 import crane.exc
 from crane import upgrade as uut, settings
 
-
-class FakeService:
-    log_name = "service_log_name"
-
-    def __init__(self, state=None):
-        self.state = state
-
-    def start_upgrade(self):
-        pass
-
-    def finish_upgrade(self):
-        pass
-
-    def json(self):
-        return {"state": self.state}
+from .conftest import CountingStack, FakeService, FakeStack, UpgradingService
+
+
+@pytest.fixture(autouse=True)
+def click_settings(monkeypatch, upgrade_settings):
+    monkeypatch.setitem(settings, "env", "1a81")
+
+
+CLOSE_FRAME = object()
+
+
+class FakeRancherEvents:
+    """A tiny websocket server standing in for Rancher's event subscription."""
+
+    def __init__(self, events):
+        self.events = events
+        self.server = socket.socket()
+        self.server.bind(("127.0.0.1", 0))
+        self.server.listen(1)
+        self.url = "http://127.0.0.1:{}".format(self.server.getsockname()[1])
+        self.request = b""
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+
+    def serve(self):
+        connection, _ = self.server.accept()
+        with connection:
+            while b"\r\n\r\n" not in self.request:
+                self.request += connection.recv(1024)
+            key = re.search(rb"Sec-WebSocket-Key: (\S+)", self.request, re.I).group(1)
+            accept = b64encode(
+                hashlib.sha1(key + b"258EAFA5-E914-47DA-95CA-C5AB0DC85B11").digest()
+            )
+            connection.sendall(
+                b"HTTP/1.1 101 Switching Protocols\r\n"
+                b"Upgrade: websocket\r\nConnection: Upgrade\r\n"
+                b"Sec-WebSocket-Accept: " + accept + b"\r\n\r\n"
+            )
+            for event in self.events:
+                if event is CLOSE_FRAME:
+                    connection.sendall(bytes([0x88, 0]))
+                    while connection.recv(1024):  # until the client hangs up
+                        pass
+                    break
+                payload = json.dumps(event).encode()
+                connection.sendall(bytes([0x81, len(payload)]) + payload)
+        self.server.close()  # dropping the connection after the last event
+
+
+def service_event(service, state):
+    return {
+        "name": "resource.change",
+        "resourceId": service.id,
+        "data": {"resource": {"state": state}},
+    }
 
 
 def get_fake_check_state(exception_to_raise=None):
@@ -36,20 +82,6 @@ def get_fake_check_state(exception_to_raise=None):
     return fake_check_state
 
 
-@pytest.mark.parametrize("count", [0, 1, 10])
-def test_service_start_upgrade(mocker, count):
-    fake_start_upgrade = mocker.patch.object(FakeService, "start_upgrade")
-    uut.service_start_upgrade([FakeService() for _ in range(count)])
-    assert fake_start_upgrade.call_count == count
-
-
-@pytest.mark.parametrize("count", [0, 1, 10])
-def test_service_finish_upgrade(mocker, count):
-    fake_finish_upgrade = mocker.patch.object(FakeService, "finish_upgrade")
-    uut.service_finish_upgrade([FakeService() for _ in range(count)])
-    assert fake_finish_upgrade.call_count == count
-
-
 @pytest.mark.parametrize(
     ["states", "raises"],
     [
@@ -72,11 +104,39 @@ def test_check_state(states, raises):
         uut.check_state(services, done)
 
 
+def test_check_state_single_request_per_stack(mocker):
+    stack = FakeStack()
+    services = [FakeService("upgrading", stack) for _ in range(20)]
+    fake_json = mocker.patch.object(FakeService, "json")
+    done = set()
+
+    uut.check_state(services, done)
+    assert stack.list_count == 1
+    assert not done
+
+    for service in services[:5]:
+        service.state = "upgraded"
+    uut.check_state(services, done)
+    assert stack.list_count == 2
+    assert done == set(services[:5])
+    assert fake_json.call_count == 0
+
+
+def test_check_state_unlisted_service():
+    stack = FakeStack()
+    service = FakeService("upgraded", stack)
+    stack.services.clear()
+    done = set()
+
+    uut.check_state([service], done)
+    assert done == {service}
+
+
 @pytest.mark.parametrize(
     ["services", "sleep_count"], [[set(), 0], [range(1), 1], [range(666), 666]]
 )
-def test_wait_for_upgrade_ok(mocker, services, sleep_count):
-    uut.check_state = get_fake_check_state(None)
+def test_wait_for_upgrade_ok(monkeypatch, mocker, services, sleep_count):
+    monkeypatch.setattr(uut, "check_state", get_fake_check_state(None))
     fake_sleep = mocker.patch.object(time, "sleep")
     uut.wait_for_upgrade(set(services))
     assert fake_sleep.call_count == sleep_count
@@ -90,8 +150,8 @@ def test_wait_for_upgrade_ok(mocker, services, sleep_count):
         [set(range(1)), requests.RequestException, None],
     ],
 )
-def test_wait_for_upgrade_error(services, error_to_raise, expected_error):
-    uut.check_state = get_fake_check_state(error_to_raise)
+def test_wait_for_upgrade_error(monkeypatch, services, error_to_raise, expected_error):
+    monkeypatch.setattr(uut, "check_state", get_fake_check_state(error_to_raise))
 
     with pytest.raises(Exception) as e:
         uut.wait_for_upgrade(set(services))
@@ -101,39 +161,320 @@ def test_wait_for_upgrade_error(services, error_to_raise, expected_error):
             assert not e
 
 
-@pytest.mark.parametrize("sleep_after_upgrade", [0, 1, 1])
-def test_sleep_after_upgrade(monkeypatch, mocker, sleep_after_upgrade):
-    services = set(range(42))
-    monkeypatch.setitem(settings, "sleep_after_upgrade", sleep_after_upgrade)
-    monkeypatch.setitem(settings, "manual_finish", False)
-
+@pytest.mark.parametrize(
+    ["scale", "batch_size", "batch_interval", "expected"],
+    [[1, 1, 2, 1.75], [1, 1, 0, 1.25], [4, 2, 5, 5], [100, 1, 2, 10]],
+)
+def test_poll_scheduler_from_settings(
+    monkeypatch, scale, batch_size, batch_interval, expected
+):
+    monkeypatch.setitem(settings, "batch_size", batch_size)
+    monkeypatch.setitem(settings, "batch_interval", batch_interval)
+    scheduler = uut.PollScheduler.from_settings(scale)
+    assert scheduler.base_interval == expected
+    assert scheduler.deadline is None
+
+
+def test_poll_scheduler_backoff():
+    scheduler = uut.PollScheduler(base_interval=2, jitter=0)
+    assert scheduler.delay() == 2
+    scheduler.record(progressed=False)
+    assert scheduler.delay() == 3
+    for _ in range(20):
+        scheduler.record(progressed=False)
+    assert scheduler.delay() == uut.MAX_POLL_INTERVAL
+    scheduler.record(progressed=True)
+    assert scheduler.delay() == 2
+
+
+def test_poll_scheduler_jitter():
+    scheduler = uut.PollScheduler(base_interval=10, jitter=0.1)
+    assert all(9 <= scheduler.delay() <= 11 for _ in range(100))
+
+
+def test_wait_for_upgrade_timeout(monkeypatch, mocker):
+    monkeypatch.setitem(settings, "upgrade_timeout", 60)
+    fake_check_state = mocker.patch.object(uut, "check_state")
     fake_sleep = mocker.patch.object(time, "sleep")
-    fake_service_finish_upgrade = mocker.patch.object(uut, "service_finish_upgrade")
+    fake_secho = mocker.patch.object(uut.click, "secho")
+    mocker.patch.object(time, "monotonic", side_effect=[0, 30, 100])
+    scheduler = uut.PollScheduler(base_interval=1, deadline=60)
 
-    uut.after_upgrade(services)
+    stuck = FakeService("upgrading")
+    with pytest.raises(crane.exc.UpgradeFailed):
+        uut.wait_for_upgrade([stuck], scheduler)
 
-    if sleep_after_upgrade:
-        fake_sleep.assert_called_with(sleep_after_upgrade)
-    else:
-        assert fake_sleep.call_count == 0
+    assert fake_check_state.call_count == 1
+    assert fake_sleep.call_count == 1
+    assert stuck.log_name in fake_secho.call_args[0][0]
+
+
+def test_wait_for_upgrade_events(monkeypatch, mocker):
+    stack = FakeStack()
+    services = [FakeService("upgrading", stack) for _ in range(3)]
+    server = FakeRancherEvents(
+        [
+            {"name": "ping"},
+            service_event(services[0], "upgraded"),
+            service_event(FakeService("upgraded"), "upgraded"),
+            service_event(services[1], "upgrading"),
+            service_event(services[1], "upgraded"),
+            service_event(services[2], "upgraded"),
+        ]
+    )
+    monkeypatch.setitem(settings, "url", server.url)
+    fake_wait_for_upgrade = mocker.patch.object(uut, "wait_for_upgrade")
+
+    uut.wait_for_upgrade_events(services)
+
+    assert b"GET /v1/projects/1a81/subscribe?eventNames=resource.change" in (
+        server.request
+    )
+    assert stack.list_count == 1
+    assert fake_wait_for_upgrade.call_count == 0
+
+
+def test_wait_for_upgrade_events_failure(monkeypatch):
+    service = FakeService("upgrading")
+    server = FakeRancherEvents([service_event(service, "error")])
+    monkeypatch.setitem(settings, "url", server.url)
+
+    with pytest.raises(crane.exc.UpgradeFailed):
+        uut.wait_for_upgrade_events([service])
+
+
+def test_wait_for_upgrade_events_fallback(monkeypatch, mocker):
+    stack = FakeStack()
+    services = [FakeService("upgrading", stack) for _ in range(2)]
+    server = FakeRancherEvents([service_event(services[0], "upgraded")])
+    monkeypatch.setitem(settings, "url", server.url)
+    fake_wait_for_upgrade = mocker.patch.object(uut, "wait_for_upgrade")
+
+    uut.wait_for_upgrade_events(services)
+
+    (_, _, done), _ = fake_wait_for_upgrade.call_args
+    assert done == {services[0]}
+
+
+def test_wait_for_upgrade_events_closed(monkeypatch, mocker):
+    stack = FakeStack()
+    services = [FakeService("upgrading", stack) for _ in range(2)]
+    server = FakeRancherEvents([service_event(services[0], "upgraded"), CLOSE_FRAME])
+    monkeypatch.setitem(settings, "url", server.url)
+    fake_wait_for_upgrade = mocker.patch.object(uut, "wait_for_upgrade")
+
+    uut.wait_for_upgrade_events(services)
+
+    (_, _, done), _ = fake_wait_for_upgrade.call_args
+    assert done == {services[0]}
+
+
+def test_wait_for_upgrade_events_unreachable(monkeypatch, mocker):
+    with socket.socket() as closed:
+        closed.bind(("127.0.0.1", 0))
+        port = closed.getsockname()[1]
+    monkeypatch.setitem(settings, "url", f"http://127.0.0.1:{port}")
+    fake_wait_for_upgrade = mocker.patch.object(uut, "wait_for_upgrade")
+
+    uut.wait_for_upgrade_events([FakeService("upgrading")])
+    assert fake_wait_for_upgrade.call_count == 1
+
+
+@pytest.mark.parametrize("count", [0, 1, 10])
+@pytest.mark.parametrize("parallelism", [1, 4])
+def test_run_concurrently(monkeypatch, mocker, count, parallelism):
+    monkeypatch.setitem(settings, "parallelism", parallelism)
+    fake_start_upgrade = mocker.patch.object(FakeService, "start_upgrade")
+    services = [FakeService() for _ in range(count)]
+
+    assert uut.run_concurrently(services, "start_upgrade") == []
+    assert fake_start_upgrade.call_count == count
+
+
+@pytest.mark.parametrize(
+    ["per_stack", "overall", "expected_per_stack", "expected_overall"],
+    [[1, 0, 1, 3], [2, 0, 2, 6], [2, 3, 2, 3], [1, 1, 1, 1]],
+)
+def test_run_concurrently_limits(
+    monkeypatch, mocker, per_stack, overall, expected_per_stack, expected_overall
+):
+    monkeypatch.setitem(settings, "parallelism", per_stack)
+    monkeypatch.setitem(settings, "max_parallelism", overall)
+    lock = threading.Lock()
+    running = []
+    peak = {"overall": 0}
+
+    class SlowService(FakeService):
+        def start_upgrade(self):
+            with lock:
+                running.append(self)
+                peak["overall"] = max(peak["overall"], len(running))
+                in_stack = sum(service.stack is self.stack for service in running)
+                peak[self.stack] = max(peak.get(self.stack, 0), in_stack)
+            time.sleep(0.05)
+            with lock:
+                running.remove(self)
+
+    stacks = [FakeStack() for _ in range(3)]
+    services = [SlowService(stack=stack) for stack in stacks for _ in range(4)]
+
+    assert uut.run_concurrently(services, "start_upgrade") == []
+    assert peak.pop("overall") == expected_overall
+    assert max(peak.values()) <= expected_per_stack
+
+
+def test_run_concurrently_failures(monkeypatch):
+    monkeypatch.setitem(settings, "parallelism", 4)
+
+    class FlakyService(FakeService):
+        def start_upgrade(self):
+            if self.state == "broken":
+                raise crane.exc.UpgradeFailed()
+
+    stack = FakeStack()
+    services = [FlakyService(state, stack) for state in ["broken", None, "broken"]]
+
+    failed = uut.run_concurrently(services, "start_upgrade")
+    assert failed == [services[0], services[2]]
+
+
+def test_run_concurrently_failures_settle(monkeypatch):
+    monkeypatch.setitem(settings, "parallelism", 4)
+    started = []
+
+    class FlakyService(FakeService):
+        def __init__(self, error=None):
+            super().__init__()
+            self.error = error
+
+        def start_upgrade(self):
+            started.append(self)
+            if self.error:
+                raise self.error
+
+    services = [
+        FlakyService(crane.exc.UpgradeFailed()),
+        FlakyService(),
+        FlakyService(requests.ConnectionError()),
+        FlakyService(),
+    ]
+
+    failed = uut.run_concurrently(services, "start_upgrade")
+    assert failed == [services[0], services[2]]
+    assert sorted(map(id, started)) == sorted(map(id, services))
+
+
+def test_run_concurrently_fail_fast():
+    class FlakyService(FakeService):
+        started = False
+
+        def start_upgrade(self):
+            self.started = True
+            if self.state == "broken":
+                raise crane.exc.UpgradeFailed()
+
+    stack = FakeStack()
+    services = [FlakyService(state, stack) for state in [None, "broken", None]]
+
+    with pytest.raises(crane.exc.UpgradeFailed):
+        uut.run_concurrently(services, "start_upgrade")
+    assert [service.started for service in services] == [True, True, False]
 
-    fake_service_finish_upgrade.assert_called_with(services)
 
+def test_upgrade(mocker):
+    mocker.patch.object(uut, "deployment")
+    mocker.patch.object(uut.PollScheduler, "delay", return_value=0)
+    stacks = [CountingStack() for _ in range(2)]
+    services = [UpgradingService(polls, stack) for stack in stacks for polls in [1, 3]]
 
-@pytest.mark.parametrize("sleep_after_upgrade", [0, 1, 1])
-def test_manual_finish(monkeypatch, mocker, sleep_after_upgrade):
-    services = set(range(42))
+    uut.upgrade(services)
+
+    assert all(service.state == "upgraded" for service in services)
+    assert all(service.finished for service in services)
+    assert all(stack.list_count == 3 for stack in stacks)
+
+
+def test_upgrade_reads_scale_before_starting(mocker):
+    mocker.patch.object(uut, "deployment")
+    mocker.patch.object(uut.PollScheduler, "delay", return_value=0)
+    calls = []
+
+    class CachedService(UpgradingService):
+        @property
+        def scale(self):
+            calls.append("scale")
+            return 1
+
+        def start_upgrade(self):
+            calls.append("start_upgrade")
+
+    uut.upgrade([CachedService(1, CountingStack())])
+    assert calls == ["scale", "start_upgrade"]
+
+
+def test_wait_for_upgrade_deadline(mocker):
+    fake_secho = mocker.patch.object(uut.click, "secho")
+    stuck = UpgradingService(1000, CountingStack())
+    scheduler = uut.PollScheduler(base_interval=0.01, deadline=time.monotonic() + 0.1)
+
+    with pytest.raises(crane.exc.UpgradeFailed):
+        uut.wait_for_upgrade([stuck], scheduler)
+
+    assert stuck.log_name in fake_secho.call_args[0][0]
+    assert stuck.stack.list_count >= 1
+
+
+def test_lookup(mocker):
+    stacks = [mocker.Mock(), mocker.Mock()]
+    stacks[0].services_from_names.return_value = ["a", "b"]
+    stacks[1].services_from_names.return_value = ["c"]
+    mocker.patch.object(uut.rancher.Stack, "from_names", return_value=stacks)
+
+    assert uut.lookup([("eu", ("a", "b")), ("us", ("c",))]) == (
+        stacks,
+        ["a", "b", "c"],
+    )
+    stacks[0].services_from_names.assert_called_with(("a", "b"), True)
+
+
+def test_lookup_merges_repeated_stacks(mocker):
+    stacks = [mocker.Mock(), mocker.Mock()]
+    for stack in stacks:
+        stack.services_from_names.return_value = []
+    fake_from_names = mocker.patch.object(
+        uut.rancher.Stack, "from_names", return_value=stacks
+    )
+
+    uut.lookup([("eu", ("a", "b")), ("us", ("c",)), ("eu", ("b", "d"))])
+    fake_from_names.assert_called_with(["eu", "us"])
+    stacks[0].services_from_names.assert_called_with(("a", "b", "d"), True)
+    stacks[1].services_from_names.assert_called_with(("c",), True)
+
+
+def test_lookup_failure(mocker):
+    stacks = [mocker.Mock(), mocker.Mock()]
+    stacks[0].services_from_names.side_effect = crane.exc.UpgradeFailed()
+    stacks[1].services_from_names.return_value = ["c"]
+    mocker.patch.object(uut.rancher.Stack, "from_names", return_value=stacks)
+
+    with pytest.raises(crane.exc.UpgradeFailed):
+        uut.lookup([("eu", ("a",)), ("us", ("c",))])
+    assert stacks[1].services_from_names.called
+
+
+@pytest.mark.parametrize("manual_finish", [False, True])
+@pytest.mark.parametrize("sleep_after_upgrade", [0, 1])
+def test_after_upgrade(monkeypatch, sleep_after_upgrade, manual_finish):
     monkeypatch.setitem(settings, "sleep_after_upgrade", sleep_after_upgrade)
-    monkeypatch.setitem(settings, "manual_finish", True)
+    monkeypatch.setitem(settings, "manual_finish", manual_finish)
+    slept = []
 
-    fake_sleep = mocker.patch.object(time, "sleep")
-    fake_service_finish_upgrade = mocker.patch.object(uut, "service_finish_upgrade")
+    monkeypatch.setattr(uut.time, "sleep", slept.append)
+    services = [UpgradingService(0, FakeStack()) for _ in range(3)]
 
     uut.after_upgrade(services)
 
-    if sleep_after_upgrade:
-        fake_sleep.assert_called_with(sleep_after_upgrade)
-    else:
-        assert fake_sleep.call_count == 0
-
-    assert fake_service_finish_upgrade.call_count == 0
+    assert slept == ([sleep_after_upgrade] if sleep_after_upgrade else [])
+    assert [hasattr(service, "finished") for service in services] == [
+        not manual_finish
+    ] * 3